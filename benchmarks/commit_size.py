@@ -0,0 +1,140 @@
+"""
+Commit Size Benchmark
+=====================
+
+  Rebuilds the sparkify database with create_tables.py, then times a
+    full etl.py run for each --commit-every setting, reporting the
+    rows in the database afterwards and rows/sec.
+
+  WARNING: this drops and recreates the sparkify database for each
+    setting.
+
+  Run from the repository root with:
+
+      python -m benchmarks.commit_size --data-root /path/to/dir
+
+  where /path/to/dir contains data/song_data and data/log_data. Extra
+    etl.py options can be given after '--', for example:
+
+      python -m benchmarks.commit_size -- --songplay-loader staged
+
+  With --partition the tables are created range-partitioned by month.
+    Over logs that cross a month boundary this is also the regression
+    run for partitions created in the middle of a --commit-every
+    transaction, which used to hang etl.py; each run is stopped after
+    --timeout seconds, reported as 'hung', and the command then exits
+    with status 1:
+
+      python -m benchmarks.generate_data --output /tmp/boundary \\
+          --days 4 --start-date 2018-11-29
+      python -m benchmarks.commit_size --data-root /tmp/boundary \\
+          --partition songplays time --settings 100 10000 file
+
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import psycopg2
+
+import connection_pool
+import etl
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMIT_SETTINGS = ['autocommit', '1', '100', '1000', '10000', 'file']
+
+TIMEOUT = 600
+
+TABLES = ['songs', 'artists', 'time', 'users', 'songplays']
+
+
+def count_rows():
+
+    """
+    Returns the total number of rows in the five star schema tables.
+    """
+
+    connection = psycopg2.connect(connection_pool.dsn())
+    try:
+        cursor = connection.cursor()
+        total = 0
+        for table in TABLES:
+            cursor.execute(f'SELECT count(*) FROM {table}')
+            total += cursor.fetchone()[0]
+        return total
+    finally:
+        connection.close()
+
+
+def run_script(script, arguments, data_root, timeout=None):
+
+    """
+    Runs one of the repository's scripts with 'data_root' as the
+      working directory, returning the elapsed seconds. A script
+      still running after 'timeout' seconds is killed and raises
+      subprocess.TimeoutExpired.
+    """
+
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, os.path.join(REPOSITORY, script)] + arguments,
+        cwd=data_root,
+        env=dict(os.environ, PYTHONPATH=REPOSITORY),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+        timeout=timeout
+        )
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--data-root', default='.',
+                        help='directory containing data/song_data and '
+                             'data/log_data')
+    parser.add_argument('--settings', nargs='+', default=COMMIT_SETTINGS,
+                        help='commit settings to compare, "autocommit" '
+                             'runs etl.py without --commit-every')
+    parser.add_argument('--partition', nargs='+', default=[],
+                        metavar='TABLE',
+                        help='create these tables (songplays, time) '
+                             'range-partitioned by month')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT,
+                        help='seconds after which an etl.py run counts '
+                             'as hung')
+    parser.add_argument('etl_arguments', nargs='*',
+                        help='extra etl.py options, after --')
+    options = parser.parse_args(argv)
+
+    print(f'{"commit every":>12} {"seconds":>9} {"rows":>10} '
+          f'{"rows/sec":>10}')
+    hung = False
+    for setting in options.settings:
+        create_arguments = []
+        if options.partition:
+            create_arguments = ['--partition'] + options.partition
+        run_script('create_tables.py', create_arguments, options.data_root)
+        arguments = list(options.etl_arguments)
+        if setting != 'autocommit':
+            arguments += ['--commit-every', setting]
+        try:
+            seconds = run_script('etl.py', arguments, options.data_root,
+                                 options.timeout)
+        except subprocess.TimeoutExpired:
+            print(f'{setting:>12} {"hung":>9}')
+            hung = True
+            continue
+        rows = count_rows()
+        print(f'{setting:>12} {seconds:9.2f} {rows:>10} '
+              f'{rows / seconds:>10,.0f}')
+    if hung:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Compact Schema Benchmark
+========================
+
+  Loads the same dataset into the usual star schema and into the
+    compact one (create_tables.py --compact) and reports, for each
+    table, the average row width, the size of the table and of the
+    table with its indexes, and then the time etl.py took and the
+    time of a query joining songplays to time, songs and artists.
+
+  WARNING: this drops and recreates the sparkify database for each
+    schema.
+
+  Run from the repository root with:
+
+      python -m benchmarks.compact_schema --data-root /path/to/dir
+
+  where /path/to/dir contains data/song_data and data/log_data, for
+    example one written by generate_data.py. etl.py runs with the set
+    based loaders unless other options are given after '--'.
+
+"""
+
+import argparse
+import time
+
+import psycopg2
+
+import connection_pool
+from benchmarks.commit_size import TABLES, run_script
+
+SCHEMAS = {'standard': [], 'compact': ['--compact']}
+
+DEFAULT_ETL_ARGUMENTS = ['--song-loader', 'copy',
+                         '--songplay-loader', 'staged']
+
+"""
+  Plays per weekday with the number resolved to an artist, the join
+    that surrogate keys are for, written for each schema.
+"""
+
+JOIN_QUERIES = {
+    'standard': ('SELECT time.weekday, count(*), count(artists.name)'
+                 ' FROM songplays'
+                 ' JOIN time ON time.time_key = songplays.time_key'
+                 ' LEFT JOIN songs ON songs.song_id = songplays.song_id'
+                 ' LEFT JOIN artists'
+                 ' ON artists.artist_id = songs.artist_id'
+                 ' GROUP BY time.weekday'),
+    'compact': ('SELECT time.weekday, count(*), count(artists.name)'
+                ' FROM songplays'
+                ' JOIN time ON time.time_key = songplays.time_key'
+                ' LEFT JOIN songs ON songs.song_key = songplays.song_key'
+                ' LEFT JOIN artists'
+                ' ON artists.artist_key = songs.artist_key'
+                ' GROUP BY time.weekday')
+    }
+
+table_size_select = ('SELECT count(*), coalesce(avg(pg_column_size(t.*)), 0),'
+                     ' pg_relation_size(%(table)s),'
+                     ' pg_total_relation_size(%(table)s)'
+                     ' FROM {table} AS t')
+
+
+def measure_tables(cursor):
+
+    """
+    Returns a dictionary of table -> (rows, average row bytes, table
+      bytes, table and index bytes).
+    """
+
+    sizes = {}
+    for table in TABLES:
+        cursor.execute(table_size_select.format(table=table),
+                       {'table': table})
+        rows, width, heap, total = cursor.fetchone()
+        sizes[table] = (rows, float(width), heap, total)
+    return sizes
+
+
+def time_query(cursor, query, repeat):
+
+    """
+    Returns the shortest of 'repeat' timings of 'query', in seconds,
+      after one run to warm the cache.
+    """
+
+    cursor.execute(query)
+    cursor.fetchall()
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cursor.execute(query)
+        cursor.fetchall()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--data-root', default='.',
+                        help='directory containing data/song_data and '
+                             'data/log_data')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timings of the join query, the best is '
+                             'reported')
+    parser.add_argument('etl_arguments', nargs='*',
+                        help='extra etl.py options, after --')
+    options = parser.parse_args(argv)
+    etl_arguments = options.etl_arguments or DEFAULT_ETL_ARGUMENTS
+
+    results = {}
+    for schema, arguments in SCHEMAS.items():
+        run_script('create_tables.py', arguments, options.data_root)
+        load_seconds = run_script('etl.py', etl_arguments,
+                                  options.data_root)
+        connection = psycopg2.connect(connection_pool.dsn())
+        connection.set_session(autocommit=True)
+        try:
+            cursor = connection.cursor()
+            cursor.execute('VACUUM ANALYZE')
+            results[schema] = (measure_tables(cursor), load_seconds,
+                               time_query(cursor, JOIN_QUERIES[schema],
+                                          options.repeat))
+        finally:
+            connection.close()
+
+    print(f'{"table":<10} {"schema":<9} {"rows":>9} {"row bytes":>10} '
+          f'{"table MB":>9} {"+indexes MB":>12}')
+    for table in TABLES:
+        for schema, (sizes, _, _) in results.items():
+            rows, width, heap, total = sizes[table]
+            print(f'{table:<10} {schema:<9} {rows:>9} {width:>10.1f} '
+                  f'{heap / 2 ** 20:>9.2f} {total / 2 ** 20:>12.2f}')
+    print()
+    load_baseline, baseline = results['standard'][1:]
+    for schema, (_, load_seconds, seconds) in results.items():
+        print(f'etl.py     {schema:<9} {load_seconds:>9.1f} s  '
+              f'{load_baseline / load_seconds:>6.2f}x')
+    for schema, (_, _, seconds) in results.items():
+        print(f'join query {schema:<9} {seconds * 1000:>9.1f} ms '
+              f'{baseline / seconds:>6.2f}x')
+
+
+if __name__ == "__main__":
+    main()
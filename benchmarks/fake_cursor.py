@@ -0,0 +1,158 @@
+"""
+In-memory Cursor
+================
+
+  A stand-in for a psycopg2 connection and cursor, so the etl.py
+    functions that take a cursor (process_song_file,
+    process_log_dataframe and so on) can be run without a database.
+
+  Every statement is formatted exactly as psycopg2 would send it,
+    values quoted by psycopg2's own adapters, and COPY input is read
+    to the end, so the client-side cost of a statement is still paid;
+    only the round trip and the server's work are missing. The
+    cursor counts the statements it was given, by their name in
+    sql_queries.py, and the rows and bytes they carried.
+
+  SELECTs return no rows unless a response is registered for the
+    statement, for example:
+
+      cursor = FakeConnection().cursor()
+      cursor.responses['songplay_staging_insert'] = lambda: (0, 0)
+
+"""
+
+import collections
+
+import psycopg2.extensions
+
+import sql_trace
+
+
+class FakeConnection:
+
+    """
+    The parts of a psycopg2 connection etl.py and
+      psycopg2.extras.execute_values use.
+    """
+
+    encoding = 'UTF8'
+
+    def __init__(self):
+        self.autocommit = True
+        self.commits = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.commit()
+
+    def set_session(self, autocommit=None, **kwargs):
+        if autocommit is not None:
+            self.autocommit = autocommit
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeCursor:
+
+    """
+    A cursor that formats statements without sending them.
+
+    Attributes:
+
+     - statements: Counter of statement name -> calls
+     - rows: Counter of statement name -> rows sent, a row for each
+         set of parameters formatted or line of COPY input
+     - bytes_sent: total size of the formatted statements and COPY
+         input
+     - responses: statement name -> callable returning the row for
+         fetchone
+    """
+
+    def __init__(self, connection=None):
+        self.connection = connection or FakeConnection()
+        self.statements = collections.Counter()
+        self.rows = collections.Counter()
+        self.bytes_sent = 0
+        self.responses = {}
+        self.rowcount = -1
+        self.mogrified = 0
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return iter(())
+
+    def mogrify(self, query, vars=None):
+
+        """
+        Formats 'query' with 'vars' as psycopg2 would, returning
+          bytes, and counts one row of parameters formatted.
+        """
+
+        if isinstance(query, str):
+            query = query.encode('utf-8')
+        if vars is None:
+            return query
+        quoted = []
+        for value in vars:
+            adapted = psycopg2.extensions.adapt(value)
+            if hasattr(adapted, 'encoding'):
+                adapted.encoding = 'utf8'
+            quoted.append(adapted.getquoted())
+        self.mogrified += 1
+        return query % tuple(quoted)
+
+    def execute(self, query, vars=None):
+        if vars is not None:
+            self.mogrified = 0
+        statement = self.mogrify(query, vars)
+        name = sql_trace.statement_name(statement)
+        self.statements[name] += 1
+        self.rows[name] += max(self.mogrified, 1)
+        self.bytes_sent += len(statement)
+        self.rowcount = max(self.mogrified, 1)
+        self.mogrified = 0
+        response = self.responses.get(name)
+        self.result = response() if response else None
+
+    def executemany(self, query, vars_list):
+        for vars in vars_list:
+            self.execute(query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        name = sql_trace.statement_name(sql)
+        self.statements[name] += 1
+        self.rowcount = 0
+        for line in file:
+            self.rowcount += 1
+            self.bytes_sent += len(line)
+        self.rows[name] += self.rowcount
+
+    def fetchone(self):
+        result, self.result = self.result, None
+        return result
+
+    def fetchall(self):
+        result = self.fetchone()
+        return [result] if result is not None else []
+
+    def close(self):
+        pass
@@ -0,0 +1,467 @@
+"""
+Synthetic Dataset Generator
+===========================
+
+  Writes a Sparkify dataset of any size for scale testing:
+
+   - data/song_data: N song files in the Million Song Dataset layout
+       that process_song_file expects, one song per file at
+       A/B/C/TRABC....json
+   - data/log_data: M days of yyyy/mm/yyyy-mm-dd-events.json activity
+       logs, one JSON event per line in time order
+
+  The logs are built from user sessions with a realistic page mix
+    (mostly NextSong, with Home, Thumbs Up, Logout, Roll Advert and
+    so on), Zipf distributed song popularity and users moving between
+    the free and paid levels through the Submit Upgrade and Submit
+    Downgrade pages. --match-fraction sets the share of NextSong
+    events that play a song from the catalog; the rest play songs
+    that aren't in it, as most do in the real logs.
+
+  The output depends only on the options, the same --seed always
+    gives the same files. Songs are rebuilt from their index when an
+    event needs them and each day is written as its sessions run, so
+    memory use depends on the catalog size and not on the number of
+    events.
+
+  Run from the repository root with, for example:
+
+      python -m benchmarks.generate_data --output /tmp/scale \\
+          --songs 100000 --days 30 --events-per-day 500000
+
+"""
+
+import argparse
+import datetime
+import functools
+import heapq
+import itertools
+import json
+import os
+import random
+import time
+
+import numpy as np
+
+WORDS = ['Love', 'Night', 'Heart', 'Fire', 'Dream', 'Rain', 'Blue',
+         'Summer', 'Road', 'River', 'Gold', 'Shadow', 'Light', 'Wild',
+         'City', 'Dance', 'Ocean', 'Stone', 'Silver', 'Morning', 'Star',
+         'Echo', 'Storm', 'Paper', 'Glass', 'Velvet', 'Thunder', 'Sugar',
+         'Winter', 'Garden', 'Mirror', 'Electric', 'Lonely', 'Golden',
+         'Midnight', 'Broken', 'Falling', 'Running', 'Sweet', 'Little']
+
+FIRST_NAMES = ['Aiden', 'Ava', 'Carlos', 'Chloe', 'Elijah', 'Emily',
+               'Jacob', 'Jayden', 'Kate', 'Layla', 'Lily', 'Mohammad',
+               'Noah', 'Rylan', 'Sara', 'Tegan', 'Wyatt', 'Zoe']
+
+LAST_NAMES = ['Allen', 'Arnold', 'Barrera', 'Cruz', 'Garrison', 'Harrell',
+              'Johnson', 'Koch', 'Levine', 'Moore', 'Owens', 'Robinson',
+              'Smith', 'Summers', 'Williams', 'Young']
+
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA',
+             'New York-Newark-Jersey City, NY-NJ-PA',
+             'Atlanta-Sandy Springs-Roswell, GA',
+             'Chicago-Naperville-Elgin, IL-IN-WI',
+             'Houston-The Woodlands-Sugar Land, TX',
+             'Lansing-East Lansing, MI',
+             'Portland-South Portland, ME',
+             'Waterloo-Cedar Falls, IA',
+             'Janesville-Beloit, WI',
+             'Tampa-St. Petersburg-Clearwater, FL']
+
+USER_AGENTS = [
+    '"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, '
+    'like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+    '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/36.0.1985.125 Safari/537.36"',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 '
+    'Firefox/31.0',
+    '"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) '
+    'AppleWebKit/537.51.2 (KHTML, like Gecko) Version/7.0 Mobile/11D257 '
+    'Safari/9537.53"',
+    'Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.1; WOW64; '
+    'Trident/6.0)',
+    '"Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like '
+    'Gecko) Ubuntu Chromium/36.0.1985.125 Chrome/36.0.1985.125 '
+    'Safari/537.36"']
+
+"""
+  Pages of a logged in session as (page, method, status, weight), the
+    weights follow the mix of the original Sparkify logs.
+"""
+
+PAGE_MIX = [('NextSong', 'PUT', 200, 800),
+            ('Home', 'GET', 200, 40),
+            ('Thumbs Up', 'PUT', 307, 45),
+            ('Add to Playlist', 'PUT', 200, 25),
+            ('Add Friend', 'PUT', 307, 15),
+            ('Roll Advert', 'GET', 200, 10),
+            ('Logout', 'PUT', 307, 12),
+            ('Thumbs Down', 'PUT', 307, 10),
+            ('Downgrade', 'GET', 200, 7),
+            ('Settings', 'GET', 200, 6),
+            ('Help', 'GET', 200, 5),
+            ('Upgrade', 'GET', 200, 2),
+            ('About', 'GET', 200, 2),
+            ('Save Settings', 'PUT', 307, 1),
+            ('Error', 'GET', 404, 1),
+            ('Submit Upgrade', 'PUT', 307, 1),
+            ('Submit Downgrade', 'PUT', 307, 1)]
+
+PAGE_CDF = np.cumsum([page[3] for page in PAGE_MIX]) \
+    / sum(page[3] for page in PAGE_MIX)
+
+MEAN_SESSION_EVENTS = 30
+SESSION_STOP = 1 / MEAN_SESSION_EVENTS \
+    - dict((page[0], page[3]) for page in PAGE_MIX)['Logout'] \
+    / sum(page[3] for page in PAGE_MIX)
+SESSION_RATE_MARGIN = 1.25
+OTHER_SONGS_PER_SONG = 4
+SONGS_PER_ARTIST = 3
+DRAW_BATCH = 65536
+SONG_CACHE_SIZE = 100000
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def song_record(seed, index):
+
+    """
+    Returns the song file record for catalog song 'index', with its
+      fields in the order of the Million Song Dataset files (which
+      extract_song_data reads by position).
+    """
+
+    song = random.Random(f'{seed}-song-{index}')
+    artist_index = song.randrange(max(index // SONGS_PER_ARTIST, 1))
+    artist = random.Random(f'{seed}-artist-{artist_index}')
+    located = artist.random() < 0.4
+    return {
+        'num_songs': 1,
+        'artist_id': f'AR{artist_index:016X}',
+        'artist_latitude': round(artist.uniform(-60, 70), 5)
+        if located else None,
+        'artist_longitude': round(artist.uniform(-180, 180), 5)
+        if located else None,
+        'artist_location': artist.choice(LOCATIONS) if located else '',
+        'artist_name': ' '.join(artist.sample(WORDS, 2)) + ' Band',
+        'song_id': f'SO{index:016X}',
+        'title': ' '.join(song.sample(WORDS, song.randint(1, 4))),
+        'duration': round(song.uniform(60, 600), 5),
+        'year': song.choice([0, song.randint(1955, 2018)])
+        }
+
+
+def other_song(seed, index):
+
+    """
+    Returns (title, artist name, length) for song 'index' of the songs
+      that are played but aren't in the catalog.
+    """
+
+    song = random.Random(f'{seed}-other-{index}')
+    return (' '.join(song.sample(WORDS, 3)) + f' {index}',
+            f'{song.choice(LAST_NAMES)} {song.choice(WORDS)} {index}',
+            round(song.uniform(60, 600), 5))
+
+
+def track_path(song_data, index):
+
+    """
+    Returns the path of the file for catalog song 'index', sharded by
+      the 3rd to 5th characters of its track ID like the originals.
+      Those characters are the index in base 26, lowest digit first,
+      so consecutive songs go to different directories.
+    """
+
+    track = 'TR' + ''.join(chr(ord('A') + index // 26 ** place % 26)
+                           for place in range(3)) + f'{index:013X}'
+    return os.path.join(song_data, track[2], track[3], track[4],
+                        f'{track}.json')
+
+
+def write_songs(song_data, songs, seed):
+
+    """
+    Writes the song files for catalog songs 0 to 'songs' - 1.
+
+    Returns: the number of artists they refer to
+    """
+
+    artists = set()
+    for index in range(songs):
+        record = song_record(seed, index)
+        artists.add(record['artist_id'])
+        path = track_path(song_data, index)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as song_file:
+            json.dump(record, song_file)
+    return len(artists)
+
+
+def draws(rng, draw):
+
+    """
+    Yields values from 'draw(rng, DRAW_BATCH)' one at a time, so
+      numpy makes the random draws in batches.
+    """
+
+    while True:
+        yield from draw(rng, DRAW_BATCH).tolist()
+
+
+def zipf_cdf(count, exponent):
+
+    """
+    Returns the cumulative distribution of Zipf ranks 1 to 'count'.
+    """
+
+    weights = np.arange(1, count + 1, dtype=np.float64) ** -exponent
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def make_users(rng, users, start_ms):
+
+    """
+    Returns the list of users, each a dictionary of the fields that
+      stay the same across their events plus their current level.
+    """
+
+    people = []
+    for user_id in range(1, users + 1):
+        person = random.Random(int(rng.integers(1 << 62)))
+        people.append({
+            'firstName': person.choice(FIRST_NAMES),
+            'gender': person.choice('FM'),
+            'lastName': person.choice(LAST_NAMES),
+            'level': 'paid' if person.random() < 0.2 else 'free',
+            'location': person.choice(LOCATIONS),
+            'registration': float(start_ms - person.randrange(
+                90 * DAY_MS)),
+            'userAgent': person.choice(USER_AGENTS),
+            'userId': str(user_id)
+            })
+    return people
+
+
+def session_events(user, session_id, start_ms, end_ms, pages, plays,
+                   stops):
+
+    """
+    Yields (ts, event) for one session of 'user' from 'start_ms', until
+      the user logs out, the session ends or the day does.
+
+    Parameters:
+
+     - user: the user dictionary, its level is changed by Submit
+         Upgrade and Submit Downgrade
+     - session_id: the sessionId of every event
+     - start_ms, end_ms: session start and end of the day, epoch ms
+     - pages: iterator of indexes into PAGE_MIX
+     - plays: iterator of (song, artist, length) for NextSong events
+     - stops: iterator of uniform values deciding when the session
+         ends
+
+    """
+
+    ts = start_ms
+    for item in itertools.count():
+        page, method, status, _ = PAGE_MIX[next(pages)]
+        if page == 'Roll Advert' and user['level'] == 'paid':
+            page, method, status, _ = PAGE_MIX[0]
+        song = artist = length = None
+        if page == 'NextSong':
+            song, artist, length = next(plays)
+        yield ts, {
+            'artist': artist,
+            'auth': 'Logged In',
+            'firstName': user['firstName'],
+            'gender': user['gender'],
+            'itemInSession': item,
+            'lastName': user['lastName'],
+            'length': length,
+            'level': user['level'],
+            'location': user['location'],
+            'method': method,
+            'page': page,
+            'registration': user['registration'],
+            'sessionId': session_id,
+            'song': song,
+            'status': status,
+            'ts': ts,
+            'userAgent': user['userAgent'],
+            'userId': user['userId']
+            }
+        if page == 'Submit Upgrade':
+            user['level'] = 'paid'
+        elif page == 'Submit Downgrade':
+            user['level'] = 'free'
+        ts += int(length * 1000) if length else 5000 + item % 7 * 1000
+        if page == 'Logout' or ts >= end_ms \
+                or next(stops) < SESSION_STOP:
+            return
+
+
+def write_day(log_file, day_ms, events, rng, users, plays, counters):
+
+    """
+    Writes one day of events to 'log_file' in time order.
+
+    Sessions start through the day as a Poisson process and run side
+      by side, so only the sessions in progress are held in memory.
+      They start SESSION_RATE_MARGIN times as often as 'events' needs,
+      to make up for sessions cut short at midnight, and the day stops
+      at exactly 'events' events.
+    """
+
+    pages = draws(rng, lambda rng, size: np.searchsorted(
+        PAGE_CDF, rng.random(size)))
+    stops = draws(rng, lambda rng, size: rng.random(size))
+    gaps = draws(rng, lambda rng, size: rng.exponential(
+        DAY_MS * MEAN_SESSION_EVENTS
+        / (max(events, 1) * SESSION_RATE_MARGIN), size))
+    who = draws(rng, lambda rng, size: rng.integers(len(users), size=size))
+
+    end_ms = day_ms + DAY_MS
+    next_start = day_ms + next(gaps)
+    running = []
+    written = 0
+    while written < events:
+        while next_start < end_ms and \
+                (not running or next_start <= running[0][0]):
+            counters['sessions'] += 1
+            session = session_events(users[next(who)],
+                                     counters['sessions'],
+                                     int(next_start), end_ms,
+                                     pages, plays, stops)
+            ts, event = next(session)
+            heapq.heappush(running, (ts, counters['sessions'], event,
+                                     session))
+            next_start += next(gaps)
+        if not running:
+            break
+        ts, session_id, event, session = heapq.heappop(running)
+        log_file.write(json.dumps(event) + '\n')
+        written += 1
+        if event['page'] == 'NextSong':
+            counters['next_songs'] += 1
+        following = next(session, None)
+        if following is not None:
+            heapq.heappush(running, (following[0], session_id,
+                                     following[1], session))
+    return written
+
+
+def generate_dataset(output, songs=1000, days=30, events_per_day=10000,
+                     users=1000, match_fraction=0.3, zipf_exponent=1.1,
+                     start_date='2018-11-01', seed=0):
+
+    """
+    Writes a dataset to output/data/song_data and output/data/log_data.
+
+    Parameters:
+
+     - output: directory to write the data directory into
+     - songs: number of song files
+     - days: number of days of log files
+     - events_per_day: events in each log file
+     - users: number of users
+     - match_fraction: share of NextSong events playing catalog songs
+     - zipf_exponent: exponent of the song popularity distribution
+     - start_date: date of the first log file, yyyy-mm-dd
+     - seed: seed for every random choice
+
+    Returns: a dictionary of counts describing the dataset
+
+    """
+
+    rng = np.random.default_rng(seed)
+    song_data = os.path.join(output, 'data', 'song_data')
+    log_data = os.path.join(output, 'data', 'log_data')
+    counters = {'songs': songs, 'artists': 0, 'events': 0,
+                'next_songs': 0, 'matching': 0, 'sessions': 0}
+    counters['artists'] = write_songs(song_data, songs, seed)
+
+    catalog_song = functools.lru_cache(maxsize=SONG_CACHE_SIZE)(
+        lambda index: song_record(seed, index))
+    other_song_cached = functools.lru_cache(maxsize=SONG_CACHE_SIZE)(
+        lambda index: other_song(seed, index))
+    popularity = rng.permutation(max(songs, 1))
+    cdf = zipf_cdf(max(songs, 1), zipf_exponent)
+    ranks = draws(rng, lambda rng, size: np.searchsorted(
+        cdf, rng.random(size)))
+    other_cdf = zipf_cdf(max(songs, 1) * OTHER_SONGS_PER_SONG,
+                         zipf_exponent)
+    other_ranks = draws(rng, lambda rng, size: np.searchsorted(
+        other_cdf, rng.random(size)))
+    matches = draws(rng, lambda rng, size: rng.random(size))
+
+    def plays():
+        for match in matches:
+            if songs and match < match_fraction:
+                counters['matching'] += 1
+                record = catalog_song(int(popularity[next(ranks)]))
+                yield (record['title'], record['artist_name'],
+                       record['duration'])
+            else:
+                yield other_song_cached(next(other_ranks))
+
+    start = datetime.datetime.strptime(start_date, '%Y-%m-%d')
+    start = start.replace(tzinfo=datetime.timezone.utc)
+    people = make_users(rng, users, int(start.timestamp() * 1000))
+    played = plays()
+    for day in range(days):
+        date = start + datetime.timedelta(days=day)
+        directory = os.path.join(log_data, f'{date:%Y}', f'{date:%m}')
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{date:%Y-%m-%d}-events.json')
+        with open(path, 'w') as log_file:
+            counters['events'] += write_day(
+                log_file, int(date.timestamp() * 1000), events_per_day,
+                rng, people, played, counters)
+    return counters
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--output', default='.',
+                        help='directory to write the data directory into')
+    parser.add_argument('--songs', type=int, default=1000,
+                        help='number of song files')
+    parser.add_argument('--days', type=int, default=30,
+                        help='number of days of log files')
+    parser.add_argument('--events-per-day', type=int, default=10000,
+                        help='events in each log file')
+    parser.add_argument('--users', type=int, default=1000,
+                        help='number of users')
+    parser.add_argument('--match-fraction', type=float, default=0.3,
+                        help='share of NextSong events that play a song '
+                             'in the catalog')
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help='exponent of the song popularity '
+                             'distribution')
+    parser.add_argument('--start-date', default='2018-11-01',
+                        help='date of the first log file, yyyy-mm-dd')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed, the same seed gives the same '
+                             'files')
+    options = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    counters = generate_dataset(
+        options.output, songs=options.songs, days=options.days,
+        events_per_day=options.events_per_day, users=options.users,
+        match_fraction=options.match_fraction,
+        zipf_exponent=options.zipf, start_date=options.start_date,
+        seed=options.seed)
+    seconds = time.perf_counter() - start
+    print(f'{counters["songs"]} songs by {counters["artists"]} artists, '
+          f'{counters["events"]} events in {counters["sessions"]} '
+          f'sessions, {counters["next_songs"]} NextSong of which '
+          f'{counters["matching"]} in the catalog, '
+          f'written in {seconds:.1f}s '
+          f'({counters["events"] / max(seconds, 1e-9):,.0f} events/sec)')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+"""
+Ingestion Benchmark
+===================
+
+  Runs create_tables.py and then etl.py over generated datasets of
+    increasing size (see generate_data.py), and records for each size
+    the total time, peak RSS and the throughput of each etl.py stage
+    (from the run statistics it writes) in a results file.
+
+  Every result is tagged with the git commit it was measured at, and
+    is compared with the latest result for the same size and etl.py
+    options from another commit (or from --baseline). A drop in the
+    rows/sec of song loading ('songs'), time-dimension building
+    ('time') or songplay resolution ('songplays') of more than
+    --threshold percent is reported as a regression and the command
+    exits with status 1.
+
+  NOTE: with --workers, etl.py adds up the seconds of the 'time',
+    'users' and 'songplays' stages across its worker processes, so
+    their rows/sec is the throughput of one worker (the 'processes'
+    figure of each stage says how many). Results are only compared
+    with results for the same etl.py options, so this doesn't mix
+    the two.
+
+  With --pg-bin the runs use a throwaway PostgreSQL cluster, created
+    with initdb in a temporary directory, started on --port and
+    removed afterwards (initdb won't run as root). Without it they use
+    the server etl.py normally connects to.
+
+  WARNING: without --pg-bin this drops and recreates the sparkify
+    database for each size.
+
+  Run from the repository root with, for example:
+
+      python -m benchmarks.ingestion --sizes small medium \\
+          --pg-bin /usr/lib/postgresql/16/bin -- --songplay-loader staged
+
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import psycopg2
+
+from benchmarks import generate_data
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SIZES = {
+    'tiny': dict(songs=200, days=1, events_per_day=2000, users=50),
+    'small': dict(songs=1000, days=2, events_per_day=10000, users=200),
+    'medium': dict(songs=10000, days=7, events_per_day=50000, users=1000),
+    'large': dict(songs=50000, days=14, events_per_day=200000,
+                  users=5000)
+    }
+
+"""
+  The stages guarded against regressions, with their description.
+"""
+
+GUARDED_STAGES = {'songs': 'song loading',
+                  'time': 'time-dimension building',
+                  'songplays': 'songplay resolution'}
+
+RESULTS_FILE = 'benchmark_results.jsonl'
+
+
+def git_commit():
+
+    """
+    Returns the short hash of HEAD, with '-dirty' added when the
+      working tree has uncommitted changes.
+    """
+
+    def git(*arguments):
+        return subprocess.run(['git'] + list(arguments), cwd=REPOSITORY,
+                              capture_output=True, text=True).stdout.strip()
+
+    commit = git('rev-parse', '--short', 'HEAD') or 'unknown'
+    if git('status', '--porcelain', '--untracked-files=no'):
+        commit += '-dirty'
+    return commit
+
+
+def prepare_dataset(work_dir, size, seed):
+
+    """
+    Generates the dataset for 'size' under 'work_dir', unless a
+      previous run already has, and returns its directory.
+    """
+
+    data_root = os.path.join(work_dir, f'{size}-seed{seed}')
+    complete = os.path.join(data_root, '.complete')
+    if not os.path.exists(complete):
+        shutil.rmtree(data_root, ignore_errors=True)
+        generate_data.generate_dataset(data_root, seed=seed, **SIZES[size])
+        open(complete, 'w').close()
+    return data_root
+
+
+@contextlib.contextmanager
+def throwaway_cluster(pg_bin, port):
+
+    """
+    Creates and starts a PostgreSQL cluster in a temporary directory
+      with the student user and studentdb database the scripts expect,
+      and stops and removes it again on exit.
+
+    Parameters:
+
+     - pg_bin: directory holding initdb and pg_ctl
+     - port: port for the cluster to listen on, the scripts are
+         pointed at it through PGPORT
+
+    Returns: a context manager
+
+    """
+
+    cluster = tempfile.mkdtemp(prefix='sparkify-benchmark-')
+    data = os.path.join(cluster, 'data')
+    subprocess.run([os.path.join(pg_bin, 'initdb'), '-D', data,
+                    '-U', 'student', '--auth=trust'],
+                   stdout=subprocess.DEVNULL, check=True)
+    subprocess.run([os.path.join(pg_bin, 'pg_ctl'), '-D', data, '-w',
+                    '-l', os.path.join(cluster, 'server.log'),
+                    '-o', f'-p {port} -k {cluster} '
+                          f'-c listen_addresses=127.0.0.1',
+                    'start'],
+                   stdout=subprocess.DEVNULL, check=True)
+    try:
+        connection = psycopg2.connect(host='127.0.0.1', port=port,
+                                      dbname='postgres', user='student')
+        connection.set_session(autocommit=True)
+        connection.cursor().execute('CREATE DATABASE studentdb')
+        connection.close()
+        yield
+    finally:
+        subprocess.run([os.path.join(pg_bin, 'pg_ctl'), '-D', data, '-w',
+                        '-m', 'fast', 'stop'],
+                       stdout=subprocess.DEVNULL)
+        shutil.rmtree(cluster, ignore_errors=True)
+
+
+def run_script(script, arguments, data_root, environment):
+
+    """
+    Runs one of the repository's scripts with 'data_root' as the
+      working directory.
+
+    Returns: (elapsed seconds, peak RSS in kB of the script and the
+      worker processes it waited for)
+    """
+
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(REPOSITORY, script)] + arguments,
+        cwd=data_root,
+        env=environment,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+        )
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    seconds = time.perf_counter() - start
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, script)
+    return seconds, usage.ru_maxrss
+
+
+def benchmark_size(size, data_root, etl_arguments, environment):
+
+    """
+    Rebuilds the database and loads the dataset at 'data_root' once.
+
+    Returns: the result record for the run, without commit or time
+    """
+
+    create_seconds, create_rss = run_script('create_tables.py', [],
+                                            data_root, environment)
+    with tempfile.TemporaryDirectory() as stats_dir:
+        etl_seconds, etl_rss = run_script(
+            'etl.py', list(etl_arguments) + ['--stats-dir', stats_dir],
+            data_root, environment)
+        with open(os.path.join(stats_dir, 'etl_stats.json')) as stats:
+            stats = json.load(stats)
+    return {
+        'size': size,
+        'dataset': SIZES[size],
+        'etl_arguments': list(etl_arguments),
+        'total_seconds': create_seconds + etl_seconds,
+        'etl_seconds': etl_seconds,
+        'peak_rss_kb': max(create_rss, etl_rss,
+                           stats['peaks'].get('peak_rss_kb', 0)),
+        'handled_errors': stats['counters'].get('handled_errors', 0),
+        'stages': {name: {figure: figures[figure]
+                          for figure in ('seconds', 'rows_in', 'rows_out',
+                                         'rows_per_sec', 'peak_rss_kb',
+                                         'processes')}
+                   for name, figures in stats['stages'].items()}
+        }
+
+
+def best_of(results):
+
+    """
+    Combines repeated results for the same size, keeping the best
+      time and throughput of each stage and the lowest peak RSS.
+    """
+
+    best = dict(results[0])
+    best['repeats'] = len(results)
+    for figure in ('total_seconds', 'etl_seconds', 'peak_rss_kb'):
+        best[figure] = min(result[figure] for result in results)
+    best['stages'] = {}
+    for name in results[0]['stages']:
+        stages = [result['stages'][name] for result in results]
+        best['stages'][name] = max(stages,
+                                   key=lambda stage: stage['rows_per_sec'])
+    return best
+
+
+def load_results(results_file):
+
+    """
+    Returns the records in the results file, oldest first.
+    """
+
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file) as results:
+        return [json.loads(line) for line in results if line.strip()]
+
+
+def find_baseline(previous, record, baseline_commit):
+
+    """
+    Returns the latest previous record for the same size and etl.py
+      options, from 'baseline_commit' if given, otherwise from any
+      other commit ... or None.
+    """
+
+    for candidate in reversed(previous):
+        if candidate['size'] != record['size'] \
+                or candidate['etl_arguments'] != record['etl_arguments']:
+            continue
+        if baseline_commit is not None:
+            if candidate['commit'].startswith(baseline_commit):
+                return candidate
+        elif candidate['commit'] != record['commit']:
+            return candidate
+    return None
+
+
+def regressions(baseline, record, threshold):
+
+    """
+    Returns a line describing each guarded stage whose rows/sec fell
+      by more than 'threshold' percent from 'baseline' to 'record'.
+    """
+
+    found = []
+    for name, description in GUARDED_STAGES.items():
+        before = baseline['stages'].get(name, {}).get('rows_per_sec')
+        after = record['stages'].get(name, {}).get('rows_per_sec')
+        if not before or after is None:
+            continue
+        change = (after - before) / before * 100
+        if change < -threshold:
+            found.append(
+                f'REGRESSION {record["size"]}: {description} ({name}) '
+                f'{before:,.0f} -> {after:,.0f} rows/sec ({change:+.1f}%) '
+                f'since {baseline["commit"]}')
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', nargs='+', default=['tiny', 'small'],
+                        choices=list(SIZES),
+                        help='dataset sizes to run, in order')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the generated datasets')
+    parser.add_argument('--work-dir',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'sparkify-benchmark-data'),
+                        help='where generated datasets are kept between '
+                             'runs')
+    parser.add_argument('--results', default=RESULTS_FILE,
+                        help='results file, one JSON record per line')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs per size, the best is recorded')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percentage drop in rows/sec reported as a '
+                             'regression')
+    parser.add_argument('--baseline',
+                        help='commit to compare with, by default the '
+                             'latest result from another commit')
+    parser.add_argument('--pg-bin',
+                        help='directory of initdb and pg_ctl, to run '
+                             'against a throwaway cluster')
+    parser.add_argument('--port', type=int, default=54329,
+                        help='port for the throwaway cluster')
+    parser.add_argument('etl_arguments', nargs='*',
+                        help='extra etl.py options, after --')
+    options = parser.parse_args(argv)
+
+    environment = dict(os.environ, PYTHONPATH=REPOSITORY)
+    cluster = contextlib.nullcontext()
+    if options.pg_bin:
+        environment['PGPORT'] = str(options.port)
+        cluster = throwaway_cluster(options.pg_bin, options.port)
+
+    commit = git_commit()
+    previous = load_results(options.results)
+    found = []
+    print(f'{"size":>8} {"events":>10} {"total s":>9} {"peak MB":>8} '
+          + ' '.join(f'{name + " r/s":>14}' for name in GUARDED_STAGES))
+    with cluster:
+        for size in options.sizes:
+            data_root = prepare_dataset(options.work_dir, size,
+                                        options.seed)
+            record = best_of([benchmark_size(size, data_root,
+                                             options.etl_arguments,
+                                             environment)
+                              for _ in range(options.repeat)])
+            record['commit'] = commit
+            record['recorded'] = datetime.datetime.now(
+                datetime.timezone.utc).isoformat(timespec='seconds')
+            with open(options.results, 'a') as results:
+                results.write(json.dumps(record) + '\n')
+            dataset = SIZES[size]
+            rates = [record['stages'].get(name, {}).get('rows_per_sec', 0)
+                     for name in GUARDED_STAGES]
+            print(f'{size:>8} '
+                  f'{dataset["days"] * dataset["events_per_day"]:>10} '
+                  f'{record["total_seconds"]:>9.2f} '
+                  f'{record["peak_rss_kb"] / 1024:>8.1f} '
+                  + ' '.join(f'{rate:>14,.0f}' for rate in rates))
+            baseline = find_baseline(previous, record, options.baseline)
+            if baseline is not None:
+                found += regressions(baseline, record, options.threshold)
+
+    for line in found:
+        print(line)
+    if found:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Latency-bound Backend Benchmark
+===============================
+
+  Compares the psycopg2 backend of etl.py with the psycopg 3
+    pipeline backend (pg_pipeline.py, --backend pipeline) on a
+    connection with artificial network latency, the case where the
+    per-row statements wait a full round trip each.
+
+  Connections go through a TCP proxy started here, which holds every
+    chunk of data for --delay-ms milliseconds in each direction
+    before passing it on, so a round trip costs twice that. Two
+    workloads are timed with each backend:
+
+   - song_select: etl.select_song_ids for --lookups NextSong rows,
+       half of them songs in the catalog
+   - time inserts: etl.insert_batch of --lookups time records in
+       pages of --page-size, rolled back afterwards
+
+  The sparkify database must exist with songs loaded, for example by
+    running create_tables.py and etl.py first. Run from the
+    repository root with:
+
+      python -m benchmarks.latency --delay-ms 1 --lookups 2000
+
+"""
+
+import argparse
+import asyncio
+import contextlib
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+import connection_pool
+import etl
+import pg_pipeline
+
+"""
+  Bytes read from a socket at a time by the proxy.
+"""
+
+PROXY_CHUNK = 65536
+
+
+async def delayed_pipe(reader, writer, delay):
+
+    """
+    Copies 'reader' to 'writer', each chunk 'delay' seconds after it
+      arrived. Chunks are queued rather than slept on in turn, so
+      data sent back to back is delayed once, not once per chunk, as
+      on a real network.
+    """
+
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+
+    async def send():
+        while True:
+            due, data = await chunks.get()
+            if data is None:
+                break
+            await asyncio.sleep(max(due - loop.time(), 0))
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    sender = asyncio.create_task(send())
+    try:
+        while True:
+            data = await reader.read(PROXY_CHUNK)
+            if not data:
+                break
+            chunks.put_nowait((loop.time() + delay, data))
+    except ConnectionError:
+        pass
+    chunks.put_nowait((0, None))
+    await sender
+
+
+@contextlib.contextmanager
+def latency_proxy(host, port, delay):
+
+    """
+    Runs a TCP proxy to host:port in a background thread, adding
+      'delay' seconds to each direction of every connection.
+
+    Returns: a context manager giving the port the proxy listens on
+      at 127.0.0.1
+    """
+
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    listening = {}
+
+    async def handle(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection(
+            host, port)
+        try:
+            await asyncio.gather(
+                delayed_pipe(client_reader, server_writer, delay),
+                delayed_pipe(server_reader, client_writer, delay))
+        except asyncio.CancelledError:
+            client_writer.close()
+            server_writer.close()
+
+    async def serve():
+        listening['stop'] = asyncio.Event()
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        listening['port'] = server.sockets[0].getsockname()[1]
+        started.set()
+        async with server:
+            await listening['stop'].wait()
+        handlers = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+    thread = threading.Thread(target=loop.run_until_complete,
+                              args=(serve(),), daemon=True)
+    thread.start()
+    started.wait()
+    try:
+        yield listening['port']
+    finally:
+        loop.call_soon_threadsafe(listening['stop'].set)
+        thread.join()
+        loop.close()
+
+
+def make_next_song_rows(cursor, lookups, seed):
+
+    """
+    A NextSong dataframe of 'lookups' rows, half of them playing
+      songs from the songs table and half songs that aren't in it.
+    """
+
+    cursor.execute('SELECT title, name, duration FROM songs '
+                   'JOIN artists ON songs.artist_id = artists.artist_id')
+    catalog = [(title, name, float(duration))
+               for title, name, duration in cursor.fetchall()]
+    if not catalog:
+        raise SystemExit('the songs table is empty, run etl.py first')
+    rng = np.random.default_rng(seed)
+    rows = []
+    for index in range(lookups):
+        if index % 2:
+            rows.append(catalog[rng.integers(len(catalog))])
+        else:
+            rows.append((f'Not a song {index}', 'Nobody', 100.0 + index))
+    return pd.DataFrame(rows, columns=['song', 'artist', 'length'])
+
+
+def make_time_records(records, seed):
+
+    """
+    A list of 'records' distinct time table records.
+    """
+
+    rng = np.random.default_rng(seed)
+    ts = np.unique(1541030400000 + rng.integers(0, 10 ** 12, records * 2))
+    dataframe = etl.add_time_keys(pd.DataFrame({'ts': ts[:records]}))
+    return etl.dataframe_records(etl.build_time_dataframe(dataframe))
+
+
+def time_workloads(connection, next_song_rows, time_records):
+
+    """
+    Times each workload on 'connection', leaving the database as it
+      was.
+
+    Returns: dictionary of workload -> seconds
+    """
+
+    cursor = connection.cursor()
+    timings = {}
+    start = time.perf_counter()
+    resolved_ids = etl.select_song_ids(cursor, next_song_rows)
+    timings['song_select'] = time.perf_counter() - start
+    connection.rollback()
+    assert sum(1 for ids in resolved_ids if ids) >= len(resolved_ids) // 2
+
+    cursor.execute('DELETE FROM time')
+    start = time.perf_counter()
+    etl.insert_batch(cursor, etl.time_table_batch_insert, time_records)
+    timings['time inserts'] = time.perf_counter() - start
+    connection.rollback()
+    cursor.close()
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--delay-ms', type=float, default=1.0,
+                        help='latency added to each direction, in ms')
+    parser.add_argument('--lookups', type=int, default=2000,
+                        help='NextSong rows looked up and time records '
+                             'inserted')
+    parser.add_argument('--page-size', type=int, default=100,
+                        help='time records per INSERT statement')
+    parser.add_argument('--host',
+                        help='host of the PostgreSQL server, by default '
+                             'the one in the connection settings')
+    parser.add_argument('--port', type=int,
+                        help='port of the PostgreSQL server, by default '
+                             'the one in the connection settings')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args(argv)
+    database = connection_pool.get_settings()['database']
+    options.host = options.host or database['host']
+    options.port = options.port or int(database['port']
+                                       or os.environ.get('PGPORT', 5432))
+
+    backends = {'psycopg2': psycopg2.connect}
+    if pg_pipeline.available():
+        backends['pipeline'] = pg_pipeline.connect
+    else:
+        print('psycopg 3 is not installed, timing psycopg2 only')
+
+    etl.insert_page_size = options.page_size
+    direct = psycopg2.connect(connection_pool.dsn(), host=options.host,
+                              port=options.port)
+    next_song_rows = make_next_song_rows(direct.cursor(), options.lookups,
+                                         options.seed)
+    direct.close()
+    time_records = make_time_records(options.lookups, options.seed)
+
+    results = {}
+    with latency_proxy(options.host, options.port,
+                       options.delay_ms / 1000) as proxy_port:
+        for backend, connect in backends.items():
+            connection = connect(connection_pool.dsn(), host='127.0.0.1',
+                                 port=proxy_port)
+            connection.set_session(autocommit=False)
+            results[backend] = time_workloads(connection, next_song_rows,
+                                              time_records)
+            connection.close()
+
+    print(f'{options.delay_ms:g} ms each way, {options.lookups} rows')
+    print(f'{"workload":<14} {"backend":<10} {"seconds":>9} '
+          f'{"rows/sec":>11} {"speedup":>8}')
+    for workload in ('song_select', 'time inserts'):
+        baseline = results['psycopg2'][workload]
+        for backend, timings in results.items():
+            seconds = timings[workload]
+            print(f'{workload:<14} {backend:<10} {seconds:>9.3f} '
+                  f'{options.lookups / seconds:>11,.0f} '
+                  f'{baseline / seconds:>7.1f}x')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Song Lookup Benchmark
+=====================
+
+  Times song_select, the per-row lookup of a NextSong event's song
+    and artist, against a large songs catalog with and without the
+    song_select indexes of sql_queries.py (song_select_index_queries).
+
+  The catalog is generated in the database itself, with
+    generate_series, in a scratch schema of the sparkify database
+    that is dropped again at the end: --songs songs by --songs / 4
+    artists, in tables made with the statements create_tables.py
+    uses. The lookups are a mix of songs in the catalog and songs
+    that aren't, as in the log files, and are timed one statement at
+    a time as etl.py's --song-lookup query mode runs them.
+
+  Without the indexes every lookup scans the songs table, so far
+    fewer of them (--scan-lookups) are timed in that case.
+
+  The sparkify database must exist, for example after running
+    create_tables.py. Run from the repository root with:
+
+      python -m benchmarks.song_lookup --songs 1000000
+
+"""
+
+import argparse
+import statistics
+import time
+
+import numpy as np
+
+import connection_pool
+from sql_queries import (song_table_create, artist_table_create,
+                         song_select, song_select_index_queries)
+
+SCHEMA = 'song_lookup_benchmark'
+
+"""
+  The catalog, built with generate_series. Song i is by artist
+    i % artists and its duration is a deterministic value with the
+    five decimal places of songs.duration.
+"""
+
+artist_generate = ("INSERT INTO artists (artist_id, name)"
+                   " SELECT 'AR' || lpad(i::text, 16, '0'),"
+                   " 'Artist ' || md5(i::text)"
+                   " FROM generate_series(0, %(artists)s - 1) AS i")
+
+song_generate = ("INSERT INTO songs"
+                 " (song_id, title, artist_id, year, duration)"
+                 " SELECT 'SO' || lpad(i::text, 16, '0'),"
+                 " 'Song ' || md5(i::text),"
+                 " 'AR' || lpad((i %% %(artists)s)::text, 16, '0'),"
+                 " 1950 + i %% 70,"
+                 " round((60 + (i::bigint * 7919 %% 30000000)"
+                 " / 100000.0)::numeric, 5)"
+                 " FROM generate_series(0, %(songs)s - 1) AS i")
+
+catalog_sample = ('SELECT title, name, duration FROM songs'
+                  ' JOIN artists ON songs.artist_id = artists.artist_id'
+                  ' WHERE song_id = ANY(%s)')
+
+
+def build_catalog(cursor, songs):
+
+    """
+    Creates the scratch schema and fills its songs and artists
+      tables, with no indexes beyond the primary keys.
+
+    Returns: seconds taken
+    """
+
+    start = time.perf_counter()
+    cursor.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+    cursor.execute(f'CREATE SCHEMA {SCHEMA}')
+    cursor.execute(f'SET search_path TO {SCHEMA}')
+    cursor.execute(song_table_create)
+    cursor.execute(artist_table_create)
+    parameters = {'songs': songs, 'artists': max(songs // 4, 1)}
+    cursor.execute(artist_generate, parameters)
+    cursor.execute(song_generate, parameters)
+    cursor.execute('ANALYZE songs')
+    cursor.execute('ANALYZE artists')
+    return time.perf_counter() - start
+
+
+def make_lookups(cursor, songs, lookups, seed):
+
+    """
+    Returns 'lookups' song_select parameter tuples, half of them
+      songs in the catalog and half songs that aren't in it.
+    """
+
+    rng = np.random.default_rng(seed)
+    song_ids = [f'SO{index:016d}'
+                for index in rng.integers(0, songs, lookups // 2 + 1)]
+    cursor.execute(catalog_sample, (song_ids,))
+    found = [(title, name, float(duration))
+             for title, name, duration in cursor.fetchall()]
+    rows = []
+    for index in range(lookups):
+        if index % 2:
+            rows.append(found[rng.integers(len(found))])
+        else:
+            rows.append((f'Not a song {index}', 'Nobody', 100.0 + index))
+    return rows
+
+
+def time_lookups(cursor, lookups):
+
+    """
+    Runs song_select for each of 'lookups'.
+
+    Returns: (list of seconds per lookup, number of songs found)
+    """
+
+    seconds = []
+    finds = 0
+    for values in lookups:
+        start = time.perf_counter()
+        cursor.execute(song_select, values)
+        row = cursor.fetchone()
+        seconds.append(time.perf_counter() - start)
+        finds += row is not None
+    return seconds, finds
+
+
+def describe(label, seconds, finds):
+
+    """
+    Returns a line summarising the per-lookup timings.
+    """
+
+    ms = sorted(value * 1000 for value in seconds)
+    p95 = ms[min(int(len(ms) * 0.95), len(ms) - 1)]
+    return (f'{label:<12} {len(ms):>8} {finds:>6} '
+            f'{statistics.mean(ms):>10.3f} {statistics.median(ms):>10.3f} '
+            f'{p95:>10.3f}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--songs', type=int, default=1000000,
+                        help='songs in the generated catalog')
+    parser.add_argument('--lookups', type=int, default=10000,
+                        help='lookups timed with the indexes')
+    parser.add_argument('--scan-lookups', type=int, default=50,
+                        help='lookups timed without the indexes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true',
+                        help="don't drop the scratch schema afterwards")
+    options = parser.parse_args(argv)
+
+    connection = connection_pool.getconn()
+    connection.set_session(autocommit=True)
+    cursor = connection.cursor()
+    try:
+        seconds = build_catalog(cursor, options.songs)
+        print(f'{options.songs:,} songs generated in {seconds:.1f} s')
+        lookups = make_lookups(cursor, options.songs,
+                               max(options.lookups, options.scan_lookups),
+                               options.seed)
+
+        print(f'{"indexes":<12} {"lookups":>8} {"found":>6} '
+              f'{"mean ms":>10} {"median ms":>10} {"p95 ms":>10}')
+        before, finds = time_lookups(cursor,
+                                     lookups[:options.scan_lookups])
+        print(describe('none', before, finds))
+
+        start = time.perf_counter()
+        for query in song_select_index_queries:
+            cursor.execute(query)
+        cursor.execute('ANALYZE songs')
+        cursor.execute('ANALYZE artists')
+        build = time.perf_counter() - start
+        after, finds = time_lookups(cursor, lookups[:options.lookups])
+        print(describe('song_select', after, finds))
+
+        print(f'indexes built in {build:.1f} s, '
+              f'{statistics.mean(before) / statistics.mean(after):,.0f}x '
+              f'faster per lookup')
+    finally:
+        if not options.keep:
+            cursor.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        cursor.execute('RESET search_path')
+        cursor.close()
+        connection_pool.putconn(connection)
+
+
+if __name__ == "__main__":
+    main()
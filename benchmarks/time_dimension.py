@@ -0,0 +1,141 @@
+"""
+Time Dimension Benchmark
+========================
+
+  Compares the original row-by-row construction of the time table
+    records (iterrows, a pd.to_datetime call per row and a dictionary
+    per event) with etl.build_time_dataframe, which works on the whole
+    'ts' column at once.
+
+  No database is needed, only the transform is timed. Run from the
+    repository root with:
+
+      python -m benchmarks.time_dimension --events 2000000
+
+  The row-by-row version takes minutes at that size, so by default it
+    is timed on a sample of --baseline-events rows and its rate is
+    used for the comparison.
+
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import etl
+
+
+def build_time_dataframe_iterrows(dataframe):
+
+    """
+    The time table construction as it was in process_log_file before
+      build_time_dataframe: a dictionary per row, then one dataframe
+      from the list of dictionaries.
+
+    Parameters:
+
+     - dataframe: dataframe with a 'ts' column in milliseconds
+
+    Returns: a dataframe with the time table columns
+
+    """
+
+    timedata_list = list()
+    for index, row in dataframe.iterrows():
+        as_datetime = pd.to_datetime(row["ts"], unit="ms")
+        time_dict = dict()
+        time_dict["time_key"] = row["ts"]
+        time_dict["start_time"] = as_datetime
+        time_dict["hour"] = as_datetime.hour
+        time_dict["day"] = as_datetime.day
+        time_dict["week"] = as_datetime.week
+        time_dict["month"] = as_datetime.month
+        time_dict["year"] = as_datetime.year
+        time_dict["weekday"] = as_datetime.day_name()
+        timedata_list.append(time_dict)
+    return pd.DataFrame.from_records(timedata_list)
+
+
+def build_time_dataframe_vectorized(dataframe):
+
+    """
+    etl.build_time_dataframe on a dataframe with only 'ts', after the
+      time_key and start_time columns it works from are added.
+    """
+
+    return etl.build_time_dataframe(etl.add_time_keys(dataframe))
+
+
+def make_events(events, seed):
+
+    """
+    A log-file-like dataframe of 'events' rows over roughly one month
+      of November 2018, with some repeated timestamps.
+
+    Parameters:
+
+     - events: number of rows
+     - seed: random seed
+
+    Returns: a dataframe with 'ts' and 'page' columns
+
+    """
+
+    rng = np.random.default_rng(seed)
+    first_ts = 1541030400000        # 2018-11-01 00:00:00 UTC in ms
+    ts = first_ts + np.sort(rng.integers(0, 30 * 86400 * 1000, events))
+    return pd.DataFrame({'ts': ts, 'page': 'NextSong'})
+
+
+def time_it(function, dataframe):
+
+    """
+    Returns (seconds, result) for one call of function(dataframe).
+    """
+
+    start = time.perf_counter()
+    result = function(dataframe)
+    return time.perf_counter() - start, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--events', type=int, default=2000000)
+    parser.add_argument('--baseline-events', type=int, default=50000,
+                        help='rows to time the iterrows version on, '
+                             '0 times it on all of --events')
+    parser.add_argument('--seed', type=int, default=42)
+    options = parser.parse_args(argv)
+
+    dataframe = make_events(options.events, options.seed)
+    sample_size = options.baseline_events or options.events
+    sample = dataframe.head(sample_size)
+
+    """
+      Check both versions agree on the sample before timing.
+    """
+    expected = build_time_dataframe_iterrows(sample.head(1000))
+    expected = expected.drop_duplicates(subset=['time_key'])
+    actual = build_time_dataframe_vectorized(sample.head(1000))
+    assert (expected.astype(str).values == actual.astype(str).values).all()
+
+    baseline_seconds, _ = time_it(build_time_dataframe_iterrows, sample)
+    vector_seconds, result = time_it(build_time_dataframe_vectorized,
+                                     dataframe)
+
+    baseline_rate = len(sample.index) / baseline_seconds
+    vector_rate = options.events / vector_seconds
+    print(
+        f'iterrows:   {len(sample.index):>10} events in '
+        f'{baseline_seconds:8.3f}s  {baseline_rate:>12,.0f} events/sec\n'
+        f'vectorized: {options.events:>10} events in '
+        f'{vector_seconds:8.3f}s  {vector_rate:>12,.0f} events/sec '
+        f'({len(result.index)} distinct start_times)\n'
+        f'speedup:    {vector_rate / baseline_rate:,.0f}x'
+        )
+
+
+if __name__ == "__main__":
+    main()
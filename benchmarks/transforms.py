@@ -0,0 +1,275 @@
+"""
+Transform Microbenchmarks
+=========================
+
+  Times each transform step of etl.py on its own, with no database:
+    reading and parsing the files, the pandas work that builds the
+    time, user and songplay records, and the whole per-file functions
+    run against the in-memory cursor in fake_cursor.py, which formats
+    every statement as psycopg2 would but doesn't send it.
+
+  Every step is timed on a generated dataset (see generate_data.py)
+    of --records log events and --songs song files, best of --repeat,
+    and reported as seconds per 100k records, so a change to any one
+    step can be measured in isolation and in seconds rather than
+    minutes.
+
+  Results are appended to a results file tagged with the git commit,
+    and compared with the latest result for the same dataset from
+    another commit (or from --baseline). A step that got slower by
+    more than --threshold percent is reported as a regression and
+    the command exits with status 1.
+
+  Run from the repository root with:
+
+      python -m benchmarks.transforms --records 100000
+
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import etl
+from benchmarks import generate_data
+from benchmarks.fake_cursor import FakeCursor
+from benchmarks.ingestion import git_commit, load_results
+
+RESULTS_FILE = 'transform_results.jsonl'
+
+"""
+  Timings are reported per PER_RECORDS records.
+"""
+
+PER_RECORDS = 100000
+
+
+def prepare_dataset(work_dir, records, songs, seed):
+
+    """
+    Generates a dataset of one log file of 'records' events and
+      'songs' song files under 'work_dir', unless a previous run
+      already has.
+
+    Returns: (log file path, list of song file paths)
+    """
+
+    data_root = os.path.join(work_dir,
+                             f'transforms-{records}-{songs}-seed{seed}')
+    complete = os.path.join(data_root, '.complete')
+    if not os.path.exists(complete):
+        shutil.rmtree(data_root, ignore_errors=True)
+        generate_data.generate_dataset(data_root, songs=songs, days=1,
+                                       events_per_day=records,
+                                       users=max(records // 100, 1),
+                                       seed=seed)
+        open(complete, 'w').close()
+    data = os.path.join(data_root, 'data')
+    log_files = sorted(glob.glob(os.path.join(data, 'log_data', '**',
+                                              '*.json'), recursive=True))
+    song_files = sorted(glob.glob(os.path.join(data, 'song_data', '**',
+                                               '*.json'), recursive=True))
+    return log_files[0], song_files
+
+
+def with_songplay_loader(loader, function):
+
+    """
+    Returns a function that calls 'function' with etl.songplay_loader
+      set to 'loader'.
+    """
+
+    def run():
+        saved, etl.songplay_loader = etl.songplay_loader, loader
+        try:
+            return function()
+        finally:
+            etl.songplay_loader = saved
+    return run
+
+
+def build_cases(log_file, song_files):
+
+    """
+    Prepares the inputs of each step from the dataset.
+
+    Returns: a list of (name, records, function) tuples, 'records'
+      being the number of input records function() processes
+    """
+
+    dataframe = next(etl.read_log_file(log_file))
+    keyed = etl.add_time_keys(dataframe)
+    next_song_rows = etl.select_next_song_rows(keyed)
+    time_dataframe = etl.build_time_dataframe(keyed)
+    resolved_ids = [None] * len(next_song_rows.index)
+    events = len(dataframe.index)
+    next_songs = len(next_song_rows.index)
+
+    def process_log_dataframe():
+        cursor = FakeCursor()
+        cursor.responses['songplay_staging_insert'] = lambda: (0, 0)
+        etl.process_log_dataframe(cursor, dataframe, log_file)
+
+    def process_song_files():
+        cursor = FakeCursor()
+        for song_file in song_files:
+            etl.process_song_file(cursor, song_file)
+
+    return [
+        ('read_log_file', events,
+         lambda: list(etl.read_log_file(log_file))),
+        ('add_time_keys', events,
+         lambda: etl.add_time_keys(dataframe)),
+        ('select_next_song_rows', events,
+         lambda: etl.select_next_song_rows(dataframe)),
+        ('build_time_dataframe', events,
+         lambda: etl.build_time_dataframe(keyed)),
+        ('dataframe_records (time)', len(time_dataframe.index),
+         lambda: etl.dataframe_records(time_dataframe)),
+        ('build_user_dataframe', next_songs,
+         lambda: etl.build_user_dataframe(next_song_rows)),
+        ('build_songplay_records', next_songs,
+         lambda: etl.build_songplay_records(next_song_rows,
+                                            resolved_ids)),
+        ('build_songplay_staging_records', next_songs,
+         lambda: etl.build_songplay_staging_records(next_song_rows)),
+        ('process_log_dataframe (insert)', events,
+         with_songplay_loader('insert', process_log_dataframe)),
+        ('process_log_dataframe (staged)', events,
+         with_songplay_loader('staged', process_log_dataframe)),
+        ('extract_song_data', len(song_files),
+         lambda: [etl.extract_song_data(song_file)
+                  for song_file in song_files]),
+        ('process_song_file', len(song_files), process_song_files),
+        ]
+
+
+def best_time(function, repeat):
+
+    """
+    Returns the shortest of 'repeat' timings of function(), in
+      seconds.
+    """
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def find_baseline(previous, record, baseline_commit):
+
+    """
+    Returns the latest previous record for the same dataset, from
+      'baseline_commit' if given, otherwise from any other commit
+      ... or None.
+    """
+
+    for candidate in reversed(previous):
+        if candidate['dataset'] != record['dataset']:
+            continue
+        if baseline_commit is not None:
+            if candidate['commit'].startswith(baseline_commit):
+                return candidate
+        elif candidate['commit'] != record['commit']:
+            return candidate
+    return None
+
+
+def regressions(baseline, record, threshold):
+
+    """
+    Returns a line describing each step whose seconds per 100k
+      records rose by more than 'threshold' percent from 'baseline'
+      to 'record'.
+    """
+
+    found = []
+    for name, after in record['seconds_per_100k'].items():
+        before = baseline['seconds_per_100k'].get(name)
+        if not before:
+            continue
+        change = (after - before) / before * 100
+        if change > threshold:
+            found.append(
+                f'REGRESSION {name}: {before:.4f} -> {after:.4f} s/100k '
+                f'({change:+.1f}%) since {baseline["commit"]}')
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--records', type=int, default=100000,
+                        help='log events in the generated log file')
+    parser.add_argument('--songs', type=int, default=2000,
+                        help='song files in the generated dataset')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the generated dataset')
+    parser.add_argument('--work-dir',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'sparkify-benchmark-data'),
+                        help='where generated datasets are kept between '
+                             'runs')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timings per step, the best is recorded')
+    parser.add_argument('--results', default=RESULTS_FILE,
+                        help='results file, one JSON record per line')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percentage slowdown reported as a '
+                             'regression')
+    parser.add_argument('--baseline',
+                        help='commit to compare with, by default the '
+                             'latest result from another commit')
+    options = parser.parse_args(argv)
+
+    """
+      etl.py logs at INFO level, which would be timed too.
+    """
+    logging.getLogger().setLevel(logging.ERROR)
+
+    log_file, song_files = prepare_dataset(options.work_dir,
+                                           options.records, options.songs,
+                                           options.seed)
+    record = {
+        'commit': git_commit(),
+        'recorded': datetime.datetime.now(
+            datetime.timezone.utc).isoformat(timespec='seconds'),
+        'dataset': {'records': options.records, 'songs': options.songs,
+                    'seed': options.seed},
+        'repeats': options.repeat,
+        'seconds_per_100k': {}
+        }
+    print(f'{"step":<32} {"records":>9} {"best s":>9} {"s/100k":>9} '
+          f'{"records/sec":>13}')
+    for name, records, function in build_cases(log_file, song_files):
+        seconds = best_time(function, options.repeat)
+        per_100k = seconds * PER_RECORDS / max(records, 1)
+        record['seconds_per_100k'][name] = per_100k
+        print(f'{name:<32} {records:>9} {seconds:>9.4f} {per_100k:>9.4f} '
+              f'{records / max(seconds, 1e-9):>13,.0f}')
+
+    previous = load_results(options.results)
+    with open(options.results, 'a') as results:
+        results.write(json.dumps(record) + '\n')
+    found = []
+    baseline = find_baseline(previous, record, options.baseline)
+    if baseline is not None:
+        found = regressions(baseline, record, options.threshold)
+    for line in found:
+        print(line)
+    if found:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
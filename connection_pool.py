@@ -0,0 +1,329 @@
+"""
+Database Connections
+====================
+
+  The connection settings and connection pool shared by
+    create_tables.py, etl.py and test.py (and the benchmarks), in
+    place of the connection strings each script had hardcoded.
+
+  Settings come from, in increasing order of precedence:
+
+   - the defaults below, the local 'student' setup
+   - a config file: the file named by SPARKIFY_CONFIG, or
+       sparkify.cfg in the current directory if there is one
+   - environment variables: SPARKIFY_DB_<NAME> for the [database]
+       settings and SPARKIFY_POOL_<NAME> for the [pool] settings,
+       for example SPARKIFY_DB_HOST or SPARKIFY_POOL_MAX_SIZE
+
+  A config file looks like this, any setting can be left out:
+
+      [database]
+      host = 127.0.0.1
+      port = 5432
+      user = student
+      password = student
+      dbname = sparkify
+      admin_dbname = studentdb
+
+      [pool]
+      min_size = 1
+      max_size = 4
+      health_check_seconds = 30
+
+  With no port, libpq's own default applies, so PGPORT still works.
+    Point host and port at a PgBouncer to keep server connections
+    warm between separate runs of the scripts.
+
+  Each process keeps a pool per database. getconn hands out an idle
+    connection from it, after a health check, and putconn returns it
+    for reuse, so code that connects more than once in a process,
+    the etl.py worker processes (which now live for the whole run)
+    or a benchmark running etl.main repeatedly, only pays for
+    connection setup once.
+
+"""
+
+"""
+Imports
+=======
+
+  os - the environment variables
+  time - when each connection was last used
+  threading - guarding the pools, which threads share
+  configparser - the config file
+  psycopg2 - the connections, pool and DSN formatting
+
+"""
+
+import os
+import time
+import threading
+import configparser
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+
+CONFIG_ENV = 'SPARKIFY_CONFIG'
+CONFIG_FILE = 'sparkify.cfg'
+
+DEFAULT_SETTINGS = {
+    'database': {
+        'host': '127.0.0.1',
+        'port': '',
+        'user': 'student',
+        'password': 'student',
+        'dbname': 'sparkify',
+        'admin_dbname': 'studentdb'
+        },
+    'pool': {
+        'min_size': '1',
+        'max_size': '4',
+        'health_check_seconds': '30'
+        }
+    }
+
+"""
+  Environment variable prefix for each section of the settings.
+"""
+
+ENV_PREFIXES = {'database': 'SPARKIFY_DB_', 'pool': 'SPARKIFY_POOL_'}
+
+settings = None
+
+pools = {}
+borrowed = {}
+last_used = {}
+pools_lock = threading.Lock()
+
+
+def load_settings(path=None):
+
+    """
+    (Re)reads the settings from the defaults, the config file and the
+      environment.
+
+    Parameters:
+
+     - path: config file to read, None uses SPARKIFY_CONFIG or
+         sparkify.cfg
+
+    Returns: the settings, a dictionary of section -> name -> value
+
+    """
+
+    global settings
+
+    config = configparser.ConfigParser(interpolation=None)
+    config.read_dict(DEFAULT_SETTINGS)
+    path = path or os.environ.get(CONFIG_ENV)
+    if path:
+        with open(path) as config_file:
+            config.read_file(config_file)
+    else:
+        config.read(CONFIG_FILE)
+    settings = {section: dict(config[section])
+                for section in DEFAULT_SETTINGS}
+    for section, prefix in ENV_PREFIXES.items():
+        for name in settings[section]:
+            value = os.environ.get(prefix + name.upper())
+            if value is not None:
+                settings[section][name] = value
+    return settings
+
+
+def get_settings():
+
+    """
+    Returns the settings, reading them the first time.
+    """
+
+    if settings is None:
+        load_settings()
+    return settings
+
+
+def dsn(dbname=None):
+
+    """
+    Builds the libpq connection string for a database.
+
+    Parameters:
+
+     - dbname: the database, None for the sparkify database (the
+         'dbname' setting)
+
+    Returns: the connection string
+
+    """
+
+    database = get_settings()['database']
+    parameters = {name: value for name, value in database.items()
+                  if value and name not in ('dbname', 'admin_dbname')}
+    return psycopg2.extensions.make_dsn(dbname=dbname or database['dbname'],
+                                        **parameters)
+
+
+def database_name():
+
+    """
+    Returns the name of the sparkify database.
+    """
+
+    return get_settings()['database']['dbname']
+
+
+def admin_database_name():
+
+    """
+    Returns the name of the database create_tables.py connects to
+      while it drops and creates the sparkify database.
+    """
+
+    return get_settings()['database']['admin_dbname']
+
+
+def get_pool(dbname=None):
+
+    """
+    Returns this process's pool for a database, creating it, and so
+      opening its first min_size connections, if need be.
+    """
+
+    dbname = dbname or database_name()
+    with pools_lock:
+        pool = pools.get(dbname)
+        if pool is None:
+            pool_settings = get_settings()['pool']
+            pool = psycopg2.pool.ThreadedConnectionPool(
+                int(pool_settings['min_size']),
+                int(pool_settings['max_size']),
+                dsn(dbname)
+                )
+            pools[dbname] = pool
+        return pool
+
+
+def healthy(connection):
+
+    """
+    Checks a pooled connection before it is handed out: it must be
+      open and not in a failed state and, if it has been idle longer
+      than health_check_seconds, answer a 'SELECT 1'.
+    """
+
+    if connection.closed:
+        return False
+    status = connection.get_transaction_status()
+    if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+        return False
+    if id(connection) not in last_used:
+        return True
+    idle = time.monotonic() - last_used[id(connection)]
+    if idle < float(get_settings()['pool']['health_check_seconds']):
+        return True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        if status == psycopg2.extensions.TRANSACTION_STATUS_IDLE \
+                and not connection.autocommit:
+            connection.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def getconn(dbname=None):
+
+    """
+    Takes a connection from the pool for a database, replacing any
+      that fail their health check.
+
+    Parameters:
+
+     - dbname: the database, None for the sparkify database
+
+    Returns: a psycopg2 connection, to be given back with putconn
+
+    """
+
+    dbname = dbname or database_name()
+    pool = get_pool(dbname)
+    while True:
+        connection = pool.getconn()
+        if healthy(connection):
+            borrowed[id(connection)] = dbname
+            return connection
+        last_used.pop(id(connection), None)
+        pool.putconn(connection, close=True)
+
+
+def putconn(connection):
+
+    """
+    Gives a connection from getconn back to its pool for reuse, first
+      rolling back anything left uncommitted and turning autocommit
+      back off, psycopg2's default. A connection that is broken is
+      closed instead.
+
+    Parameters:
+
+     - connection: a connection from getconn
+
+    Returns: none
+
+    """
+
+    dbname = borrowed.pop(id(connection))
+    close = bool(connection.closed)
+    if not close:
+        try:
+            connection.rollback()
+            connection.autocommit = False
+        except psycopg2.Error:
+            close = True
+    if close:
+        last_used.pop(id(connection), None)
+    else:
+        last_used[id(connection)] = time.monotonic()
+    with pools_lock:
+        pool = pools.get(dbname)
+    if pool is None:
+        connection.close()
+    else:
+        pool.putconn(connection, close=close)
+
+
+def close_pool(dbname=None):
+
+    """
+    Closes every connection in this process's pool for a database,
+      for example before dropping it.
+
+    Parameters:
+
+     - dbname: the database, None for the sparkify database
+
+    Returns: none
+
+    """
+
+    dbname = dbname or database_name()
+    with pools_lock:
+        pool = pools.pop(dbname, None)
+    if pool is not None:
+        pool.closeall()
+        for key, value in list(borrowed.items()):
+            if value == dbname:
+                del borrowed[key]
+
+
+def close_all():
+
+    """
+    Closes every pool in this process.
+    """
+
+    for dbname in list(pools):
+        close_pool(dbname)
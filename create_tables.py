@@ -6,7 +6,7 @@
 
   Standalone version create_tables script.
 
-  'Kills and rebuilds' each of the five table definitions
+  'Kills and rebuilds' each of the table definitions
   required by the etl.py script.
 
   Part of my submission for:
@@ -20,11 +20,22 @@ Imports
 
   psycopg2 to handle interaction with PostgreSQL
   sql_queries.py is part of the submission required by this project.
+  sql_trace to time each query when SPARKIFY_TRACE_SQL is set
+  connection_pool for the connection settings and pooled connections
+  argparse and time for the --bulk-load and --finalize options
 
 """
 
+import argparse
+import time
 import psycopg2
 from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import bulk_create_table_queries, bulk_finalize_queries
+from sql_queries import bulk_load_select
+from sql_queries import partitioned_table_creates
+from sql_queries import compact_create_table_queries
+import sql_trace
+import connection_pool
 
 """
 Underlining
@@ -59,8 +70,8 @@ Create Database
 def create_database():
 
     """
-    Connects to the default database on a local postgreSQL
-    installation, then:
+    Connects to the default database ('admin_dbname' in
+    connection_pool.py, studentdb unless configured otherwise), then:
 
      - Obtains a 'cursor' to allow submission of queries
      - Perfoms a 'kill and rebuild' of the 'sparkify' database by:
@@ -84,8 +95,8 @@ def create_database():
     """
 
     try:
-        admin_connection = psycopg2.connect(
-            'host=127.0.0.1 dbname=studentdb user=student password=student'
+        admin_connection = connection_pool.getconn(
+            connection_pool.admin_database_name()
             )
         logging.info(
             f'\n'
@@ -128,7 +139,8 @@ def create_database():
     """
 
     try:
-        cursor = admin_connection.cursor()
+        cursor = admin_connection.cursor(
+            cursor_factory=sql_trace.cursor_factory())
         logging.info(
             f'\n'
             f'  Cursor active\n'
@@ -149,7 +161,13 @@ def create_database():
       is the 'kill' part of 'kill and rebuild'
     """
 
-    database_name = 'sparkify'
+    """
+    Any connections this process has pooled to the 'sparkify'
+      database have to be closed first.
+    """
+
+    database_name = connection_pool.database_name()
+    connection_pool.close_pool(database_name)
     sql = f'DROP DATABASE IF EXISTS {database_name}'
     try:
         cursor.execute(f'{sql}')
@@ -195,11 +213,11 @@ def create_database():
             )
 
     """
-    Close connection to default database to avoid any confusion and
-      it's generally a safer way to do things.
+    Give the connection to the default database back to the pool to
+      avoid any confusion and it's generally a safer way to do things.
     """
 
-    admin_connection.close()
+    connection_pool.putconn(admin_connection)
 
     """
     Create a new connection to the new 'sparkify' database for all
@@ -207,9 +225,7 @@ def create_database():
     """
 
     try:
-        sparkify_connection = psycopg2.connect(
-            f'host=127.0.0.1 dbname={database_name} user=student password=student'
-            )
+        sparkify_connection = connection_pool.getconn(database_name)
         logging.info(
             f'\n'
             f'  Connection open:\n'
@@ -232,7 +248,8 @@ def create_database():
     """
 
     try:
-        sparkify_cursor = sparkify_connection.cursor()
+        sparkify_cursor = sparkify_connection.cursor(
+            cursor_factory=sql_trace.cursor_factory())
         logging.info(
             f'\n'
             f'  Sparkify cursor active\n'
@@ -272,39 +289,209 @@ def drop_tables(cursor, connecction):
         connecction.commit()
 
 
-def create_tables(cursor, connecction):
+def create_tables(cursor, connecction, queries=create_table_queries):
         ################################################################
         # Creates all required the tables using the queries in
-        #   `create_table_queries` list.
+        #   `create_table_queries` list, or `bulk_create_table_queries`
+        #   with --bulk-load.
         #
-    for query in create_table_queries:
+    for query in queries:
+        cursor.execute(query)
+        connecction.commit()
+
+
+"""
+Bulk Load
+=========
+
+  With --bulk-load the tables are created UNLOGGED and without their
+    primary keys, UNIQUE constraints and indexes (see BULK LOAD in
+    sql_queries.py) so that a full etl.py run doesn't pay for WAL
+    and index maintenance on every insert. Once etl.py has finished,
+    'create_tables.py --finalize' removes the duplicates the
+    constraints would have rejected, adds the constraints and
+    indexes, makes the tables LOGGED and runs ANALYZE.
+
+  NOTE: until they are finalized the tables are emptied by a crash
+    of the server, as UNLOGGED tables are.
+"""
+
+def bulk_loaded(cursor):
+
+    """
+    Returns True when the sparkify tables were created with
+      --bulk-load and haven't been finalized yet, that is when the
+      songplays table exists and is UNLOGGED.
+    """
+
+    cursor.execute(bulk_load_select)
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def finalize_tables(cursor, connecction):
+
+    """
+    Runs the `bulk_finalize_queries` list on tables created with
+      --bulk-load, logging the time each takes.
+
+    Parameters:
+
+     - cursor: cursor on the sparkify database
+     - connecction: its connection
+
+    Returns: none
+
+    """
+
+    for query in bulk_finalize_queries:
+        start = time.perf_counter()
         cursor.execute(query)
         connecction.commit()
+        logging.info(
+            f'\n'
+            f'  {query}\n'
+            f'    {cursor.rowcount} rows, '
+            f'{time.perf_counter() - start:.3f}s\n'
+            f'{UNDERLINE_3}'
+            )
+
 
+def partitioned_queries(tables):
+
+    """
+    Returns `create_table_queries` with the CREATE statements of
+      'tables' replaced by their monthly range-partitioned versions
+      (see PARTITIONED TABLES in sql_queries.py). etl.py creates the
+      partitions as it needs them.
+
+    Parameters:
+
+     - tables: list of table names, from 'songplays' and 'time'
+
+    Returns: list of queries
+
+    """
+
+    queries = list(create_table_queries)
+    for table in tables:
+        plain, partitioned = partitioned_table_creates[table]
+        queries[queries.index(plain)] = partitioned
+    return queries
+
+
+def parse_arguments(argv=None):
+
+    """
+    Command line options for the script. With no options the
+      database and tables are rebuilt as they always were.
+
+    Parameters:
+
+     - argv: list of argument strings, None means sys.argv
+
+    Returns: an argparse.Namespace holding the options
+
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Drop and recreate the sparkify database and its '
+                    'tables.'
+        )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        '--bulk-load',
+        action='store_true',
+        help='create the tables UNLOGGED with no constraints or '
+             'indexes, for a full etl.py load followed by --finalize'
+        )
+    mode.add_argument(
+        '--finalize',
+        action='store_true',
+        help='after etl.py has loaded --bulk-load tables: remove '
+             'duplicates, add the constraints and indexes, make the '
+             'tables LOGGED and ANALYZE them'
+        )
+    mode.add_argument(
+        '--compact',
+        action='store_true',
+        help='create the compact schema: double precision and real '
+             'instead of NUMERIC, smallint calendar fields and '
+             'weekday code, integer song and artist keys'
+        )
+    parser.add_argument(
+        '--partition',
+        nargs='+',
+        choices=sorted(partitioned_table_creates),
+        default=[],
+        metavar='TABLE',
+        help='create these tables (songplays, time) range-partitioned '
+             'by month'
+        )
+    options = parser.parse_args(argv)
+    if options.partition and (options.bulk_load or options.finalize
+                              or options.compact):
+        parser.error('--partition cannot be combined with --bulk-load, '
+                     '--finalize or --compact')
+    return options
+
+
+def main(argv=None):
+    options = parse_arguments(argv)
 
-def main():
     logging.warning(
         f'\n'
         f'  We\'re at the beginning ...\n'
         f'{UNDERLINE_3}'
         )
 
+    if options.finalize:
+
+        ################################################################
+        # Finalizes the tables of an existing sparkify database.
+        #
+        sparkify_connection = connection_pool.getconn()
+        sparkify_cursor = sparkify_connection.cursor(
+            cursor_factory=sql_trace.cursor_factory())
+        if not bulk_loaded(sparkify_cursor):
+            logging.error(
+                f'\n'
+                f'  Nothing to finalize: the sparkify tables weren\'t '
+                f'created with --bulk-load, or are already finalized\n'
+                f'{UNDERLINE_1}'
+                )
+            connection_pool.putconn(sparkify_connection)
+            raise SystemExit(1)
+        finalize_tables(sparkify_cursor, sparkify_connection)
+
+    else:
+
         ################################################################
         # Drops (if it exists) and creates the sparkify database, then
         #   establishes connection with the sparkify database and
         #   gets a cursor to it.
         #
-    sparkify_cursor, sparkify_connection = create_database()
+        sparkify_cursor, sparkify_connection = create_database()
 
         ################################################################
         # Drop all the tables.
         #
-    drop_tables(sparkify_cursor, sparkify_connection)
+        drop_tables(sparkify_cursor, sparkify_connection)
 
         ################################################################
         # Creates all tables needed.
         #
-    create_tables(sparkify_cursor, sparkify_connection)
+        if options.bulk_load:
+            create_tables(sparkify_cursor, sparkify_connection,
+                          bulk_create_table_queries)
+        elif options.compact:
+            create_tables(sparkify_cursor, sparkify_connection,
+                          compact_create_table_queries)
+        elif options.partition:
+            create_tables(sparkify_cursor, sparkify_connection,
+                          partitioned_queries(options.partition))
+        else:
+            create_tables(sparkify_cursor, sparkify_connection)
 
         ################################################################
         #
@@ -327,13 +514,13 @@ def main():
             )
 
         ################################################################
-        # Close the connection
+        # Give the connection back to the pool
         #
     try:
-        sparkify_connection.close()
+        connection_pool.putconn(sparkify_connection)
         logging.info(
             f'\n'
-            f'  Connection closed\n'
+            f'  Connection released\n'
             f'{UNDERLINE_3}'
             )
     except psycopg2.Error as e:
@@ -345,6 +532,9 @@ def main():
             f'{UNDERLINE_2}'
             )
 
+    if sql_trace.tracing_enabled():
+        logging.info(sql_trace.statement_report())
+
     logging.warning(
         f'\n'
         f'  We\'ve got to the end!!\n\n'
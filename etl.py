@@ -27,23 +27,58 @@ Imports
 
   os - provides 'directory walk' capabilities amongst other
   sys - can help in interpreting errors
-  glob - allows pattern matching using wildcards
+  fnmatch - allows pattern matching using wildcards
+  itertools - slicing the stream of files into worker tasks
+  io, csv - build in-memory buffers for 'COPY ... FROM STDIN'
+  time - timing of the bulk loaders
+  argparse - command line options to select the loaders
+  functools - lru_cache for the bounded song lookup
+  contextlib - savepoint context manager for batched transactions
+  hashlib - content hashes for the load manifest
+  concurrent.futures, multiprocessing - worker process pool
+  threading, queue - reader and writer threads of --readers
   psycopg2 - provided interaction with PostgreSQL
   json - allows conversion into and out of json object format
   pandas - python data analysis and manipulation tool
   numpy - provides 'scientific computing' capabilities
   sql-queries - local source of sql queries used here
+  run_stats - counters and per-stage figures for the run
+  sql_trace - per-statement timing when SPARKIFY_TRACE_SQL is set
+  pg_pipeline - the psycopg 3 pipeline mode backend, --backend pipeline
+  connection_pool - connection settings and the pooled connections
+  user_agent - browser, OS and device of a userAgent string
 
 """
 
 import os
+import re
 import sys
-import glob
+import fnmatch
+import itertools
+import io
+import csv
+import time
+import datetime
+import argparse
+import functools
+import contextlib
+import hashlib
+import concurrent.futures
+import threading
+import queue
+import multiprocessing
+import multiprocessing.util
 import psycopg2
+import psycopg2.extras
 import json
 import pandas as pd
 import numpy as np
 from sql_queries import *
+from run_stats import RunStats, read_peak_rss, reset_peak_rss
+import sql_trace
+import pg_pipeline
+import connection_pool
+from user_agent import parse_user_agent
 
 """
 Underlining
@@ -90,62 +125,394 @@ logging.basicConfig(level=logging.INFO)
 
 
 """
-  Using a global variable to count handled errors is clunky but ...
-  ... pragmatic here as it saves hunting through lots of output
+  The database driver, 'psycopg2' or, with --backend pipeline,
+    psycopg 3 in pipeline mode through pg_pipeline.py.
+
+  The connection settings come from connection_pool.py (a config
+    file or SPARKIFY_DB_* environment variables), and psycopg2
+    connections are taken from its pool, used by main and by each
+    worker process.
+"""
+
+database_backend = 'psycopg2'
+
+
+def connect_sparkify():
+
+    """
+    Gets a connection to the sparkify database with the driver
+      selected by database_backend, in autocommit mode unless a
+      --commit-every mode is in use.
+
+    Returns: a psycopg2 connection, or a pg_pipeline.PipelineConnection,
+      to be given back with release_sparkify
+    """
+
+    if database_backend == 'pipeline':
+        connection = pg_pipeline.connect(connection_pool.dsn())
+    else:
+        connection = connection_pool.getconn()
+    connection.set_session(autocommit=commit_every is None)
+    return connection
+
+
+def release_sparkify(connection):
+
+    """
+    Gives back a connection from connect_sparkify: to the pool for a
+      psycopg2 connection, otherwise it is closed.
+    """
+
+    if isinstance(connection, pg_pipeline.PipelineConnection):
+        connection.close()
+    else:
+        connection_pool.putconn(connection)
+
+
+"""
+  Tables created by 'create_tables.py --bulk-load' are UNLOGGED and
+    have no constraints, so the conflict targets of the inserts below
+    have nothing to match and are dropped, leaving 'ON CONFLICT DO
+    NOTHING'. The duplicates they would have skipped are removed by
+    'create_tables.py --finalize' (see BULK LOAD in sql_queries.py).
+"""
+
+bulk_load = False
+
+BULK_LOAD_QUERIES = ['song_table_batch_insert', 'artist_table_batch_insert',
+                     'user_table_batch_insert', 'time_table_batch_insert',
+                     'song_staging_merge', 'artist_staging_merge',
+                     'songplay_staging_insert']
+
+CONFLICT_TARGET = re.compile(
+    r' ON CONFLICT \([^)]*\) DO (NOTHING|UPDATE SET [^;]*)')
+
+
+def detect_bulk_load(cursor):
+
+    """
+    Checks whether the tables were created with --bulk-load and, if
+      so, switches the BULK_LOAD_QUERIES to their versions without a
+      conflict target.
+
+    Returns: True for --bulk-load tables
+    """
+
+    global bulk_load
+
+    cursor.execute(bulk_load_select)
+    row = cursor.fetchone()
+    bulk_load = bool(row and row[0])
+    if bulk_load:
+        use_bulk_load_queries()
+        logging.info(
+            f'\n'
+            f'  Unlogged --bulk-load tables found, run '
+            f'\'create_tables.py --finalize\' after loading\n'
+            f'{UNDERLINE_2}'
+            )
+    return bulk_load
+
+
+"""
+  Tables created by 'create_tables.py --compact' have integer
+    song_key and artist_key surrogate keys and narrower columns, and
+    the statements that write or look up songs, time and songplays
+    are swapped for the compact_queries versions (see COMPACT SCHEMA
+    in sql_queries.py).
+"""
+
+compact_schema = False
+
+
+def detect_compact_schema(cursor):
+
+    """
+    Checks whether the tables were created with --compact and, if
+      so, switches to the compact_queries.
+
+    Returns: True for --compact tables
+    """
+
+    global compact_schema
+
+    cursor.execute(compact_schema_select)
+    row = cursor.fetchone()
+    compact_schema = bool(row and row[0])
+    if compact_schema:
+        use_compact_queries()
+        logging.info(
+            f'\n'
+            f'  Compact schema found, songplays refer to songs and '
+            f'artists by song_key and artist_key\n'
+            f'{UNDERLINE_2}'
+            )
+    return compact_schema
+
+
+"""
+  Tables created by create_tables.py have a user_agents dimension
+    holding the browser, os and device parsed from each user agent
+    (see Interned dimensions below). A database created before it
+    was added loads as before, without it.
+"""
+
+user_agent_dimension = False
+
+
+def detect_user_agent_dimension(cursor):
+
+    """
+    Checks whether the user_agents table has the parsed attributes
+      and reads the keys of the interned dimensions in use.
+
+    Returns: True when user agents are parsed into user_agents
+    """
+
+    global user_agent_dimension
+
+    cursor.execute(user_agent_dimension_select)
+    row = cursor.fetchone()
+    user_agent_dimension = bool(row and row[0])
+    load_dimension_keys(cursor)
+    if not user_agent_dimension:
+        logging.warning(
+            f'\n'
+            f'  No user_agents table with browser, os and device, '
+            f'user agents won\'t be parsed\n'
+            f'{UNDERLINE_2}'
+            )
+    return user_agent_dimension
+
+
+def use_compact_queries():
+
+    """
+    Replaces the globals named in compact_queries with their compact
+      schema versions.
+    """
+
+    globals().update(compact_queries)
+
+
+def use_bulk_load_queries():
+
+    """
+    Replaces each of the BULK_LOAD_QUERIES globals with its version
+      without a conflict target.
+    """
+
+    for name in BULK_LOAD_QUERIES:
+        globals()[name] = CONFLICT_TARGET.sub(' ON CONFLICT DO NOTHING',
+                                              globals()[name])
+
+
+"""
+  Counting handled errors (and the rows saved, duplicates found
+  ...) is pragmatic here as it saves hunting through lots of output
   when there are no error messages to find.
+
+  The counts are kept in run_stats, a RunStats object, under the
+    names they had as globals, for example run_stats['songs_saved'].
+    Alongside them it times the song and log stages and records the
+    rows and bytes read and the peak memory of each, and at the end
+    of the run main writes it all out as JSON and Prometheus text
+    (see run_stats.py and --stats-dir).
+"""
+
+run_stats = RunStats()
+
+STATS_JSON_FILE = 'etl_stats.json'
+STATS_PROMETHEUS_FILE = 'etl_stats.prom'
+
+
+"""
+Transactions
+============
+
+  By default the connection is in autocommit mode, so every INSERT
+    is its own transaction. With --commit-every N the rows are
+    committed N at a time instead, with --commit-every file once per
+    file.
+
+  In either transactional mode each single-row statement runs inside
+    a savepoint (and each batch statement inside one of its own), so
+    a row that fails, a duplicate key for example, is rolled back on
+    its own and the rest of the transaction carries on.
+
+  In a --workers process a transaction also ends with each file,
+    --commit-every N committing at N rows or at the end of the file,
+    whichever comes first. Otherwise two workers' transactions each
+    hold the artists, users and time rows of several files, taken in
+    different orders, and deadlock on one another's rows.
+
+  NOTE: execute_isolated sends 'SAVEPOINT ...; <query>' as a single
+    round trip and leaves the savepoint to be released at the start
+    of the next call, so that the result of the query can still be
+    fetched from the cursor.
 """
 
-handled_errors = 0
+commit_every = None
+commit_each_file = False
+rows_since_commit = 0
+savepoint_open = False
+
+
+def commit_every_type(value):
+
+    """
+    argparse type for --commit-every: 'file' or a positive number of
+      rows.
+    """
+
+    if value == 'file':
+        return value
+    rows = int(value)
+    if rows < 1:
+        raise argparse.ArgumentTypeError('must be "file" or at least 1')
+    return rows
 
-songs_saved = 0
-song_duplicates = 0
 
-artists_saved = 0
-artist_duplicates = 0
+def execute_isolated(cursor, query, values=None, rows=1):
 
-times_saved = 0
-time_duplicates = 0
+    """
+    Executes a single-row statement, inside a savepoint when a
+      transactional --commit-every mode is in use. If the statement
+      fails the transaction is rolled back to the savepoint and the
+      psycopg2 error is raised for the caller to handle as before.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+     - query: a query from sql_queries.py
+     - values: the query parameters
+     - rows: number of rows the statement writes, 0 for a SELECT
+
+    Returns: none
+
+    """
+
+    global savepoint_open
+
+    if commit_every is None:
+        cursor.execute(query, values)
+        return
+
+    release = 'RELEASE SAVEPOINT etl_row; ' if savepoint_open else ''
+    try:
+        cursor.execute(f'{release}SAVEPOINT etl_row; {query}', values)
+        savepoint_open = True
+    except psycopg2.Error:
+        cursor.execute('ROLLBACK TO SAVEPOINT etl_row')
+        savepoint_open = True
+        raise
+    count_rows(cursor, rows)
 
-users_saved = 0
-user_duplicates = 0
 
-songplays_saved = 0
-songplays_duplicates = 0
+@contextlib.contextmanager
+def isolated_batch(cursor):
 
-song_select_finds = 0
-song_select_responses = []
+    """
+    Context manager that runs a batch of statements inside a
+      savepoint when a transactional --commit-every mode is in use,
+      rolling back just the batch if one of them fails.
 
+    Parameters:
 
-def process_song_file(cursor, filepath):
+     - cursor: a cursor object to the database
 
     """
-    Opens the song file specified in 'filepath' and converts it
-      to a pandas dataframe
 
-     - Obtains a 'cursor' to allow submission of queries
-     - Perfoms a 'kill and rebuild' of the 'sparkify' database by:
-       * Droping the 'sparkify' database if it exists.
-       * Creating a new 'sparkify' database
-       * Closing the connection to the default database
-       * Obtaining a connection to the sparkify database
-       * Obtaining a cursor to the sparkify database
+    if commit_every is None:
+        yield
+        return
+
+    cursor.execute('SAVEPOINT etl_batch')
+    try:
+        yield
+    except psycopg2.Error:
+        cursor.execute('ROLLBACK TO SAVEPOINT etl_batch')
+        raise
+    cursor.execute('RELEASE SAVEPOINT etl_batch')
+
+
+def count_rows(cursor, rows):
+
+    """
+    Adds 'rows' to the rows written since the last commit and
+      commits if that reaches --commit-every N.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+     - rows: number of rows just written
+
+    Returns: none
+
+    """
+
+    global rows_since_commit
+
+    rows_since_commit += rows
+    if isinstance(commit_every, int) and rows_since_commit >= commit_every:
+        commit_transaction(cursor)
+
+
+def commit_transaction(cursor):
+
+    """
+    Commits the current transaction, when a transactional
+      --commit-every mode is in use.
 
     Parameters:
 
      - cursor: a cursor object to the database
-     - filepath: the absolute path to the song file to be processed
 
     Returns: none
 
     """
 
-    global handled_errors
+    global rows_since_commit
+    global savepoint_open
+
+    if commit_every is None:
+        return
+
+    try:
+        cursor.connection.commit()
+    except psycopg2.Error as e:
+        run_stats.add('handled_errors')
+        logging.error(
+            f'\n'
+            f'  Error committing {rows_since_commit} rows\n'
+            f'    {e}\n'
+            f'{UNDERLINE_1}'
+            )
+    rows_since_commit = 0
+    savepoint_open = False
+
+
+def extract_song_data(filepath, stats=None):
+
+    """
+    Opens the song file specified in 'filepath', converts it to a
+      pandas data series and builds the tuples needed by the songs
+      and artists tables.
+
+    Parameters:
+
+     - filepath: the absolute path to the song file to be processed
+     - stats: the RunStats to count in, None uses run_stats
+
+    Returns:
+
+     - song_data: tuple of (song_id, title, artist_id, year, duration)
+     - artist_data: tuple of (artist_id, name, location, latitude,
+         longitude)
 
-    global songs_saved
-    global song_duplicates
+      Both are None if the file could not be converted.
 
-    global artists_saved
-    global artist_duplicates
+    """
 
     """
       NOTE: When using pandas.read_json with a single line of json
@@ -157,35 +524,32 @@ def process_song_file(cursor, filepath):
 
     """
 
-    logging.debug(
-        f'\n'
-        f'  Entering process_song_file for: '
-        f'{os.path.basename(filepath)}\n'
-        f'{UNDERLINE_3}')
+    if stats is None:
+        stats = run_stats
+
     try:
         dataseries = pd.read_json(filepath, typ='series')
     except Exception:       # recommedned by PEP8
-        handled_errors += 1
+        stats.add('handled_errors')
         logging.error(
             f'\n'
             f'  Something went wrong converting to a dataseries for:\n'
             f'    {os.path.basename(filepath)}\n'
             f'{UNDERLINE_1}')
+        return None, None
+    stats.add('rows_read')
 
     """
-      Task #1: Populate Songs Table
-      =============================
-
-        Copying the dataseries fields to named variables is not
-          necessary but makes the code more comprehensible.
+      Copying the dataseries fields to named variables is not
+        necessary but makes the code more comprehensible.
 
-        NOTE a): single quotes are a problem in postgreSQL
-          queries so replace them with two quotes where they're
-          likely to occur
+      NOTE a): single quotes are a problem in postgreSQL
+        queries so replace them with two quotes where they're
+        likely to occur
 
-        NOTE b): rather than a string containing the field
-          values for the song_data, we need to make a tuple, so
-          use a cast
+      NOTE b): rather than a string containing the field
+        values for the song_data, we need to make a tuple, so
+        use a cast
     """
     try:
         num_songs = dataseries.iloc[0]
@@ -202,45 +566,16 @@ def process_song_file(cursor, filepath):
         song_data = tuple([song_id, title, artist_id, year, duration])
         logging.debug(f'\n  song_data tuple is: {song_data}')
     except Exception:       # recommedned by PEP8
-        handled_errors += 1
+        stats.add('handled_errors')
         logging.error(
             f'\n'
             f'  Something went wrong building the song_data tuple\n'
             f'{UNDERLINE_1}')
+        return None, None
 
     """
-      With everything prepared, insert the song data into the database
-    """
-    try:
-        cursor.execute(song_table_insert, song_data)
-        songs_saved += 1
-        logging.debug(
-            f'\n'
-            f'  Song data record saved to database')
-    except psycopg2.Error as e:
-        if ('duplicate key' in str(e)):
-            song_duplicates += 1
-            logging.warning(
-                f'\n'
-                f'Database reports a duplicate key for song: '
-                f'{title}\n'
-                f'{UNDERLINE_3}'
-                )
-        else:
-            handled_errors += 1
-            logging.error(
-                f'\n'
-                f'  Error saving song data record\n'
-                f'    {e}\n'
-                f'{UNDERLINE_3}'
-                )
-    """
-      Task #2: Populate Artists Table
-      ===============================
-
-        Use the same basic techniques as used for the song data of
-          building a tuple from sensibly named variables.
-
+      Use the same basic techniques for the artist data of
+        building a tuple from sensibly named variables.
     """
     try:
         artist_data = tuple([artist_id, artist_name, artist_location,
@@ -249,14 +584,51 @@ def process_song_file(cursor, filepath):
             f'\n'
             f'  artist_data tuple is: {artist_data}')
     except Exception:       # recommedned by PEP8
-        handled_errors += 1
+        stats.add('handled_errors')
         logging.error(
             f'\n'
             f'Something went wrong building the artist_data tuple\n'
             f'{UNDERLINE_1}')
+        return None, None
+
+    return song_data, artist_data
+
+
+def process_song_file(cursor, filepath, parsed=None):
+
+    """
+    Opens the song file specified in 'filepath' and inserts its
+      contents into the songs and artists tables, one row each.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+     - filepath: the absolute path to the song file to be processed
+     - parsed: the file's (song_data, artist_data) from
+         extract_song_data, when a --readers thread has already
+         parsed it
+
+    Returns: none
+
+    """
+
+    logging.debug(
+        f'\n'
+        f'  Entering process_song_file for: '
+        f'{os.path.basename(filepath)}\n'
+        f'{UNDERLINE_3}')
+
+    song_data, artist_data = parsed or extract_song_data(filepath)
+    if song_data is None:
+        return
 
     """
-      With everything prepared, insert the song data into the database.
+      Task #2: Populate Artists Table
+      ===============================
+
+        NOTE: the artist goes in before the song, since with
+          create_tables.py --compact the song row refers to it by
+          artist_key.
 
       QUESTION:
       =========
@@ -270,92 +642,704 @@ def process_song_file(cursor, filepath):
     """
 
     try:
-        cursor.execute(artist_table_insert, artist_data)
-        artists_saved += 1
+        saved = insert_batch(cursor, artist_table_batch_insert,
+                             [artist_data])
+        run_stats.add('artists_saved', saved)
+        run_stats.add('artist_duplicates', 1 - saved)
         logging.debug(
             f'\n'
             f'  Artist data record saved to database')
     except psycopg2.Error as e:
-        if ('duplicate key' in str(e)):
-            artist_duplicates += 1
-            logging.warning(
-                f'\n'
-                f'Database reports a duplicate key for artist: '
-                f'{artist_name}\n'
-                f'{UNDERLINE_3}'
-                )
-        else:
-            handled_errors += 1
-            logging.error(
-                f'\n'
-                f'  Error saving artist data record\n'
-                f'    {e}\n'
-                f'{UNDERLINE_3}'
-                )
+        run_stats.add('handled_errors')
+        logging.error(
+            f'\n'
+            f'  Error saving artist data record\n'
+            f'    {e}\n'
+            f'{UNDERLINE_3}'
+            )
+    """
+      Task #1: Populate Songs Table
+      =============================
+
+        With everything prepared, insert the song data into the
+          database
+    """
+    try:
+        saved = insert_batch(cursor, song_table_batch_insert, [song_data])
+        run_stats.add('songs_saved', saved)
+        run_stats.add('song_duplicates', 1 - saved)
+        logging.debug(
+            f'\n'
+            f'  Song data record saved to database')
+    except psycopg2.Error as e:
+        run_stats.add('handled_errors')
+        logging.error(
+            f'\n'
+            f'  Error saving song data record\n'
+            f'    {e}\n'
+            f'{UNDERLINE_3}'
+            )
     logging.debug(
         f'\n'
         f'  process_song_file completefor: {os.path.basename(filepath)}\n'
         f'{UNDERLINE_3}\n')
 
 
-def process_log_file(cursor, filepath):
+def copy_records(cursor, copy_query, records):
 
     """
-    This processes one log file using pandas to open, convert (to a
-      dataframe) and process the contents.
-
-    NOTE: Unlike the songs files each log file contains multiple
-      lines of user activity data.
+    Streams a list of record tuples to the database with a single
+      'COPY ... FROM STDIN' statement.
 
-    NOTE: When using pandas.read_json with a multiple lines of
-      json data per file, then it is necessary to specify
-      lines=True
+    The records are written to an in-memory csv buffer first. None
+      values are written as '\\N' which the COPY queries in
+      sql_queries.py declare as their NULL marker, so empty strings
+      survive as empty strings.
 
     Parameters:
 
      - cursor: a cursor object to the database
-     - filepath: the absolute path to the log file to be processed
+     - copy_query: a 'COPY ... FROM STDIN' query from sql_queries.py
+     - records: a list of tuples, one per row
 
     Returns: none
 
     """
 
-    global handled_errors
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for record in records:
+        writer.writerow(
+            ['\\N' if value is None else value for value in record]
+            )
+    buffer.seek(0)
+    cursor.copy_expert(copy_query, buffer)
+
 
-    global times_saved
-    global time_duplicates
+"""
+Bulk COPY loader for songs and artists
+======================================
+
+  Rather than two single-row INSERTs (and, with autocommit, two
+    commits) per song file, process_song_file_copy collects the
+    parsed records in these buffers. Each time song_copy_batch_size
+    records have been collected they are COPYed into the UNLOGGED
+    staging tables and merged into songs and artists with one
+    INSERT ... ON CONFLICT per table.
+"""
 
-    global users_saved
-    global user_duplicates
+SONG_COPY_BATCH_SIZE = 5000
 
-    global songplays_saved
-    global songplays_duplicates
+song_copy_batch_size = SONG_COPY_BATCH_SIZE
+song_copy_buffer = []
+artist_copy_buffer = []
 
-    global song_select_finds
-    global song_select_responses
 
+def prepare_song_staging(cursor):
 
     """
-      Use pandas to open the log file ...
+    Makes sure the UNLOGGED staging tables used by the bulk COPY
+      loader exist (create_tables.py creates them too, this covers
+      databases built before they were added).
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+
+    Returns: none
+
     """
 
-    logging.debug(f'\n\
-      Entering process_log_file for: \
-      {os.path.basename(filepath)}\n{UNDERLINE_3}')
+    for query in song_staging_queries:
+        cursor.execute(query)
+
+
+def process_song_file_copy(cursor, filepath, parsed=None):
+
+    """
+    Bulk mode alternative to process_song_file: parses the song file
+      and adds its records to the in-memory buffers, flushing them
+      to the database when a full batch has been collected.
+
+    NOTE: flush_song_buffer must be called once all files have been
+      processed to load the final, partial, batch.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+     - filepath: the absolute path to the song file to be processed
+     - parsed: as for process_song_file
+
+    Returns: none
+
+    """
+
+    song_data, artist_data = parsed or extract_song_data(filepath)
+    if song_data is None:
+        return
+
+    song_copy_buffer.append(song_data)
+    artist_copy_buffer.append(artist_data)
+
+    if len(song_copy_buffer) >= song_copy_batch_size:
+        flush_song_buffer(cursor)
+
+
+def flush_song_buffer(cursor):
+
+    """
+    COPYs the buffered song and artist records into the staging
+      tables, merges them into the songs and artists tables with a
+      single set-based INSERT ... ON CONFLICT each.
+
+    The whole batch is one transaction (psycopg2 starts one for
+      'with connection' even in autocommit mode). The staging tables
+      are emptied at its start, and TRUNCATE holds its lock until the
+      commit, so worker processes sharing the staging tables take
+      turns rather than merging each other's rows. With --commit-every
+      this also commits (or, on an error, rolls back) anything else
+      written since the last commit.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+
+    Returns: none
+
+    """
+
+    global rows_since_commit
+    global savepoint_open
+
+    if not song_copy_buffer:
+        record_loaded_files(cursor, manifest_pending)
+        manifest_pending.clear()
+        return
+
+    batch_size = len(song_copy_buffer)
+    start = time.perf_counter()
     try:
-        dataframe = pd.read_json(filepath, lines=True)
-        logging.debug(
+        with cursor.connection:
+            cursor.execute(song_staging_truncate)
+            cursor.execute(artist_staging_truncate)
+
+            copy_records(cursor, song_staging_copy, song_copy_buffer)
+            copy_records(cursor, artist_staging_copy, artist_copy_buffer)
+
+            cursor.execute(artist_staging_merge)
+            artists_inserted = cursor.rowcount
+
+            cursor.execute(song_staging_merge)
+            songs_inserted = cursor.rowcount
+
+            for entry in manifest_pending:
+                cursor.execute(load_manifest_upsert, entry)
+        run_stats.add('songs_saved', songs_inserted)
+        run_stats.add('song_duplicates', batch_size - songs_inserted)
+        run_stats.add('artists_saved', artists_inserted)
+        run_stats.add('artist_duplicates', batch_size - artists_inserted)
+    except psycopg2.Error as e:
+        run_stats.add('handled_errors')
+        logging.error(
             f'\n'
-            f'  File: {os.path.basename(filepath)}\n\n'
-            f'  Number of lines read:'
-            f'{len(dataframe.index)}\n\n'
-            f'Data fields (head):\n'
-            f'{dataframe.head()}\n\n'
-            f'Data fields (tail)\n'
-            f'{dataframe.tail()}\n\n'
-            f'{UNDERLINE_3}')
+            f'  Error bulk loading a batch of {batch_size} song files\n'
+            f'    {e}\n'
+            f'{UNDERLINE_3}'
+            )
+    rows_since_commit = 0
+    savepoint_open = False
+    elapsed = time.perf_counter() - start
+    logging.info(
+        f'\n'
+        f'  Bulk loaded {batch_size} songs and artists in '
+        f'{elapsed:.3f}s ({2 * batch_size / max(elapsed, 1e-9):.0f} '
+        f'rows/sec)\n'
+        f'{UNDERLINE_3}'
+        )
+
+    song_copy_buffer.clear()
+    artist_copy_buffer.clear()
+    manifest_pending.clear()
+
+
+"""
+Batched inserts
+===============
+"""
+
+INSERT_PAGE_SIZE = 1000
+
+insert_page_size = INSERT_PAGE_SIZE
+
+
+def dataframe_records(dataframe):
+
+    """
+    Converts a dataframe to a list of row tuples holding plain Python
+      values (psycopg2 can't adapt numpy integers).
+
+    Parameters:
+
+     - dataframe: the dataframe to convert
+
+    Returns: a list of tuples, one per row
+
+    """
+
+    return list(dataframe.astype(object).itertuples(index=False,
+                                                    name=None))
+
+
+def insert_batch(cursor, query, records, page_size=None):
+
+    """
+    The batched writer used for every insert into the star schema
+      tables: inserts a list of records with psycopg2's
+      execute_values, which sends 'page_size' records per multi-row
+      INSERT statement, and adds up the row counts the statements
+      report.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+     - query: an INSERT query from sql_queries.py with a single
+         'VALUES %s' placeholder
+     - records: a list of tuples, one per row
+     - page_size: number of records per statement, None uses
+         insert_page_size (--page-size)
+
+    With the pipeline backend all the pages are sent in one pipeline.
+
+    Returns: the number of rows the database reports as inserted (or
+      updated, for an ON CONFLICT ... DO UPDATE query)
+
+    """
+
+    page_size = page_size or insert_page_size
+    if pg_pipeline.is_pipelined(cursor):
+        """
+          The pipeline backend sends every page at once, so a failing
+            page rolls back the whole batch in the --commit-every modes.
+        """
+        pages = [records[first:first + page_size]
+                 for first in range(0, len(records), page_size)]
+        with isolated_batch(cursor):
+            inserted = cursor.execute_values_each(query, pages)
+        count_rows(cursor, len(records))
+        return inserted
+    inserted = 0
+    for first in range(0, len(records), page_size):
+        page = records[first:first + page_size]
+        with isolated_batch(cursor):
+            psycopg2.extras.execute_values(cursor, query, page,
+                                           page_size=len(page))
+            inserted += cursor.rowcount
+        count_rows(cursor, len(page))
+    return inserted
+
+
+"""
+Monthly partitions
+==================
+
+  When create_tables.py --partition has made songplays or time
+    range-partitioned by month on time_key, the records of each
+    batch are grouped by the month of their start_time and each
+    group is inserted straight into that month's partition, which
+    saves the database routing every row, and a partition that
+    doesn't exist yet is created first.
+
+  Partitions are created on a connection of their own, in autocommit
+    mode, so other processes can use a new partition straight away.
+    The CREATE waits for every open transaction that has used the
+    parent table, so with --commit-every the loading connection's
+    transaction is committed first; otherwise the CREATE would wait
+    forever on the connection that is waiting for it.
+
+  partitioned_tables names the partitioned tables (found by
+    detect_partitioning at the start of the run) and
+    known_partitions the partitions this process knows to exist.
+"""
+
+partitioned_tables = ()
+known_partitions = set()
+
+
+def detect_partitioning(cursor):
+
+    """
+    Finds which of songplays and time are partitioned, and their
+      existing partitions.
+
+    Returns: tuple of the partitioned table names
+    """
+
+    global partitioned_tables
+
+    cursor.execute(partitioned_tables_select)
+    partitioned_tables = tuple(sorted(row[0] for row in cursor.fetchall()))
+    if partitioned_tables:
+        load_partitions(cursor)
+        logging.info(
+            f'\n'
+            f'  Monthly partitioned tables: '
+            f'{", ".join(partitioned_tables)}, '
+            f'{len(known_partitions)} partitions\n'
+            f'{UNDERLINE_2}'
+            )
+    return partitioned_tables
+
+
+def load_partitions(cursor):
+
+    """
+    Reads the names of the existing partitions into known_partitions.
+    """
+
+    cursor.execute(partitions_select)
+    known_partitions.update(row[0] for row in cursor.fetchall())
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def month_time_key(year, month):
+
+    """
+    Returns the time_key of the first millisecond of a month, the
+      lower bound of its partitions.
+    """
+
+    first = datetime.datetime(year + (month - 1) // 12,
+                              (month - 1) % 12 + 1, 1)
+    return (first - EPOCH) // datetime.timedelta(milliseconds=1)
+
+
+def partition_name(table, year, month):
+
+    """
+    Returns the name of a table's partition for a month, for example
+      songplays_y2018m11.
+    """
+
+    return f'{table}_y{year:04d}m{month:02d}'
+
+
+def ensure_partitions(cursor, table, months):
+
+    """
+    Creates any of the partitions of 'table' for 'months' that don't
+      exist yet, committing the loading transaction first if one is
+      open.
+
+    Parameters:
+
+     - cursor: the loading cursor, whose transaction is committed
+     - table: 'songplays' or 'time'
+     - months: iterable of (year, month) tuples
+
+    Returns: none
+
+    """
+
+    missing = [(year, month) for year, month in sorted(set(months))
+               if partition_name(table, year, month) not in known_partitions]
+    if not missing:
+        return
+    commit_transaction(cursor)
+    connection = connection_pool.getconn()
+    try:
+        connection.set_session(autocommit=True)
+        cursor = connection.cursor()
+        for year, month in missing:
+            partition = partition_name(table, year, month)
+            try:
+                cursor.execute(partition_create.format(partition=partition,
+                                                       table=table),
+                               (month_time_key(year, month),
+                                month_time_key(year, month + 1)))
+                run_stats.add('partitions_created')
+                logging.info(
+                    f'\n'
+                    f'  Partition {partition} created\n'
+                    f'{UNDERLINE_3}'
+                    )
+            except psycopg2.Error:
+                """
+                  Another process may have just created it.
+                """
+                load_partitions(cursor)
+                if partition not in known_partitions:
+                    raise
+            known_partitions.add(partition)
+        cursor.close()
+    finally:
+        connection_pool.putconn(connection)
+
+
+def insert_partitioned(cursor, table, query, records):
+
+    """
+    insert_batch for the songplays and time records, whose first
+      fields are time_key and start_time: when 'table' is partitioned
+      the records are inserted month by month into its partitions.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+     - table: 'songplays' or 'time'
+     - query: the INSERT query for 'table' from sql_queries.py
+     - records: a list of tuples, one per row
+
+    Returns: the number of rows the database reports as inserted
+
+    """
+
+    if table not in partitioned_tables:
+        return insert_batch(cursor, query, records)
+    by_month = {}
+    for record in records:
+        by_month.setdefault((record[1].year, record[1].month),
+                            []).append(record)
+    ensure_partitions(cursor, table, by_month)
+    inserted = 0
+    for (year, month), month_records in sorted(by_month.items()):
+        partition_query = query.replace(
+            f'INSERT INTO {table} ',
+            f'INSERT INTO {partition_name(table, year, month)} ', 1)
+        inserted += insert_batch(cursor, partition_query, month_records)
+    return inserted
+
+
+def add_time_keys(dataframe):
+
+    """
+    Adds the time_key and start_time columns shared by the time and
+      songplays records to a log file dataframe, computed once for
+      the whole batch.
+
+    Parameters:
+
+     - dataframe: dataframe of log file rows, with a 'ts' column in
+         milliseconds
+
+    Returns: the dataframe with a time_key column, 'ts' as a bigint
+      (int64), and a start_time column derived from it
+
+    """
+
+    time_keys = dataframe['ts'].astype('int64')
+    return dataframe.assign(time_key=time_keys,
+                            start_time=pd.to_datetime(time_keys, unit='ms'))
+
+
+def build_time_dataframe(dataframe):
+
+    """
+    Builds the time table records for a log file dataframe.
+
+    Every column is computed from the whole start_time column at once
+      using the .dt accessors, and repeated time_keys are dropped, so
+      each distinct time is only sent to the database once.
+
+    Parameters:
+
+     - dataframe: dataframe of log file rows, with the time_key and
+         start_time columns of add_time_keys
+
+    Returns: a dataframe with the time table columns, time_key,
+      start_time, hour, day, week, month, year, weekday
+
+    """
+
+    times = dataframe.drop_duplicates(subset=['time_key'])
+    start_times = times['start_time']
+    return pd.DataFrame({
+        'time_key': times['time_key'],
+        'start_time': start_times,
+        'hour': start_times.dt.hour,
+        'day': start_times.dt.day,
+        'week': start_times.dt.isocalendar().week.astype('int64'),
+        'month': start_times.dt.month,
+        'year': start_times.dt.year,
+        'weekday': start_times.dt.day_name()
+        })
+
+
+"""
+Transforms
+==========
+
+  The pandas work of the log stage, kept apart from the database work
+    so it can be timed on its own (see benchmarks/transforms.py):
+    add_time_keys and build_time_dataframe above and the functions
+    below take a dataframe and return a dataframe or a list of
+    records, without touching a cursor.
+"""
+
+SONGPLAY_STAGING_COLUMNS = ['time_key',
+                            'userId',
+                            'level',
+                            'song',
+                            'artist',
+                            'length',
+                            'sessionId',
+                            'location',
+                            'userAgent']
+
+
+def select_next_song_rows(dataframe):
+
+    """
+    Returns the rows of a log file dataframe whose page is NextSong.
+    """
+
+    return dataframe.loc[dataframe["page"] == "NextSong"]
+
+
+def build_user_dataframe(next_song_rows):
+
+    """
+    Builds the users table records for the NextSong rows of a log
+      file, one per userId.
+
+    Parameters:
+
+     - next_song_rows: dataframe of the NextSong rows from a log file
+
+    Returns: a dataframe with the users table columns, userId,
+      firstName, lastName, gender, level
+
+    """
+
+    return next_song_rows[['userId',
+                           'firstName',
+                           'lastName',
+                           'gender',
+                           'level']].drop_duplicates(subset=['userId'])
+
+
+def build_songplay_records(next_song_rows, resolved_ids):
+
+    """
+    Builds the songplay records for the NextSong rows of a log file.
+
+    Parameters:
+
+     - next_song_rows: dataframe of the NextSong rows from a log file
+     - resolved_ids: list with a (song_id, artist_id) tuple, or None,
+         for each row, see resolve_song_ids and select_song_ids
+
+    Returns: a list of (time_key, start_time, user_id, level, song_id,
+      artist_id, session_id, location, user_agent) tuples
+
+    """
+
+    """
+      REMEMBER: - Table 'songplays' has fields:
+           songplay_id, time_key, start_time, user_id, level,
+             song_id, artist_id, session_id, location, user_agent
+
+      time_key and start_time are the columns add_time_keys derived
+        from 'ts' for the whole batch, the same values the time
+        table records are built from.
+    """
+    time_keys = next_song_rows['time_key'].tolist()
+    start_times = next_song_rows['start_time'].astype(object)
+    songplay_records = []
+    for time_key, start_time, row, response in zip(
+            time_keys,
+            start_times,
+            next_song_rows.itertuples(index=False),
+            resolved_ids):
+        song_id, artist_id = response if response else (None, None)
+        songplay_records.append(tuple([
+                            time_key,
+                            start_time,
+                            row.userId,
+                            row.level,
+                            song_id,
+                            artist_id,
+                            row.sessionId,
+                            row.location,
+                            row.userAgent
+                            ]))
+    return songplay_records
+
+
+def build_songplay_staging_records(next_song_rows):
+
+    """
+    Builds the records COPYed into songplays_staging, with the columns
+      of songplay_staging_copy in sql_queries.py.
+    """
+
+    return list(next_song_rows[SONGPLAY_STAGING_COLUMNS].itertuples(
+        index=False, name=None))
+
+
+"""
+  Task #5 (songplays) can be loaded one row at a time ('insert') or
+    a log file at a time through a staging table ('staged'), main
+    sets this from the --songplay-loader option.
+"""
+
+songplay_loader = 'insert'
+
+
+"""
+  With --chunk-rows N each log file is read N lines at a time and the
+    time, user and songplay stages run on each chunk in turn, so the
+    memory needed no longer grows with the size of the file. 0 reads
+    the whole file at once.
+"""
+
+log_chunk_rows = 0
+
+
+def read_log_file(filepath, stats=None):
+
+    """
+    Uses pandas to open the log file, yielding its contents as
+      dataframes: the whole file as one dataframe or, when
+      log_chunk_rows is set, one dataframe per log_chunk_rows lines.
+
+    Errors reading the file are logged and counted here, so a file
+      that can't be read simply yields nothing (more).
+
+    Parameters:
+
+     - filepath: the absolute path to the log file to be read
+     - stats: the RunStats to count in, None uses run_stats
+
+    Returns: a generator of dataframes
+
+    """
+
+    if stats is None:
+        stats = run_stats
+
+    try:
+        if log_chunk_rows:
+            dataframes = pd.read_json(filepath, lines=True,
+                                      chunksize=log_chunk_rows)
+        else:
+            dataframes = [pd.read_json(filepath, lines=True)]
+        for dataframe in dataframes:
+            logging.debug(
+                f'\n'
+                f'  File: {os.path.basename(filepath)}\n\n'
+                f'  Number of lines read:'
+                f'{len(dataframe.index)}\n\n'
+                f'Data fields (head):\n'
+                f'{dataframe.head()}\n\n'
+                f'Data fields (tail)\n'
+                f'{dataframe.tail()}\n\n'
+                f'{UNDERLINE_3}')
+            stats.add('rows_read', len(dataframe.index))
+            yield dataframe
     except OSError as ose:
-        handled_errors += 1
+        stats.add('handled_errors')
         logging.error(
             f'\n'
             f'  Something went wrong converting to a dataframe for:\n'
@@ -363,557 +1347,1660 @@ def process_log_file(cursor, filepath):
             f'  OS returned:\n\n{ose}\n'
             f'{UNDERLINE_1}\n')
     except ValueError as ve:
-        handled_errors += 1
+        stats.add('handled_errors')
         logging.error(
             f'\n'
             f'  A ValueError occurred converting to a dataframe for:\n'
             f'    {os.path.basename(filepath)}'
             f'  Error message is:\n\n{ve}\n'
             f'{UNDERLINE_1}\n')
-    except NameError as ne:
-        handled_errors += 1
-        logging.error(
-            f'\n'
-            f'  A NameError occurred convertingto a dataframe for:\n'
-            f'    {os.path.basename(filepath)}'
-            f'  Error message is:\n\n{ve}\n'
-            f'{UNDERLINE_1}\n')
     except Exception:       # recommedned by PEP8
-        handled_errors += 1
+        stats.add('handled_errors')
         logging.error(
             f'\n'
             f'  Some other non-OSError occurred reading:\n'
             f'    {os.path.basename(filepath)}'
             f'{UNDERLINE_1}\n')
 
+
+def process_log_file(cursor, filepath, parsed=None):
+
+    """
+    This processes one log file using pandas to open, convert (to a
+      dataframe) and process the contents.
+
+    NOTE: Unlike the songs files each log file contains multiple
+      lines of user activity data.
+
+    NOTE: When using pandas.read_json with a multiple lines of
+      json data per file, then it is necessary to specify
+      lines=True
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+     - filepath: the absolute path to the log file to be processed
+     - parsed: the list of dataframes read_log_file yields for the
+         file, when a --readers thread has already read it
+
+    Returns: none
+
+    """
+
+    logging.debug(f'\n\
+      Entering process_log_file for: \
+      {os.path.basename(filepath)}\n{UNDERLINE_3}')
+
+    reset_peak_rss()
+    lines = 0
+    if parsed is None:
+        parsed = read_log_file(filepath)
+    for dataframe in parsed:
+        lines += len(dataframe.index)
+        process_log_dataframe(cursor, dataframe, filepath)
+
+    peak_rss = read_peak_rss()
+    run_stats.peak('peak_rss_kb', peak_rss)
+    logging.info(
+        f'\n'
+        f'  {os.path.basename(filepath)}: {lines} lines, '
+        f'peak RSS {peak_rss / 1024:.1f} MB\n'
+        f'{UNDERLINE_3}'
+        )
+    logging.debug(
+        f'\n'
+        f'  process_log_file complete for file: '
+        f'{os.path.basename(filepath)} \n'
+        f'{UNDERLINE_3}'
+        )
+
+
+def process_log_dataframe(cursor, dataframe, filepath):
+
+    """
+    Runs the time, user and songplay stages (tasks #3, #4 and #5) on
+      a dataframe holding all, or a chunk, of a log file.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+     - dataframe: dataframe of log file rows
+     - filepath: the path of the log file, for logging
+
+    Returns: none
+
+    """
+
+    """
+      Filter by NextSong action to remove unwanted data
+
+      NOTE: This is placing quite a lot of data in memory, so
+        perhaps expect problems if the log files are huge ...
+        ... which is what --chunk-rows is for.
+
+      The time_key and start_time shared by the time and songplays
+        records are added first, so they're computed once for the
+        batch and the NextSong rows have them too.
+    """
+
+    try:
+        dataframe = add_time_keys(dataframe)
+        next_song_rows = select_next_song_rows(dataframe)
+        logging.debug(
+            f'\n'
+            f'  Filtering records where page == NextSong for:\n'
+            f'    dataframe from: {os.path.basename(filepath)}\n'
+            f'  Rows found: {len(next_song_rows.index)}\n\n'
+            f'Data fields (head):\n'
+            f'{next_song_rows.head()}\n\n'
+            f'Data fields (tail)\n'
+            f'{next_song_rows.tail()}\n\n'
+            f'{UNDERLINE_3}'
+            )
+    except OSError as ose:
+        run_stats.add('handled_errors')
+        logging.error(
+            f'\n'
+            f'  Something went wrong filtering rows in: \n'
+            f'    dataframe from: {os.path.basename(filepath)}\n'
+            f'  OS returned:\n\n{ose}\n\n'
+            f'{UNDERLINE_3}'
+            )
+    except ValueError as ve:
+        run_stats.add('handled_errors')
+        logging.error(
+            f'\n'
+            f'  A ValueError occurred filtering rows in: \n'
+            f'    dataframe from: {os.path.basename(filepath)}\n'
+            f'  Error message is:\n\n{ve}\n\n'
+            f'{UNDERLINE_3}'
+            )
+    except NameError as ne:
+        run_stats.add('handled_errors')
+        logging.error(
+            f'\n'
+            f'  A NameError occurred filtering rows in: \n'
+            f'    dataframe from: {os.path.basename(filepath)}\n'
+            f'  Error message is:\n\n{ne}\n\n'
+            f'{UNDERLINE_3}'
+            )
+    except Exception:       # recommedned by PEP8
+        run_stats.add('handled_errors')
+        logging.error(
+            f'\n'
+            f'Some error occurred filtering rows in:\n'
+            f'    dataframe from: {os.path.basename(filepath)}\n'
+            f'{UNDERLINE_3}'
+            )
+
+    """
+      DEVELOPEMNT DEBUG --- Check for sensible looking user table data
+      vvvvvvvvvvvvvvvvv
+
+      Built only when DEBUG logging is on, as iterrows is slow.
+    """
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        log_string = (
+            f'\n'
+            f'  Extracting required data fields (for debugging ONLY):\n\n'
+            )
+        for index, row in next_song_rows.iterrows():
+            log_string += (
+                f'{index} --- '
+                f' User ID: {row["userId"]},'
+                f' Name: {row["firstName"]} {row["lastName"]},'
+                f' Gender: {row["gender"]},'
+                f' Level: {row["level"]}'
+                f'\n'
+                )
+        log_string += f'{UNDERLINE_3}'
+        logging.debug(log_string)
+    """
+      ^^^^^^^^^^^^^^^^^
+      End of DEVELOPMENT DEBUG
+    """
+
+    """
+      Task #3: Populate Time Table
+      ============================
+
+        NOTE a): Further reading ...
+          Apparently, appending rows to a dataframe one at a time is
+           incredibly slow which may be why the Jupyter notebook
+           (eti.pynb) suggests making a dictionary of all the records
+           first, then convert that to a dataframe and submit that to
+           psycopg2.
+
+        NOTE b): Building that dictionary with iterrows and a
+          pd.to_datetime call per row turned out to be the slow part
+          on large log files, so build_time_dataframe now works on
+          the whole start_time column at once using the .dt
+          accessors and drops repeated time_keys before they reach
+          the database.
+
+        NOTE c): The records are then written with insert_batch, a
+          few multi-row INSERTs rather than one INSERT per record.
+    """
+    with run_stats.stage('time') as time_stage:
+        time_stage['rows_in'] += len(dataframe.index)
+        try:
+            time_dataframe = build_time_dataframe(dataframe)
+            logging.debug(
+                f'\n'
+                f'Time data dataframe ...\n'
+                f'{time_dataframe.head().to_string()}\n'
+                f'{UNDERLINE_3}'
+                )
+        except Exception:       # recommedned by PEP8
+            run_stats.add('handled_errors')
+            logging.error(
+                f'\n'
+                f'  An error occurred when building the time dataframe '
+                f'for:\n'
+                f'    {os.path.basename(filepath)}\n'
+                f'{UNDERLINE_3}'
+                )
+            time_dataframe = pd.DataFrame()
+
+        run_stats.add('time_duplicates',
+                      len(dataframe.index) - len(time_dataframe.index))
+        try:
+            saved = insert_partitioned(cursor, 'time',
+                                       time_table_batch_insert,
+                                       dataframe_records(time_dataframe))
+            run_stats.add('times_saved', saved)
+            run_stats.add('time_duplicates',
+                          len(time_dataframe.index) - saved)
+            logging.debug(
+                f'\n'
+                f'  {saved} time records added to the database\n'
+                f'{UNDERLINE_3}'
+                )
+        except psycopg2.Error as e:
+            run_stats.add('handled_errors')
+            logging.error(
+                f'\n'
+                f'  Error saving time data records\n {e}'
+                f'{UNDERLINE_3}'
+                )
+
+    """
+      Task #4: Populate User Table
+      ============================
+
+        Load user table ... try loading just the required columns from
+          the file ... more time than working from the full dataset,
+          but less memory!
+
+        WARNING!!! - This works using a csv file, but not with JSON
+          ... this is as documented but I still wonder why??
+
+        So, create a new user_dataframe from the next_song_rows
+          dataframe
+
+        NOTE: You need to be logged in to request a next-song, so
+                we'll still get all the users.
+
+    """
+    with run_stats.stage('users') as user_stage:
+        user_stage['rows_in'] += len(next_song_rows.index)
+        try:
+            """
+              If we don't want duplicate user records in the database ...
+
+              NOTE: This will ONLY stop us creating duplicate user
+                records from a given file. We need a constraint on the
+                database when we create it fully to prevent duplicates.
+
+              Nonetheless: not attempting to save know duplicates
+                will save resources.
+            """
+            user_dataframe = build_user_dataframe(next_song_rows)
+            logging.debug (
+                f'\n'
+                f'  Extracting a user-dataframe from file: '
+                f'{os.path.basename(filepath)}\n\n'
+                f'  Number of lines read: {len(user_dataframe.index)}\n\n'
+                f'User data fields (head):\n'
+                f'{user_dataframe.head().to_string()}\n\n'
+                f'User data fields (tail)\n'
+                f'{user_dataframe.tail().to_string()}\n\n'
+                f'{UNDERLINE_3}'
+                )
+        except OSError as ose:
+            run_stats.add('handled_errors')
+            logging.error(
+                f'\n'
+                f'  Something went wrong creating a sub-dataframe for '
+                f'users.'
+                f'\nOS returned:\n\n{ose}\n\n'
+                f'{UNDERLINE_3}'
+                )
+        except ValueError as ve:
+            run_stats.add('handled_errors')
+            logging.error(
+                f'\n'
+                f'  A ValueError occurred creating a sub-dataframe for '
+                f'users.'
+                f'\nError message is:\n\n{ve}\n\n'
+                f'{UNDERLINE_3}'
+                )
+        except NameError as ne:
+            run_stats.add('handled_errors')
+            logging.error(
+                f'\n'
+                f'  A NameError occurred creating a sub-dataframe for '
+                f'users.'
+                f'\nError message is:\n\n{ne}\n\n'
+                f'{UNDERLINE_3}'
+                )
+        except Exception:       # recommedned by PEP8
+            run_stats.add('handled_errors')
+            logging.error(
+                f'\n'
+                f'  Some error occurred creating a sub-dataframe for '
+                f'users.\n\n'
+                f'{UNDERLINE_3}'
+                )
+        """
+          Insert the user records as a batch. The ON CONFLICT clause
+            updates the level of users already in the table, so every
+            record counts as saved.
+        """
+        try:
+            saved = insert_batch(cursor, user_table_batch_insert,
+                                 dataframe_records(user_dataframe))
+            run_stats.add('users_saved', saved)
+            run_stats.add('user_duplicates', len(user_dataframe.index) - saved)
+            logging.debug(
+                f'\n'
+                f'  {saved} user records saved to the database\n'
+                f'{UNDERLINE_3}'
+                )
+        except psycopg2.Error as e:
+            run_stats.add('handled_errors')
+            logging.error(
+                f'\n'
+                f'  Error saving user data records\n {e}'
+                f'{UNDERLINE_3}'
+                )
+
+    """
+      Task #5: Populate 'songplays' Table
+      ===================================
+
+        FROM etl.ipynb ...
+        ===================
+          This one is a little more complicated since information
+          from the songs table, artists table, and original log file
+          are all needed for the songplays table. Since the log file
+          does not specify an ID for either the song or the artist,
+          you'll need to get the song ID and artist ID by querying
+          the songs and artists tables to find matches based on song
+          title, artist name, and song duration time.
+
+       For each row in the dataframe (the dataframe derived from
+         log files!!) ... or, with --songplay-loader staged, for all
+         of the rows at once.
+    """
+    with run_stats.stage('songplays') as songplay_stage:
+        songplay_stage['rows_in'] += len(next_song_rows.index)
+        if songplay_loader == 'staged':
+            load_songplays_staged(cursor, next_song_rows)
+        else:
+            load_songplays_per_row(cursor, next_song_rows)
+
+
+"""
+In-memory song/artist lookup
+============================
+
+  With --song-lookup index, the (title, artist name, duration) ->
+    (song_id, artist_id) pairs that song_select would find are loaded
+    into a dictionary once and each log file is resolved with
+    dictionary lookups instead of a query per NextSong row.
+
+  With --song-lookup lru, catalogs too big to hold in full are served
+    by a bounded functools.lru_cache wrapped around song_select, so
+    only the most recently used keys (found or not) are held.
+
+  Both are reloaded/cleared whenever songs_saved shows that rows have
+    been added to the songs table since they were built.
+
+  NOTE: duration is keyed as a float, which compares the same way as
+    song_select's 'duration = (%s)' with a float parameter.
+
+  NOTE: the lru cache keeps its own hit and miss counts, which
+    count_song_lookup_cache adds to run_stats.
+"""
+
+SONG_LOOKUP_CACHE_SIZE = 100000
+
+song_lookup = 'query'
+song_lookup_cache_size = SONG_LOOKUP_CACHE_SIZE
+
+song_index = None
+
+song_lookup_cached = None
+song_lookup_counted = (0, 0)
+song_lookup_songs_saved = None
+
+
+def song_lookup_key(title, artist, duration):
+
+    """
+    Builds the dictionary key used by the in-memory song lookup.
+
+    Parameters:
+
+     - title: song title
+     - artist: artist name
+     - duration: song duration (float, Decimal or None)
+
+    Returns: a (title, artist, duration) tuple
+
+    """
+
+    return (title, artist,
+            None if duration is None else float(duration))
+
+
+def load_song_index(cursor):
+
+    """
+    Loads every (title, artist name, duration) -> (song_id,
+      artist_id) pair from the songs and artists tables into the
+      song_index dictionary.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+
+    Returns: none
+
+    """
+
+    global song_index
+
+    start = time.perf_counter()
+    cursor.execute(song_index_select)
+    song_index = dict()
+    for title, name, duration, song_id, artist_id in cursor:
+        song_index.setdefault(song_lookup_key(title, name, duration),
+                              (song_id, artist_id))
+    logging.info(
+        f'\n'
+        f'  Song lookup index loaded: {len(song_index)} keys in '
+        f'{time.perf_counter() - start:.3f}s\n'
+        f'{UNDERLINE_3}'
+        )
+
+
+def prepare_song_lookup(cursor):
+
+    """
+    Makes sure the in-memory song lookup selected by song_lookup is
+      ready and up to date with the songs table, (re)building it if
+      songs have been saved since it was last built.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+
+    Returns: none
+
+    """
+
+    global song_lookup_cached
+    global song_lookup_counted
+    global song_lookup_songs_saved
+
+    if song_lookup_songs_saved == run_stats['songs_saved']:
+        return
+
+    if song_lookup == 'index':
+        load_song_index(cursor)
+    elif song_lookup == 'lru':
+        count_song_lookup_cache()
+        def lookup(title, artist, duration):
+            execute_isolated(cursor, song_select,
+                             tuple([title, artist, duration]), rows=0)
+            return cursor.fetchone()
+        song_lookup_cached = functools.lru_cache(
+            maxsize=song_lookup_cache_size)(lookup)
+        song_lookup_counted = (0, 0)
+    song_lookup_songs_saved = run_stats['songs_saved']
+
+
+def count_song_lookup_cache():
+
+    """
+    Adds the hits and misses of the lru song lookup cache since they
+      were last counted to run_stats.
+
+    Parameters: none
+
+    Returns: none
+
+    """
+
+    global song_lookup_counted
+
+    if song_lookup_cached is None:
+        return
+    info = song_lookup_cached.cache_info()
+    hits, misses = song_lookup_counted
+    run_stats.add('song_lookup_hits', info.hits - hits)
+    run_stats.add('song_lookup_misses', info.misses - misses)
+    song_lookup_counted = (info.hits, info.misses)
+
+
+def resolve_song_ids(cursor, next_song_rows):
+
+    """
+    Finds the (song_id, artist_id) pair for every NextSong row using
+      the in-memory lookup selected by song_lookup.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+     - next_song_rows: dataframe of the NextSong rows from a log file
+
+    Returns: a list with a (song_id, artist_id) tuple, or None, for
+      each row in next_song_rows ... or None when song_lookup is
+      'query' and the rows should be resolved with song_select.
+
+    """
+
+    if song_lookup == 'query':
+        return None
+
+    prepare_song_lookup(cursor)
+
+    keys = zip(next_song_rows['song'], next_song_rows['artist'],
+               next_song_rows['length'])
+
+    if song_lookup == 'index':
+        resolved_ids = [song_index.get(song_lookup_key(*key))
+                        for key in keys]
+        found = sum(1 for response in resolved_ids if response)
+        run_stats.add('song_lookup_hits', found)
+        run_stats.add('song_lookup_misses', len(resolved_ids) - found)
+        return resolved_ids
+
+    resolved_ids = []
+    for key in keys:
+        try:
+            resolved_ids.append(song_lookup_cached(*song_lookup_key(*key)))
+        except psycopg2.Error as e:
+            run_stats.add('handled_errors')
+            resolved_ids.append(None)
+            logging.error(
+                f'\n'
+                f'  Error running select query for: {key}\n'
+                f'  Error reurned by psycopg2: \n'
+                f'    {e}\n'
+                f'{UNDERLINE_3}'
+                )
+    return resolved_ids
+
+
+def song_lookup_summary():
+
+    """
+    Describes the in-memory song lookup's hit rate for the end of
+      run summary.
+
+    Parameters: none
+
+    Returns: a summary string, empty when song_lookup is 'query'
+
+    """
+
+    if song_lookup == 'query' or songplay_loader == 'staged':
+        return ''
+    count_song_lookup_cache()
+    hits = run_stats['song_lookup_hits']
+    misses = run_stats['song_lookup_misses']
+    return (
+        f'  Song lookup ({song_lookup}) hits: {hits}, misses: {misses}, '
+        f'hit rate: {hits / max(hits + misses, 1):.1%}\n'
+        )
+
+
+def select_song_ids(cursor, next_song_rows):
+
+    """
+    Finds the (song_id, artist_id) pair for every NextSong row by
+      running song_select once per row.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+     - next_song_rows: dataframe of the NextSong rows from a log file
+
+    Returns: a list with a (song_id, artist_id) tuple, or None, for
+      each row in next_song_rows
+
+    With the pipeline backend the queries are all sent at once, in a
+      single pipeline, rather than one round trip per row.
+
+    """
+
+    if pg_pipeline.is_pipelined(cursor):
+        query_values = list(next_song_rows[['song', 'artist', 'length']]
+                            .itertuples(index=False, name=None))
+        try:
+            with isolated_batch(cursor):
+                return cursor.fetchone_each(song_select, query_values)
+        except psycopg2.Error as e:
+            run_stats.add('handled_errors')
+            logging.error(
+                f'\n'
+                f'  Error running {len(query_values)} pipelined select '
+                f'queries\n'
+                f'  Error reurned by psycopg2: \n'
+                f'    {e}\n'
+                f'{UNDERLINE_3}'
+                )
+            return [None] * len(query_values)
+
+    resolved_ids = []
+    for row in next_song_rows.itertuples(index=False):
+
+        """
+          Get song_id and artist_id from song and artist tables
+
+            Remember:
+              song_select = 'SELECT song_id, artist_id
+                             FROM songs JOIN artists
+                             ON songs.artist_id = artists.artist_id
+                             WHERE title = (%s)
+                             AND name = (%s)
+                             AND duration = (%s);
+        """
+        query_values = tuple([row.song, row.artist, row.length])
+        """
+          Check the composed sql query
+        """
+        logging.debug(
+            f'\n'
+            f'  Composed SQL query is: \n'
+            f'{cursor.mogrify(song_select, query_values)}\n'
+            f'{UNDERLINE_3}'
+            )
+        """
+          Execute the query
+        """
+        try:
+            execute_isolated(cursor, song_select, query_values, rows=0)
+            resolved_ids.append(cursor.fetchone())
+        except psycopg2.Error as e:
+            run_stats.add('handled_errors')
+            resolved_ids.append(None)
+            logging.error(
+                f'\n'
+                f'  Error running select query: \n'
+                f'    {cursor.mogrify(song_select, query_values)}\n'
+                f'  Error reurned by psycopg2: \n'
+                f'    {e}\n'
+                f'{UNDERLINE_3}'
+                )
+    return resolved_ids
+
+
+def load_songplays_per_row(cursor, next_song_rows):
+
+    """
+    Task #5 one row at a time: runs song_select (or the in-memory
+      lookup) for each NextSong row to find its song_id and
+      artist_id, then inserts all the songplay records as a batch.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+     - next_song_rows: dataframe of the NextSong rows from a log file
+
+    Returns: none
+
+    """
+
+    """
+      This runs for every file, or every --chunk-rows chunk, so what
+        it logs about the rows is at DEBUG level.
+    """
+    logging.debug(
+        f'\n'
+        f'  next_song_rows dataframe looks like this: \n\n'
+        f'{next_song_rows.head()}'
+        f'{UNDERLINE_3}'
+        )
+
+    """
+      REMEMBER it's the next_song_rows dataframe !!!
+
+        This has fields:
+          "artist":
+          "auth":
+          "firstName":
+          "gender":
+          "itemInSession":
+          "lastName":
+          "length":
+          "level":
+          "location":
+          "method"
+          "page":
+          "registration":
+          "sessionId":
+          "song":
+          "status":
+          "ts":
+          "userAgent":
+          "userId":
+    """
+    """
+      With --song-lookup index or lru the song and artist IDs come
+        from the in-memory lookup rather than a query per row.
+    """
+    resolved_ids = resolve_song_ids(cursor, next_song_rows)
+    if resolved_ids is None:
+        resolved_ids = select_song_ids(cursor, next_song_rows)
+
+    for row, response in zip(next_song_rows.itertuples(index=False),
+                             resolved_ids):
+        if response:                  # == if response is not None
+            logging.debug(
+                f'\n'
+                f'  For title: {row.song}, artist: {row.artist} IDs are: '
+                f'{response}\n'
+                f'{UNDERLINE_3}'
+                )
+            run_stats.add('song_select_finds')
+            run_stats.sample('song_select_responses', response)
+
+    """
+      Insert all the songplay records as a batch. Rows that would
+        repeat a (time_key, user_id) pair already in the table are
+        skipped by the database and counted as duplicates.
+    """
+    next_song_rows = intern_songplay_dimensions(next_song_rows)
+    songplay_records = build_songplay_records(next_song_rows,
+                                              resolved_ids)
+    try:
+        saved = insert_partitioned(cursor, 'songplays',
+                                   songplay_table_batch_insert,
+                                   songplay_records)
+        run_stats.add('songplays_saved', saved)
+        run_stats.add('songplays_duplicates',
+                      len(songplay_records) - saved)
+    except psycopg2.Error as e:
+        run_stats.add('handled_errors')
+        logging.error(
+            f'\n'
+            f'  Error saving songplay data records\n {e}'
+            f'{UNDERLINE_3}'
+            )
+
+
+def load_songplays_staged(cursor, next_song_rows):
+
     """
-      Filter by NextSong action to remove unwanted data
+    Task #5 as a set-based operation: COPYs all the NextSong rows of
+      a log file into the songplays_staging temporary table, then
+      resolves song_id and artist_id and fills the songplays table
+      with a single INSERT ... SELECT ... LEFT JOIN statement.
+
+    NOTE: time_key is the 'ts' field in milliseconds, as in the time
+      table, and start_time is derived from it in the database.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+     - next_song_rows: dataframe of the NextSong rows from a log file
+
+    Returns: none
 
-      NOTE: This is placing quite a lot of data in memory, so
-        perhaps expect problems if the log files are huge ...
     """
 
+    """
+      The staging table columns follow the songplays_staging_copy
+        query in sql_queries.py
+    """
+    next_song_rows = intern_songplay_dimensions(next_song_rows)
+    records = build_songplay_staging_records(next_song_rows)
+    if not records:
+        return
+
+    """
+      The INSERT ... SELECT leaves routing each row to its month to
+        the database, but the partitions have to exist first.
+    """
+    if 'songplays' in partitioned_tables:
+        start_times = next_song_rows['start_time']
+        ensure_partitions(cursor, 'songplays',
+                          zip(start_times.dt.year.tolist(),
+                              start_times.dt.month.tolist()))
+
     try:
-        next_song_rows = dataframe.loc[dataframe["page"] == "NextSong"]
+        with isolated_batch(cursor):
+            cursor.execute(songplay_staging_table_create)
+            cursor.execute(songplay_staging_truncate)
+            copy_records(cursor, songplay_staging_copy, records)
+            cursor.execute(songplay_staging_insert)
+            saved, finds = cursor.fetchone()
+        count_rows(cursor, saved)
+        run_stats.add('songplays_saved', saved)
+        run_stats.add('songplays_duplicates', len(records) - saved)
+        run_stats.add('song_select_finds', finds)
         logging.debug(
             f'\n'
-            f'  Filtering records where page == NextSong for:\n'
-            f'    dataframe from: {os.path.basename(filepath)}\n'
-            f'  Rows found: {len(next_song_rows.index)}\n\n'
-            f'Data fields (head):\n'
-            f'{next_song_rows.head()}\n\n'
-            f'Data fields (tail)\n'
-            f'{next_song_rows.tail()}\n\n'
-            f'{UNDERLINE_3}'
-            )
-    except OSError as ose:
-        handled_errors += 1
-        logging.error(
-            f'\n'
-            f'  Something went wrong filtering rows in: \n'
-            f'    dataframe from: {os.path.basename(filepath)}\n'
-            f'  OS returned:\n\n{ose}\n\n'
-            f'{UNDERLINE_3}'
-            )
-    except ValueError as ve:
-        handled_errors += 1
-        logging.error(
-            f'\n'
-            f'  A ValueError occurred filtering rows in: \n'
-            f'    dataframe from: {os.path.basename(filepath)}\n'
-            f'  Error message is:\n\n{ve}\n\n'
-            f'{UNDERLINE_3}'
-            )
-    except NameError as ne:
-        handled_errors += 1
-        logging.error(
-            f'\n'
-            f'  A NameError occurred filtering rows in: \n'
-            f'    dataframe from: {os.path.basename(filepath)}\n'
-            f'  Error message is:\n\n{ne}\n\n'
+            f'  Staged {len(records)} NextSong rows, saved {saved} '
+            f'songplays, {finds} with song and artist IDs\n'
             f'{UNDERLINE_3}'
             )
-    except Exception:       # recommedned by PEP8
-        handled_errors += 1
+    except psycopg2.Error as e:
+        run_stats.add('handled_errors')
         logging.error(
             f'\n'
-            f'Some error occurred filtering rows in:\n'
-            f'    dataframe from: {os.path.basename(filepath)}\n'
+            f'  Error loading staged songplay records\n {e}'
             f'{UNDERLINE_3}'
             )
 
+
+"""
+Interned dimensions
+===================
+
+  In the compact schema songplays refers to its location and user
+    agent by location_key and user_agent_key, the strings being
+    stored once each in the locations and user_agents tables (see
+    INTERNED DIMENSIONS in sql_queries.py). A log file repeats a
+    handful of them thousands of times.
+
+  Both schemas have the user_agents table, where each user agent is
+    stored with its browser, os and device. They're parsed when the
+    user agent is first written, so dimension_keys['user_agents']
+    is also the parse cache: a NextSong row whose user agent is
+    already in it is a hit, each new user agent a miss, parsed just
+    once. In the standard schema songplays keeps the user agent
+    string and the keys aren't used.
+
+  dimension_keys holds a dictionary of value -> key for each table,
+    read from the database at the start of the run
+    (load_dimension_keys), so only values never seen before are
+    written, by intern_values.
+
+  New values are written on a connection of their own, in
+    autocommit mode, as new partitions are: their keys are committed
+    whatever becomes of the batch being loaded, so the cache never
+    holds a key that was rolled back, and other worker processes can
+    use them straight away.
+"""
+
+DIMENSIONS = {
+    'locations': (location_keys_select, location_insert,
+                  location_new_keys_select),
+    'user_agents': (user_agent_keys_select, user_agent_insert,
+                    user_agent_new_keys_select)
+    }
+
+dimension_keys = {table: {} for table in DIMENSIONS}
+
+
+def dimension_tables():
+
     """
-      DEVELOPEMNT DEBUG --- Check for sensible looking user table data
-      vvvvvvvvvvvvvvvvv
+    Returns the names of the dimension tables etl.py fills, which
+      depend on the schema found at the start of the run.
     """
+
+    if compact_schema:
+        return list(DIMENSIONS)
+    return ['user_agents'] if user_agent_dimension else []
+
+
+def dimension_record(table, value):
+
     """
-    log_string = (
-        f'\n'
-        f'  Extracting required data fields (for debugging ONLY):\n\n'
-        )
-    for index, row in next_song_rows.iterrows():
-        log_string += (
-            f'{index} --- '
-            f' User ID: {row["userId"]},'
-            f' Name: {row["firstName"]} {row["lastName"]},'
-            f' Gender: {row["gender"]},'
-            f' Level: {row["level"]}'
-            f'\n'
-            )
-    log_string += f'{UNDERLINE_3}'
-    logging.debug(log_string)
+    Returns the record *_insert writes for a new value: user agents
+      are stored with their browser, os and device.
     """
+
+    if table == 'user_agents':
+        return (value, *parse_user_agent(value))
+    return (value,)
+
+
+def load_dimension_keys(cursor):
+
     """
-      ^^^^^^^^^^^^^^^^^
-      End of DEVELOPMENT DEBUG
+    Reads every value -> key pair of the dimension tables in use into
+      dimension_keys.
     """
 
+    for table in dimension_tables():
+        keys_select, _, _ = DIMENSIONS[table]
+        cursor.execute(keys_select)
+        dimension_keys[table] = dict(cursor.fetchall())
+
+
+def intern_values(table, values):
+
     """
-      Task #3: Populate Time Table
-      ============================
+    Returns the key of each value in a dimension table, first adding
+      the values that aren't in it yet.
 
-        NOTE a): Further reading ...
-          Apparently, appending rows to a dataframe one at a time is
-           incredibly slow which may be why the Jupyter notebook
-           (eti.pynb) suggests making a dictionary of all the records
-           first, then convert that to a dataframe and submit that to
-           psycopg2.
+    Parameters:
 
-        NOTE b): Running some tests on diffeent ways of doing things
-          seems to confirm this. Handling many dataframes each
-          containing one record seems very slow.
-
-        NOTE c) So, look at the format that we need to submit the
-          processed data to the database to decide a strategy.
-          We'll be using (something like):
-
-              for i, row in time_dataframe.iterrows():
-                   logging.debug(f'Row {i} list(row) is: {list(row)}')
-                   cursor.execute(time_table_insert, list(row))
-
-         We will want each row of our timedata_list to be a tuple of
-           the values of the field names:
-             i.e. start_time, hour, day, week, month, year, weekday
-                --- as specified in sql_queries.py
-
-        NOTE d): The steps in the process become:
-          (d1) - Set up a Python list to hold the time data records
-                   extracted from the file
-          (d2) - Loop over the dataframe derived from the input file,
-                   extracting the records we want
-          (d3) - Make a Python dictionary from each row in the
-                   dataframe
-          (d4) - Append that to the timedata list
-          (d5) - Use the list of dictionaries to make a new dataframe
-                   (pandas has a convenient method)
-          (d6) - Use the new dataframe to create database records
-                  (again pandas has a convenient method)
-
-    """
-    log_string = (
-        f'\n'
-        f'  Setting up a python list of python dictionaries for the'
-        f' time data ...\n'
-        )
+     - table: 'locations' or 'user_agents'
+     - values: list of strings, anything else (None, NaN) has no key
+
+    Returns: a list of integer keys, or None, one per value
 
     """
-      (d1) - Set up a Python list to hold the time data
-        records extracted from the file
+
+    keys = dimension_keys[table]
+    new_values = sorted({value for value in values
+                         if isinstance(value, str) and value not in keys})
+    found = sum(1 for value in values if isinstance(value, str))
+    run_stats.add(f'{table}_cache_hits', found - len(new_values))
+    run_stats.add(f'{table}_cache_misses', len(new_values))
+    if new_values:
+        _, insert, new_keys_select = DIMENSIONS[table]
+        connection = connection_pool.getconn()
+        try:
+            connection.set_session(autocommit=True)
+            cursor = connection.cursor()
+            psycopg2.extras.execute_values(
+                cursor, insert,
+                [dimension_record(table, value) for value in new_values],
+                page_size=len(new_values))
+            run_stats.add(f'{table}_interned', cursor.rowcount)
+            cursor.execute(new_keys_select, (new_values,))
+            keys.update(cursor.fetchall())
+            cursor.close()
+        finally:
+            connection_pool.putconn(connection)
+    return [keys.get(value) if isinstance(value, str) else None
+            for value in values]
+
+
+def intern_songplay_dimensions(next_song_rows):
+
+    """
+    Returns a copy of the NextSong rows with the location and
+      userAgent strings replaced by their keys, for the compact
+      schema's songplays. In the standard schema only the user agents
+      are written to their dimension, and the rows are returned as
+      they are.
     """
-    timedata_list = list()
+
+    if not compact_schema:
+        if user_agent_dimension:
+            intern_values('user_agents',
+                          next_song_rows['userAgent'].tolist())
+        return next_song_rows
+
+    interned = {}
+    for column, table in (('location', 'locations'),
+                          ('userAgent', 'user_agents')):
+        interned[column] = pd.Series(
+            intern_values(table, next_song_rows[column].tolist()),
+            index=next_song_rows.index, dtype=object)
+    return next_song_rows.assign(**interned)
+
+
+"""
+Load manifest
+=============
+
+  Each file that is processed without a handled error is recorded in
+    the load_manifest table with its size, mtime and a hash of its
+    contents. Later runs skip files whose size and mtime, or failing
+    that content hash, match their manifest entry, so only new or
+    modified files are reprocessed. --full processes every file
+    regardless.
+
+  A file whose content hash is worked out while selecting the files
+    isn't hashed again: the hash waits in selected_hashes for
+    process_file, or for the worker that loads the file. A file that
+    has only been touched gets its new size and mtime written to the
+    manifest (from manifest_touched, at the end of process_data), so
+    later runs skip it on the cheap size and mtime check.
+
+  NOTE: files buffered by the bulk COPY song loader aren't in the
+    database until their batch is flushed, so their entries wait in
+    manifest_pending and are written in the same transaction as the
+    batch.
+"""
+
+full_reload = False
+manifest_pending = []
+manifest_touched = []
+selected_hashes = {}
+
+
+def load_manifest(cursor):
 
     """
-      (d2) - Loop over the dataframe derived from the input file,
-               extracting the records we want
+    Reads the load_manifest table, creating it first if this database
+      was built before it was added.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+
+    Returns: a dictionary of path -> (size, mtime, content_hash)
+
     """
 
-    log_string += (
-        f'    ... extracting time data for each record\n\n'
-        )
-    loopcount = 0
-    try:
-        for index, row in dataframe.iterrows():
-            as_datetime = pd.to_datetime(row["ts"], unit="ms")
-            """
-              (d3) - Make a Python dictionary from each row in
-                the dataframe
-            """
-            time_dict = dict()
-            time_dict["start_time"] = as_datetime
-            time_dict["hour"] = as_datetime.hour
-            time_dict["day"] = as_datetime.day
-            time_dict["week"] = as_datetime.week
-            time_dict["month"] = as_datetime.month
-            time_dict["year"] = as_datetime.year
-            time_dict["weekday"] = as_datetime.day_name()
-            """
-              Add to the log_string for each record processed
-            """
-            log_string += (
-                f'Time (in ms): {row["ts"]}  '
-                f'Start time: {time_dict["start_time"]}  '
-                f'Hour: {time_dict["hour"]}  '
-                f'Day: {time_dict["day"]}  '
-                f'Week number: {time_dict["week"]}  '
-                f'Month: {time_dict["month"]}  '
-                f'Year: {time_dict["year"]}  '
-                f'Weekday: {time_dict["weekday"]}  '
-                f'\n'
-                )
-            loopcount += 1
-            """
-              (d4) - Append that to the timedata list
+    cursor.execute(load_manifest_table_create)
+    cursor.execute(load_manifest_select)
+    return {path: (size, mtime, content_hash)
+            for path, size, mtime, content_hash in cursor}
+
+
+def file_content_hash(datafile):
 
-                !! Dangerous Python indentation ... easy to get the
-                     next statement outside the loop!!
-            """
-            timedata_list.append(time_dict)
-        log_string += (
-            f'\n  Number of records processed: {loopcount}\n'
-            f'\n  Number of records added to timedata_list: '
-            f'{len(timedata_list)}\n'
-            f'{UNDERLINE_3}'
-            )
-        logging.debug(UNDERLINE_3)
-    except Exception:       # recommedned by PEP8
-        handled_errors += 1
-        logging.error(
-            f'\n'
-            f'  An error occurred when extracting data to the '
-            f'time_dict:\n'
-            f'{UNDERLINE_3}')
     """
-      (d5) - Use the list of dictionaries to make a new
-               dataframe (pandas has a convenient method)
+    Returns the sha256 hex digest of the contents of 'datafile'.
     """
-    try:
-        time_dataframe = pd.DataFrame.from_records(timedata_list)
-        logging.debug(
-            f'\n'
-            f'Time data dataframe ...\n'
-            f'{time_dataframe.to_string()}\n'
-            f'{UNDERLINE_3}'
-            )
-    except Exception:       # recommedned by PEP8
-        handled_errors += 1
-        logging.error(
-            f'\n'
-            f'  An error occurred when converting time_dict to a '
-            f'dataframe:\n'
-            f'{UNDERLINE_3}'
-            )
-    """"
-      (d6) - Use the new dataframe to create database records
-               (again pandas has a convenient method)
+
+    digest = hashlib.sha256()
+    with open(datafile, 'rb') as data:
+        for block in iter(lambda: data.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def select_files_to_load(all_files, manifest):
+
     """
-    loopcount = 0
-    log_string = (
-        f'\n'
-        f'  Inserting time data rows into database ...\n\n'
-        )
-    for i, row in time_dataframe.iterrows():
+    Filters out the files that are unchanged since they were
+      recorded in the manifest, unless full_reload is set.
+
+    A file is unchanged if its size and mtime match the manifest; if
+      they don't, the content hash is compared so that a file which
+      has only been touched is still skipped, and its new size and
+      mtime are added to manifest_touched. The hash of a file that
+      has changed is kept in selected_hashes.
+
+    Parameters:
+
+     - all_files: iterable of absolute file paths
+     - manifest: dictionary returned by load_manifest
+
+    Returns: a generator of the files that need to be processed
+
+    """
+
+    for datafile in all_files:
+        if full_reload:
+            yield datafile
+            continue
+        entry = manifest.get(datafile)
+        if entry is not None:
+            size, mtime, content_hash = entry
+            status = os.stat(datafile)
+            if status.st_size == size and status.st_mtime == mtime:
+                run_stats.add('files_skipped')
+                continue
+            digest = file_content_hash(datafile)
+            if digest == content_hash:
+                manifest_touched.append((datafile, status.st_size,
+                                         status.st_mtime, digest))
+                run_stats.add('files_skipped')
+                continue
+            selected_hashes[datafile] = digest
+        yield datafile
+
+
+def record_loaded_files(cursor, entries):
+
+    """
+    Writes (path, size, mtime, content_hash) entries to the
+      load_manifest table.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+     - entries: list of (path, size, mtime, content_hash) tuples
+
+    Returns: none
+
+    """
+
+    for entry in entries:
+        execute_isolated(cursor, load_manifest_upsert, entry)
+
+
+def process_file(cursor, func, datafile, parsed=None):
+
+    """
+    Applies 'func' to one file and records the file in the load
+      manifest if that didn't add to handled_errors. With
+      --commit-every file, or any --commit-every in a worker process,
+      this is where each file is committed.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+     - func: the function to be applied to the file
+     - datafile: absolute path to the file
+     - parsed: (records, RunStats) from parse_file when a --readers
+         thread has parsed the file, None parses it here
+
+    Returns: none
+
+    """
+
+    errors_before = run_stats['handled_errors']
+    content_hash = selected_hashes.pop(datafile, None)
+    status = os.stat(datafile)
+    if parsed is None:
+        func(cursor, datafile)
+    else:
+        records, parse_stats = parsed
         try:
-            log_string += (
-                f'(Time) Row {i} list(row) is: {list(row)}\n'
-                )
-            cursor.execute(time_table_insert, list(row))
-            times_saved += 1
-            loopcount += 1
-        except psycopg2.Error as e:
-            if ('duplicate key' in str(e)):
-                time_duplicates += 1
-                logging.warning(
-                    f'\n'
-                    f'Database reports a duplicate key for time: '
-                    f'{list(row)[0]}\n'
-                    f'{UNDERLINE_3}'
-                    )
-            else:
-                handled_errors += 1
+            func(cursor, datafile, records)
+        finally:
+            run_stats.merge(parse_stats)
+    run_stats.add('files_processed')
+    run_stats.add('bytes_read', status.st_size)
+
+    if run_stats['handled_errors'] == errors_before:
+        if content_hash is None:
+            content_hash = file_content_hash(datafile)
+        entry = (datafile, status.st_size, status.st_mtime, content_hash)
+        if func is process_song_file_copy:
+            manifest_pending.append(entry)
+        else:
+            try:
+                record_loaded_files(cursor, [entry])
+            except psycopg2.Error as e:
+                run_stats.add('handled_errors')
                 logging.error(
                     f'\n'
-                    f'  Error saving time data record\n {e}'
+                    f'  Error recording {os.path.basename(datafile)} in '
+                    f'the load manifest\n'
+                    f'    {e}\n'
                     f'{UNDERLINE_3}'
                     )
-    log_string += (
-        f'\n\n  '
-        f'{loopcount} records added to the database\n'
-        f'{UNDERLINE_3}'
-        )
-    logging.debug(log_string)
 
-    """
-      Task #4: Populate User Table
-      ============================
+    if commit_every == 'file' or commit_each_file:
+        commit_transaction(cursor)
+
+
+"""
+File discovery
+==============
+
+  discover_files walks the data directory with os.scandir and yields
+    matching files as it finds them, so processing can start while
+    the scan continues and the full list of files is never held in
+    memory. Each directory's entries are sorted by name, which gives
+    the same depth-first order on every run.
+
+  --patterns sets the file name patterns, for example '*.json.gz' to
+    include compressed files, which pandas decompresses according to
+    their extension.
+"""
+
+FILE_PATTERNS = ['*.json']
+
+file_patterns = FILE_PATTERNS
+
+
+def discover_files(filepath, patterns):
+
+    """
+    Recursively scans 'filepath' for files whose names match any of
+      'patterns', in sorted order.
+
+    Parameters:
+
+     - filepath: the directory to scan
+     - patterns: list of fnmatch style file name patterns
+
+    Returns: a generator of absolute file paths
+
+    """
+
+    try:
+        with os.scandir(filepath) as scan:
+            entries = sorted(scan, key=lambda entry: entry.name)
+    except OSError as ose:
+        logging.error(
+            f'\n'
+            f'  Could not scan directory: {filepath}\n'
+            f'  OS returned:\n\n{ose}\n'
+            f'{UNDERLINE_3}'
+            )
+        return
+
+    for entry in entries:
+        if entry.is_dir():
+            yield from discover_files(entry.path, patterns)
+        elif any(fnmatch.fnmatch(entry.name, pattern)
+                 for pattern in patterns):
+            yield os.path.abspath(entry.path)
+
+
+"""
+Parallel ingestion
+==================
+
+  With --workers N, process_data hands the files it finds to a pool
+    of N worker processes, WORKER_TASK_FILES at a time (a whole batch
+    of the COPY song loader at a time for that loader). Each worker
+    opens its own connection when it starts, processes each task with
+    the same function and settings as the serial path and returns
+    a RunStats for that task, which is merged into run_stats in
+    this (the parent) process.
+
+  The pool is started by the first process_data call and kept until
+    main calls shutdown_workers at the end of the run, so the log
+    stage reuses the worker processes, and their warm connections,
+    from the song stage. The settings are sent with each task, as
+    main changes some between the stages.
+
+  No more than two tasks per worker are queued at a time, so the
+    directory scan only runs as far ahead of the workers as needed.
+
+  NOTE: the 'spawn' start method is used so that no worker inherits
+    the parent's open database connection.
+"""
+
+WORKER_TASK_FILES = 100
+
+WORKER_SETTINGS = ['song_copy_batch_size', 'songplay_loader',
+                   'song_lookup', 'song_lookup_cache_size',
+                   'log_chunk_rows', 'commit_every',
+                   'insert_page_size', 'database_backend', 'bulk_load',
+                   'partitioned_tables', 'compact_schema',
+                   'user_agent_dimension']
+
+worker_cursor = None
+worker_executor = None
+
+
+def start_worker(settings):
+
+    """
+    Runs once in each worker process: copies the parent's settings
+      and opens the connection used for every task in this worker.
+
+    Parameters:
+
+     - settings: dictionary of the WORKER_SETTINGS globals from the
+         parent process
+
+    Returns: none
+
+    """
+
+    global worker_cursor
+    global commit_each_file
+
+    globals().update(settings)
+    commit_each_file = commit_every is not None
+    if bulk_load:
+        use_bulk_load_queries()
+    if compact_schema:
+        use_compact_queries()
+
+    worker_connection = connect_sparkify()
+    worker_cursor = worker_connection.cursor(
+        cursor_factory=sql_trace.cursor_factory())
+    if partitioned_tables:
+        load_partitions(worker_cursor)
+    load_dimension_keys(worker_cursor)
+    multiprocessing.util.Finalize(worker_connection,
+                                  worker_connection.close,
+                                  exitpriority=10)
+
+
+def process_task(func, datafiles, settings, hashes):
+
+    """
+    Runs in a worker process: applies 'func' to each file in the
+      task using this worker's connection.
+
+    Parameters:
+
+     - func: process_song_file, process_song_file_copy or
+         process_log_file
+     - datafiles: list of absolute file paths for this task
+     - settings: dictionary of the WORKER_SETTINGS globals from the
+         parent process
+     - hashes: dictionary of path -> content hash for the files the
+         parent has already hashed (see selected_hashes)
+
+    Returns: a RunStats holding the counters for this task and the
+      sql_trace statement statistics (empty unless tracing)
+
+    """
+
+    global run_stats
+
+    globals().update(settings)
+    selected_hashes.update(hashes)
+
+    """
+      Counters start from zero for each task
+    """
+    run_stats = RunStats()
+
+    for datafile in datafiles:
+        process_file(worker_cursor, func, datafile)
+    flush_song_buffer(worker_cursor)
+    commit_transaction(worker_cursor)
+    count_song_lookup_cache()
+    run_stats.peak('peak_rss_kb', read_peak_rss())
+    return run_stats, sql_trace.take_statement_stats()
+
+
+def process_data_in_workers(datafiles, func, workers):
 
-        Load user table ... try loading just the required columns from
-          the file ... more time than working from the full dataset,
-          but less memory!
+    """
+    Hands the files from 'datafiles' to a pool of worker processes,
+      each task running process_task, then merges the RunStats and
+      statement statistics they return into run_stats and sql_trace.
 
-        WARNING!!! - This works using a csv file, but not with JSON
-          ... this is as documented but I still wonder why??
+    Parameters:
 
-        So, create a new user_dataframe from the next_song_rows
-          dataframe
+     - datafiles: iterable of absolute file paths
+     - func: the function to be applied to each file
+     - workers: number of worker processes
 
-        NOTE: You need to be logged in to request a next-song, so
-                we'll still get all the users.
+    Returns: the number of files processed
 
     """
-    try:
-        """
-          If we don't want duplicate user records in the database ...
 
-          NOTE: This will ONLY stop us creating duplicate user
-            records from a given file. We need a constraint on the
-            database when we create it fully to prevent duplicates.
+    settings = {name: globals()[name] for name in WORKER_SETTINGS}
+    task_files = WORKER_TASK_FILES
+    if func is process_song_file_copy:
+        task_files = song_copy_batch_size
 
-          Nonetheless: not attempting to save know duplicates
-            will save resources.
-        """
-        user_dataframe = next_song_rows[['userId',
-                                         'firstName',
-                                         'lastName',
-                                         'gender',
-                                         'level']].drop_duplicates(
-                                            subset=['userId'])
-        logging.debug (
-            f'\n'
-            f'  Extracting a user-dataframe from file: '
-            f'{os.path.basename(filepath)}\n\n'
-            f'  Number of lines read: {len(user_dataframe.index)}\n\n'
-            f'User data fields (head):\n'
-            f'{user_dataframe.head().to_string()}\n\n'
-            f'User data fields (tail)\n'
-            f'{user_dataframe.tail().to_string()}\n\n'
-            f'{UNDERLINE_3}'
-            )
-    except OSError as ose:
-        handled_errors += 1
-        logging.error(
-            f'\n'
-            f'  Something went wrong creating a sub-dataframe for '
-            f'users.'
-            f'\nOS returned:\n\n{ose}\n\n'
-            f'{UNDERLINE_3}'
-            )
-    except ValueError as ve:
-        handled_errors += 1
-        logging.error(
-            f'\n'
-            f'  A ValueError occurred creating a sub-dataframe for '
-            f'users.'
-            f'\nError message is:\n\n{ve}\n\n'
-            f'{UNDERLINE_3}'
+    def collect(future):
+        try:
+            task_stats, task_statements = future.result()
+        except Exception as e:       # recommedned by PEP8
+            run_stats.add('handled_errors')
+            logging.error(
+                f'\n'
+                f'  A worker failed processing {pending[future]} '
+                f'files\n'
+                f'    {e}\n'
+                f'{UNDERLINE_1}'
+                )
+            return 0
+        run_stats.merge(task_stats)
+        sql_trace.merge_statement_stats(task_statements)
+        return pending[future]
+
+    executor = start_workers(workers, settings)
+    files_done = 0
+    pending = {}
+    datafiles = iter(datafiles)
+    while True:
+        task = list(itertools.islice(datafiles, task_files))
+        if task:
+            hashes = {datafile: selected_hashes.pop(datafile)
+                      for datafile in task if datafile in selected_hashes}
+            pending[executor.submit(process_task, func, task,
+                                    settings, hashes)] = len(task)
+        if len(pending) < 2 * workers and task:
+            continue
+        if not pending:
+            break
+        done, _ = concurrent.futures.wait(
+            pending,
+            return_when=concurrent.futures.FIRST_COMPLETED
             )
-    except NameError as ne:
-        handled_errors += 1
-        logging.error(
+        for future in done:
+            files_done += collect(future)
+            del pending[future]
+        logging.info(
             f'\n'
-            f'  A NameError occurred creating a sub-dataframe for '
-            f'users.'
-            f'\nError message is:\n\n{ne}\n\n'
-            f'{UNDERLINE_3}'
+            f'  Worker tasks complete: {files_done} files processed.\n'
+            f'{UNDERLINE_2}'
             )
-    except Exception:       # recommedned by PEP8
-        handled_errors += 1
-        logging.error(
-            f'\n'
-            f'  Some error occurred creating a sub-dataframe for '
-            f'users.\n\n'
-            f'{UNDERLINE_3}'
+    return files_done
+
+
+def start_workers(workers, settings):
+
+    """
+    Returns the pool of worker processes, starting it on first use.
+
+    Parameters:
+
+     - workers: number of worker processes
+     - settings: the WORKER_SETTINGS the workers start with
+
+    Returns: a concurrent.futures.ProcessPoolExecutor
+
+    """
+
+    global worker_executor
+
+    if worker_executor is None:
+        worker_executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=start_worker,
+            initargs=(settings,)
             )
+    return worker_executor
+
+
+def shutdown_workers():
+
     """
-      Insert user records once again using the iterrows method
-        provided by pandas
+    Stops the pool of worker processes, if one was started, closing
+      their connections.
     """
-    log_string = (
-        f'\n'
-        f'  Inserting user data rows into database ...\n\n'
-        )
-    for i, row in user_dataframe.iterrows():
-        try:
-            log_string += (
-                f'(User) Row {i} list(row) is: {list(row)}\n'
-                )
-            cursor.execute(user_table_insert, list(row))
-            users_saved += 1
-        except psycopg2.Error as e:
-            if ('duplicate key' in str(e)):
-                user_duplicates += 1
-                logging.warning(
-                    f'\n'
-                    f'Database reports a duplicate key for user: '
-                    f'{list(row)[0:3]}\n'
-                    f'{UNDERLINE_3}'
-                    )
-            else:
-                handled_errors += 1
-                logging.error(
-                    f'\n'
-                    f'  Error saving user data record\n {e}'
-                    f'{UNDERLINE_3}'
-                    )
-    logging.debug(log_string)
+
+    global worker_executor
+
+    if worker_executor is not None:
+        worker_executor.shutdown()
+        worker_executor = None
+
+
+"""
+Pipelined ingestion
+===================
+
+  Processing a file alternates between parsing it, with the database
+    connection idle, and loading it, with the CPU waiting on the
+    database. With --readers N, process_data overlaps the two in one
+    process: N reader threads parse files (parse_file) while a
+    single writer thread, the only one using the cursor, loads them
+    in the order they were found.
+
+  The files in flight are held on a queue of at most
+    pipeline_queue_depth (--queue-depth) parsed files; when it is
+    full the directory scan waits, so the readers get no further
+    ahead of the writer and memory use stays bounded.
+
+  With --chunk-rows a log file isn't read whole before it is queued:
+    its reader hands the dataframes over one at a time, on a queue
+    of its own holding one chunk, and the writer loads each as it
+    arrives. So no more than a couple of chunks per reader are in
+    memory, whatever the size of the files, as without --readers.
+
+  Each side's busy and idle time is added to run_stats as
+    pipeline_reader_* and pipeline_writer_* seconds: idle readers
+    mean the database is the bottleneck, an idle writer means
+    parsing is.
+
+  NOTE: reader threads count into a RunStats of their own for each
+    file, which the writer merges once it has loaded the file and
+    before recording it, so a parse error still keeps that file out
+    of the load manifest.
+"""
+
+PIPELINE_QUEUE_DEPTH = 8
+
+pipeline_queue_depth = PIPELINE_QUEUE_DEPTH
+
+
+def parse_file(func, datafile, stats, chunks=None):
 
     """
-      Task #5: Populate 'songplays' Table
-      ===================================
+    Runs in a reader thread: parses a file for 'func' without
+      touching the database.
 
-        FROM etl.ipynb ...
-        ===================
-          This one is a little more complicated since information
-          from the songs table, artists table, and original log file
-          are all needed for the songplays table. Since the log file
-          does not specify an ID for either the song or the artist,
-          you'll need to get the song ID and artist ID by querying
-          the songs and artists tables to find matches based on song
-          title, artist name, and song duration time.
+    Parameters:
+
+     - func: process_song_file, process_song_file_copy or
+         process_log_file
+     - datafile: absolute path to the file
+     - stats: the RunStats to count in
+     - chunks: for a log file read --chunk-rows at a time, the queue
+         each dataframe is put on as it is read, followed by None
+
+    Returns: ((records, stats), seconds taken) where records is what
+      extract_song_data returns for a song file or the list of
+      dataframes read_log_file yields for a log file, None when they
+      were put on 'chunks'. Time spent waiting for room on 'chunks'
+      isn't counted.
 
-       For each row in the dataframe (the dataframe derived from
-         log files!!)
     """
-    log_string = (
-        f'\n'
-        f'Select all songs, just to make sure that there are some ...\n'
-        )
-    cursor.execute("SELECT song_id, title FROM songs")
-    for row in cursor:
-        log_string += (
-            f'{cursor.fetchone()}\n'
-            )
-    log_string += (UNDERLINE_2)
-    logging.info(log_string)
 
-    logging.warning(
-        f'\n'
-        f'  next_song_rows dataframe looks like this: \n\n'
-        f'{next_song_rows.head()}'
-        f'{UNDERLINE_3}'
-        )
+    start = time.perf_counter()
+    waited = 0
+    records = None
+    if chunks is not None:
+        try:
+            for dataframe in read_log_file(datafile, stats):
+                put_start = time.perf_counter()
+                chunks.put(dataframe)
+                waited += time.perf_counter() - put_start
+        except Exception:       # recommedned by PEP8
+            stats.add('handled_errors')
+            raise
+        finally:
+            chunks.put(None)
+    elif func is process_log_file:
+        records = list(read_log_file(datafile, stats))
+    else:
+        records = extract_song_data(datafile, stats)
+    return (records, stats), time.perf_counter() - start - waited
+
+
+def process_data_pipelined(cursor, datafiles, func, readers):
 
-    log_string = (
-        f'\n'
-        f'  Retrieving song and artist IDs using an SQL query ...\n\n'
-        )
     """
-      REMEMBER it's the next_song_rows dataframe !!!
+    Parses the files from 'datafiles' in 'readers' threads while a
+      writer thread loads them on 'cursor', through a bounded queue.
+
+    Parameters:
+
+     - cursor: a cursor object to the database
+     - datafiles: iterable of absolute file paths
+     - func: the function to be applied to each file
+     - readers: number of reader threads
+
+    Returns: the number of files processed
 
-        This has fields:
-          "artist":
-          "auth":
-          "firstName":
-          "gender":
-          "itemInSession":
-          "lastName":
-          "length":
-          "level":
-          "location":
-          "method"
-          "page":
-          "registration":
-          "sessionId":
-          "song":
-          "status":
-          "ts":
-          "userAgent":
-          "userId":
     """
-    for index, row in next_song_rows.iterrows():
 
-        """
-          Get song_id and artist_id from song and artist tables
+    batches = queue.Queue(maxsize=pipeline_queue_depth)
+    timings = dict.fromkeys(['reader_busy', 'writer_busy', 'writer_idle',
+                             'chunk_wait', 'files'], 0)
 
-            Remember:
-              song_select = 'SELECT song_id, artist_id
-                             FROM songs JOIN artists
-                             ON songs.artist_id = artists.artist_id
-                             WHERE title = (%s)
-                             AND name = (%s)
-                             AND duration = (%s);
-        """
-        query_values = tuple([row.song, row.artist, row.length])
+    def collect(datafile, future, counted=False):
         """
-          Check the composed sql query
-        """
-        logging.debug(
-            f'\n'
-            f'  Composed SQL query is: \n'
-            f'{cursor.mogrify(song_select, query_values)}\n'
-            f'{UNDERLINE_3}'
-            )
-        """
-          Execute the query
+        Waits for a reader's result, returning the parsed file or None
+          if the reader failed. 'counted' when the failure is already
+          in the file's RunStats.
         """
         try:
-            cursor.execute(song_select, query_values)
-            response = cursor.fetchone()
-            if response:                  # == if response is not None
-                logging.warning(
-                    f'\n'
-                    f'  For title: {row.song}, artist: {row.artist} IDs are: '
-                    f'{response}\n'
-                    f'{UNDERLINE_3}'
-                    )
-                song_select_finds += 1
-                song_select_responses.append(response)
-
-                song_id, artist_id = response
-            else:
-                song_id = None
-                artist_id = None
-
-        except psycopg2.Error as e:
-            handled_errors += 1
+            parsed, parse_seconds = future.result()
+            timings['reader_busy'] += parse_seconds
+            return parsed
+        except Exception as e:       # recommedned by PEP8
+            if not counted:
+                run_stats.add('handled_errors')
             logging.error(
                 f'\n'
-                f'  Error running select query: \n'
-                f'    {cursor.mogrify(song_select, query_values)}\n'
-                f'  Error reurned by psycopg2: \n'
+                f'  A reader failed parsing '
+                f'{os.path.basename(datafile)}\n'
                 f'    {e}\n'
-                f'{UNDERLINE_3}'
+                f'{UNDERLINE_1}'
                 )
+            return None
 
+    def stream(chunks):
         """
-          Insert songplay record
-            REMEMBER: - Table 'songplays' has fields:
-                 songplay_id, start_time, user_id, level, song_id,
-                   artist_id, session_id, location, user_agent
+        Yields the dataframes a reader puts on 'chunks' until its None,
+          timing the waits for them as writer idle time.
         """
-        songplay_data = tuple([
-                            pd.to_datetime(row['ts']),
-                            row['userId'],
-                            row['level'],
-                            song_id,
-                            artist_id,
-                            row['sessionId'],
-                            row['location'],
-                            row['userAgent']
-                            ])
-        try:
-            cursor.execute(songplay_table_insert, songplay_data)
-            songplays_saved += 1
-        except psycopg2.Error as e:
-            handled_errors += 1
-            logging.error(
+        while True:
+            start = time.perf_counter()
+            dataframe = chunks.get()
+            timings['chunk_wait'] += time.perf_counter() - start
+            if dataframe is None:
+                return
+            yield dataframe
+
+    def write():
+        while True:
+            start = time.perf_counter()
+            batch = batches.get()
+            if batch is None:
+                timings['writer_idle'] += time.perf_counter() - start
+                break
+            datafile, future, stats, chunks = batch
+            if chunks is None:
+                parsed = collect(datafile, future)
+            else:
+                parsed = (stream(chunks), stats)
+            timings['writer_idle'] += time.perf_counter() - start
+            if parsed is None:
+                continue
+            start = time.perf_counter()
+            waited = timings['chunk_wait']
+            try:
+                process_file(cursor, func, datafile, parsed)
+            except Exception as e:       # recommedned by PEP8
+                run_stats.add('handled_errors')
+                logging.error(
+                    f'\n'
+                    f'  The writer failed loading '
+                    f'{os.path.basename(datafile)}\n'
+                    f'    {e}\n'
+                    f'{UNDERLINE_1}'
+                    )
+            if chunks is not None:
+                """
+                  Drain what's left, should loading have stopped
+                    early, so the reader isn't left waiting.
+                """
+                for _ in parsed[0]:
+                    pass
+                collect(datafile, future, counted=True)
+            waited = timings['chunk_wait'] - waited
+            timings['writer_busy'] += time.perf_counter() - start - waited
+            timings['writer_idle'] += waited
+            timings['files'] += 1
+            logging.info(
                 f'\n'
-                f'  Error saving songplay data record\n {e}'
-                f'{UNDERLINE_3}'
+                f'  {os.path.basename(datafile)} complete: '
+                f'{timings["files"]} files processed.\n'
+                f'{UNDERLINE_2}'
                 )
-    logging.debug(
+
+    start = time.perf_counter()
+    writer = threading.Thread(target=write, name='etl-writer')
+    writer.start()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=readers,
+                thread_name_prefix='etl-reader') as executor:
+            for datafile in datafiles:
+                chunks = None
+                if func is process_log_file and log_chunk_rows:
+                    chunks = queue.Queue(maxsize=1)
+                stats = RunStats()
+                future = executor.submit(parse_file, func, datafile,
+                                         stats, chunks)
+                batches.put((datafile, future, stats, chunks))
+    finally:
+        batches.put(None)
+        writer.join()
+    seconds = time.perf_counter() - start
+
+    """
+      Readers are idle whenever they aren't parsing: waiting for the
+        directory scan or for room on the queue.
+    """
+    reader_idle = max(readers * seconds - timings['reader_busy'], 0)
+    run_stats.add('pipeline_reader_busy_seconds', timings['reader_busy'])
+    run_stats.add('pipeline_reader_idle_seconds', reader_idle)
+    run_stats.add('pipeline_writer_busy_seconds', timings['writer_busy'])
+    run_stats.add('pipeline_writer_idle_seconds', timings['writer_idle'])
+    logging.info(
         f'\n'
-        f'  process_log_file complete for file: '
-        f'{os.path.basename(filepath)} \n'
-        f'{UNDERLINE_3}'
+        f'  Pipeline: {timings["files"]} files in {seconds:.3f}s, '
+        f'{readers} readers busy {timings["reader_busy"]:.3f}s idle '
+        f'{reader_idle:.3f}s, writer busy {timings["writer_busy"]:.3f}s '
+        f'idle {timings["writer_idle"]:.3f}s\n'
+        f'{UNDERLINE_2}'
         )
+    return timings['files']
 
 
-def process_data(cursor, connection, filepath, func):
+def process_data(cursor, connection, filepath, func, workers=1,
+                 readers=0):
 
     """
-    Perform a directory walk on the specified filepath and
-      for each file found, submit the absolute filepath to
-      the specfied function.
+    Scan the specified filepath and for each file found, submit
+      the absolute filepath to the specfied function.
 
     Parameters:
 
@@ -921,11 +3008,15 @@ def process_data(cursor, connection, filepath, func):
      - connection: a connection object to the database
      - filepath: the absolute path to the song file to be processed
      - func: the function to be called by this function
+     - workers: number of worker processes, 1 processes the files
+         here on 'cursor'
+     - readers: number of reader threads to parse files in while
+         they are loaded here on 'cursor', 0 parses each file just
+         before loading it
 
     Returns: none
 
     """
-    global handled_errors
 
     logging.debug(
         f'\n'
@@ -938,43 +3029,197 @@ def process_data(cursor, connection, filepath, func):
         f'{UNDERLINE_3}'
         )
     """
-      Get all files matching extension from directory using os
-        and glob
+      Files matching the patterns are found as they are needed, and
+        those unchanged since they were last loaded are skipped
     """
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root,'*.json'))
-        for file in files:
-            all_files.append(os.path.abspath(file))
+    skipped_before = run_stats['files_skipped']
+    datafiles = select_files_to_load(
+        discover_files(filepath, file_patterns),
+        load_manifest(cursor)
+        )
     """
-      Get (and log) total number of files found
+      Iterate over files and process ... or hand them out to a pool
+        of worker processes
     """
-    num_files = len(all_files)
-    logging.info(
-        f'\n'
-        f'  {num_files} files found in path: '
-        f'{os.path.basename(filepath)}\n'
-        f'{UNDERLINE_2}'
-        )
+    if workers > 1:
+        num_files = process_data_in_workers(datafiles, func, workers)
+    elif readers > 0:
+        num_files = process_data_pipelined(cursor, datafiles, func,
+                                           readers)
+    else:
+        num_files = 0
+        for datafile in datafiles:
+            process_file(cursor, func, datafile)
+            num_files += 1
+            logging.info(
+                f'\n'
+                f'  {os.path.basename(datafile)} complete: {num_files} files processed.\n'
+                f'{UNDERLINE_2}'
+                )
     """
-      Iterate over files and process
+      Files skipped as only touched get their new size and mtime
     """
-    for i, datafile in enumerate(all_files, 1):
-        func(cursor, datafile)
-        logging.info(
+    try:
+        record_loaded_files(cursor, manifest_touched)
+    except psycopg2.Error as e:
+        run_stats.add('handled_errors')
+        logging.error(
             f'\n'
-            f'  {os.path.basename(datafile)} complete: {i}/{num_files} files processed.\n'
-            f'{UNDERLINE_2}'
+            f'  Error updating touched files in the load manifest\n'
+            f'    {e}\n'
+            f'{UNDERLINE_3}'
             )
+    manifest_touched.clear()
+    commit_transaction(cursor)
     logging.info(
         f'\n'
         f'  Leaving process_data for path: '
         f'{os.path.basename(filepath)} with: {func}\n'
+        f'  {num_files} files processed, '
+        f'{run_stats["files_skipped"] - skipped_before} unchanged since '
+        f'last loaded\n'
         f'{UNDERLINE_1}'
         )
 
 
-def main():
+def parse_arguments(argv=None):
+
+    """
+    Command line options for the script. With no options the
+      original single-row INSERT loaders are used.
+
+    Parameters:
+
+     - argv: list of argument strings, None means sys.argv
+
+    Returns: an argparse.Namespace holding the options
+
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Load the Sparkify song and log files into '
+                    'PostgreSQL.'
+        )
+    parser.add_argument(
+        '--song-loader',
+        choices=['insert', 'copy'],
+        default='insert',
+        help='insert: one INSERT per song and artist (default), '
+             'copy: bulk COPY through staging tables'
+        )
+    parser.add_argument(
+        '--song-batch-size',
+        type=int,
+        default=SONG_COPY_BATCH_SIZE,
+        help='song files per COPY batch when --song-loader=copy'
+        )
+    parser.add_argument(
+        '--songplay-loader',
+        choices=['insert', 'staged'],
+        default='insert',
+        help='insert: song_select and an INSERT per NextSong row '
+             '(default), staged: COPY each log file into a staging '
+             'table and resolve it with one INSERT ... SELECT'
+        )
+    parser.add_argument(
+        '--song-lookup',
+        choices=['query', 'index', 'lru'],
+        default='query',
+        help='how --songplay-loader insert finds song and artist IDs, '
+             'query: song_select per row (default), index: load every '
+             'song into memory, lru: bounded cache in front of '
+             'song_select'
+        )
+    parser.add_argument(
+        '--lookup-cache-size',
+        type=int,
+        default=SONG_LOOKUP_CACHE_SIZE,
+        help='maximum number of keys held by --song-lookup lru'
+        )
+    parser.add_argument(
+        '--chunk-rows',
+        type=int,
+        default=0,
+        help='read log files this many lines at a time so memory use '
+             'is bounded whatever the file size, 0 (default) reads '
+             'each file whole'
+        )
+    parser.add_argument(
+        '--patterns',
+        nargs='+',
+        default=FILE_PATTERNS,
+        help='file name patterns to load, for example *.json '
+             '*.json.gz (default: *.json)'
+        )
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help='process every file, including those the load manifest '
+             'shows are unchanged since they were last loaded'
+        )
+    parser.add_argument(
+        '--page-size',
+        type=int,
+        default=INSERT_PAGE_SIZE,
+        help='rows per multi-row INSERT statement'
+        )
+    parser.add_argument(
+        '--commit-every',
+        type=commit_every_type,
+        default=None,
+        help='commit every N rows, or every file with "file", instead '
+             'of autocommitting each statement. Each row runs in a '
+             'savepoint so one bad row doesn\'t roll back the rest'
+        )
+    parser.add_argument(
+        '--stats-dir',
+        default='.',
+        help=f'directory the run statistics are written to at the end '
+             f'of the run, as {STATS_JSON_FILE} and '
+             f'{STATS_PROMETHEUS_FILE} (default: the current '
+             f'directory)'
+        )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='number of worker processes, each with its own '
+             'connection, to share the song and log files between'
+        )
+    parser.add_argument(
+        '--backend',
+        choices=['psycopg2', 'pipeline'],
+        default='psycopg2',
+        help='psycopg2 (default), or pipeline: psycopg 3 in pipeline '
+             'mode, sending the song_select lookups and INSERT pages '
+             'of a file without waiting for each result'
+        )
+    parser.add_argument(
+        '--readers',
+        type=int,
+        default=0,
+        help='number of reader threads parsing files while a writer '
+             'thread loads them, 0 (default) alternates parsing and '
+             'loading'
+        )
+    parser.add_argument(
+        '--queue-depth',
+        type=int,
+        default=PIPELINE_QUEUE_DEPTH,
+        help='parsed files --readers may hold waiting for the writer'
+        )
+    options = parser.parse_args(argv)
+    if options.readers and options.workers > 1:
+        parser.error('--readers and --workers can\'t be combined')
+    if options.backend == 'pipeline' and not pg_pipeline.available():
+        parser.error('--backend pipeline needs psycopg 3: '
+                     'pip install "psycopg[binary]"')
+    if options.queue_depth < 1:
+        parser.error('--queue-depth must be at least 1')
+    return options
+
+
+def main(argv=None):
 
     """
     Main is the entry point to the script. It performs a
@@ -988,12 +3233,33 @@ def main():
       tables updated, the cursor and database connections are
       closed.
 
-    Parameters: none
+    Parameters:
+
+     - argv: list of command line arguments, see parse_arguments
 
     Returns: none
 
     """
-    global handled_errors
+    global song_copy_batch_size
+    global songplay_loader
+    global song_lookup
+    global song_lookup_cache_size
+    global log_chunk_rows
+    global full_reload
+    global file_patterns
+    global commit_every
+    global insert_page_size
+    global pipeline_queue_depth
+    global database_backend
+
+    options = parse_arguments(argv)
+    database_backend = options.backend
+    full_reload = options.full
+    commit_every = options.commit_every
+    insert_page_size = options.page_size
+    pipeline_queue_depth = options.queue_depth
+    file_patterns = options.patterns
+    run_stats.settings.update(vars(options))
 
     logging.info(
         f'\n'
@@ -1004,17 +3270,14 @@ def main():
       Connect to the sparkify database and obtain a cursor
     """
     try:
-        sparkify_connection = psycopg2.connect(
-            'host=127.0.0.1 dbname=sparkify user=student password=student'
-            )
-        sparkify_connection.set_session(autocommit=True)
+        sparkify_connection = connect_sparkify()
         logging.debug(
             f'\n'
             f'  Connection open\n  {sparkify_connection}\n'
             f'{UNDERLINE_3}'
             )
     except psycopg2.Error as e:
-        handled_errors += 1
+        run_stats.add('handled_errors')
         logging.error(
             f'\n'
             f'  Error trying to open connection:\n'
@@ -1024,14 +3287,15 @@ def main():
             f'{UNDERLINE_1}'
             )
     try:
-        sparkify_cursor = sparkify_connection.cursor()
+        sparkify_cursor = sparkify_connection.cursor(
+            cursor_factory=sql_trace.cursor_factory())
         logging.debug(
             f'\n'
             f'  Sparkify cursor active\n'
             f'{UNDERLINE_1}'
             )
     except psycopg2.Error as e:
-        handled_errors += 1
+        run_stats.add('handled_errors')
         logging.error(
             f'\n'
             f'  Error obtaining a cursor on connection:\n'
@@ -1040,6 +3304,10 @@ def main():
             f'    {e}\n'
             f'{UNDERLINE_1}'
             )
+    detect_bulk_load(sparkify_cursor)
+    detect_compact_schema(sparkify_cursor)
+    detect_user_agent_dimension(sparkify_cursor)
+    detect_partitioning(sparkify_cursor)
     """
       TASKS #1 & #2
       =============
@@ -1047,10 +3315,35 @@ def main():
           artists table.
     """
     song_datapath = 'data/song_data'
-    process_data(sparkify_cursor,
-        sparkify_connection,
-        filepath=song_datapath,
-        func=process_song_file
+    with run_stats.stage('songs'):
+        if options.song_loader == 'copy':
+            song_copy_batch_size = options.song_batch_size
+            prepare_song_staging(sparkify_cursor)
+            process_data(sparkify_cursor,
+                sparkify_connection,
+                filepath=song_datapath,
+                func=process_song_file_copy,
+                workers=options.workers,
+                readers=options.readers
+                )
+            flush_song_buffer(sparkify_cursor)
+        else:
+            process_data(sparkify_cursor,
+                sparkify_connection,
+                filepath=song_datapath,
+                func=process_song_file,
+                workers=options.workers,
+                readers=options.readers
+                )
+    song_seconds = run_stats.stages['songs']['seconds']
+    song_rows = run_stats['songs_saved'] + run_stats['song_duplicates'] \
+        + run_stats['artists_saved'] + run_stats['artist_duplicates']
+    logging.info(
+        f'\n'
+        f'  Song loader \'{options.song_loader}\' handled {song_rows} '
+        f'song and artist rows in {song_seconds:.3f}s '
+        f'({song_rows / max(song_seconds, 1e-9):.0f} rows/sec)\n'
+        f'{UNDERLINE_2}'
         )
     try:
         sql = 'SELECT count(*) from songs'
@@ -1095,11 +3388,20 @@ def main():
           and songplays table.
     """
     logs_datapath = 'data/log_data'
-    process_data(sparkify_cursor,
-        sparkify_connection,
-        filepath=logs_datapath,
-        func=process_log_file
-        )
+    songplay_loader = options.songplay_loader
+    song_lookup = options.song_lookup
+    song_lookup_cache_size = options.lookup_cache_size
+    log_chunk_rows = options.chunk_rows
+    with run_stats.stage('logs'):
+        process_data(sparkify_cursor,
+            sparkify_connection,
+            filepath=logs_datapath,
+            func=process_log_file,
+            workers=options.workers,
+            readers=options.readers
+            )
+        commit_transaction(sparkify_cursor)
+    shutdown_workers()
     """
       Do a clean shutdown of the cursor and connection
     """
@@ -1111,7 +3413,7 @@ def main():
             f'{UNDERLINE_3}'
             )
     except psycopg2.Error as e:
-        handled_errors += 1
+        run_stats.add('handled_errors')
         logging.error(
             f'\n'
             f'  Error when trying to close the cursor\n'
@@ -1120,14 +3422,14 @@ def main():
             f'{UNDERLINE_1}'
             )
     try:
-        sparkify_connection.close()
+        release_sparkify(sparkify_connection)
         logging.debug(
             f'\n'
-            f'  Sparkify connection closed\n'
+            f'  Sparkify connection released\n'
             f'{UNDERLINE_3}'
             )
     except psycopg2.Error as e:
-        handled_errors += 1
+        run_stats.add('handled_errors')
         logging.error(
             f'\n'
             f'  Error when trying to close the connection\n'
@@ -1135,27 +3437,95 @@ def main():
             f'    {e}\n'
             f'{UNDERLINE_1}'
             )
+    """
+      Write the run statistics out for graphing
+    """
+    song_lookup_text = song_lookup_summary()
+    stats_json = os.path.join(options.stats_dir, STATS_JSON_FILE)
+    stats_prometheus = os.path.join(options.stats_dir,
+                                    STATS_PROMETHEUS_FILE)
+    stats_written = f'{stats_json}, {stats_prometheus}'
+    try:
+        run_stats.write(stats_json, stats_prometheus)
+    except OSError as ose:
+        stats_written = 'not written, see error above'
+        run_stats.add('handled_errors')
+        logging.error(
+            f'\n'
+            f'  Could not write the run statistics to: '
+            f'{options.stats_dir}\n'
+            f'  OS returned:\n\n{ose}\n'
+            f'{UNDERLINE_1}'
+            )
+    stage_summary = ''
+    if options.readers:
+        stage_summary += (
+            f'  Pipeline readers busy: '
+            f'{run_stats["pipeline_reader_busy_seconds"]:.3f}s, idle: '
+            f'{run_stats["pipeline_reader_idle_seconds"]:.3f}s, writer '
+            f'busy: {run_stats["pipeline_writer_busy_seconds"]:.3f}s, '
+            f'idle: {run_stats["pipeline_writer_idle_seconds"]:.3f}s\n'
+            )
+    if compact_schema:
+        stage_summary += (
+            f'  New values interned: '
+            f'{run_stats["locations_interned"]} locations, '
+            f'{run_stats["user_agents_interned"]} user agents\n'
+            )
+    if user_agent_dimension:
+        hits = run_stats['user_agents_cache_hits']
+        misses = run_stats['user_agents_cache_misses']
+        stage_summary += (
+            f'  User agent parse cache hits: {hits}, misses: {misses}, '
+            f'hit rate: {hits / max(hits + misses, 1):.1%}\n'
+            )
+    for stage, figures in run_stats.as_dict()['stages'].items():
+        """
+          A stage timed in the workers adds up their seconds, so its
+            rows/sec is per worker
+        """
+        processes = ''
+        if figures['processes'] > 1:
+            processes = (f' (added up over {figures["processes"]} '
+                         f'processes, rows/sec is per process)')
+        stage_summary += (
+            f'  Stage {stage}: {figures["seconds"]:.3f}s{processes}, '
+            f'{figures["rows_in"]} rows in, '
+            f'{figures["rows_out"]} rows out, '
+            f'{figures["rows_per_sec"]:.0f} rows/sec, '
+            f'{figures["bytes_read"]} bytes read, '
+            f'peak RSS {figures["peak_rss_kb"] / 1024:.1f} MB\n'
+            )
     """
       Say goodbye and log summary warnings
     """
     logging.info(
         f'\n'
-        f'  Song duplicates encountered: {song_duplicates}\n'
-        f'  Artist duplicates encountered: {artist_duplicates}\n'
-        f'  Time duplicates encountered: {time_duplicates}\n'
-        f'  User duplicates encountered: {user_duplicates}\n'
-        f'  Songplays duplicates encountered: {songplays_duplicates}\n\n'
-        f'  \'not None\' returns from song select: {song_select_finds}\n\n'
-        f'    {song_select_responses}\n\n'
-        f'  Handled errors encountered: {handled_errors}\n\n'
-        f'  Songs saved to database: {songs_saved}\n'
-        f'  Artists saved to database: {artists_saved}\n'
-        f'  Times saved to database: {times_saved}\n'
-        f'  Users saved to database: {users_saved}\n'
-        f'  Songplays saved to database: {songplays_saved}\n\n'
+        f'  Song duplicates encountered: {run_stats["song_duplicates"]}\n'
+        f'  Artist duplicates encountered: '
+        f'{run_stats["artist_duplicates"]}\n'
+        f'  Time duplicates encountered: {run_stats["time_duplicates"]}\n'
+        f'  User duplicates encountered: {run_stats["user_duplicates"]}\n'
+        f'  Songplays duplicates encountered: '
+        f'{run_stats["songplays_duplicates"]}\n\n'
+        f'  \'not None\' returns from song select: '
+        f'{run_stats["song_select_finds"]}\n'
+        f'{song_lookup_text}\n'
+        f'    {run_stats.samples.get("song_select_responses", [])}\n\n'
+        f'  Handled errors encountered: {run_stats["handled_errors"]}\n\n'
+        f'  Files skipped as unchanged: {run_stats["files_skipped"]}\n'
+        f'  Songs saved to database: {run_stats["songs_saved"]}\n'
+        f'  Artists saved to database: {run_stats["artists_saved"]}\n'
+        f'  Times saved to database: {run_stats["times_saved"]}\n'
+        f'  Users saved to database: {run_stats["users_saved"]}\n'
+        f'  Songplays saved to database: {run_stats["songplays_saved"]}\n\n'
+        f'{stage_summary}'
+        f'  Run statistics: {stats_written}\n\n'
         f'  We\'ve got to the end!!\n\n'
         f'{UNDERLINE_2}\n\n'
         )
+    if sql_trace.tracing_enabled():
+        logging.info(sql_trace.statement_report())
 
 
 if __name__ == "__main__":
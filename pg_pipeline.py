@@ -0,0 +1,327 @@
+"""
+psycopg 3 Pipeline Backend
+==========================
+
+  An alternative database backend for etl.py, selected with
+    --backend pipeline, built on psycopg 3's pipeline mode. In
+    pipeline mode statements are sent without waiting for the result
+    of the one before, so a batch of N statements costs one network
+    round trip instead of N.
+
+  PipelineConnection and PipelineCursor wrap a psycopg 3 connection
+    and client-side binding cursor in the parts of the psycopg2
+    interface etl.py uses (execute, fetchone, rowcount, copy_expert,
+    mogrify, set_session, 'with connection' ...) and raise psycopg2
+    exceptions, so they are a drop-in for the cursor process_song_file
+    and process_log_file receive and for psycopg2.extras.execute_values.
+
+  On top of that the cursor has two batch methods, which etl.py uses
+    when it is given a PipelineCursor (see is_pipelined):
+
+   - fetchone_each: runs one query for each set of parameters, for
+       example song_select for every NextSong row, with all of them
+       in flight at once
+   - execute_values_each: sends the pages of a multi-row INSERT
+       together and returns the rows inserted by all of them
+
+  psycopg 3 is optional, install it with:
+
+      pip install "psycopg[binary]"
+
+"""
+
+"""
+Imports
+=======
+
+  time - statement timing for sql_trace
+  contextlib - translating psycopg 3 errors
+  psycopg2 - the exception classes etl.py catches
+  psycopg - psycopg 3, the driver, when installed
+  sql_trace - per-statement timing when SPARKIFY_TRACE_SQL is set
+
+"""
+
+import time
+import contextlib
+
+import psycopg2
+import psycopg2.errors
+
+import sql_trace
+
+try:
+    import psycopg
+except ImportError:       # psycopg 3 is an optional dependency
+    psycopg = None
+
+
+def available():
+
+    """
+    Returns True when psycopg 3 is installed.
+    """
+
+    return psycopg is not None
+
+
+def connect(dsn, **kwargs):
+
+    """
+    Opens a psycopg 3 connection, taking the same arguments as
+      psycopg2.connect.
+
+    Returns: a PipelineConnection
+    """
+
+    if psycopg is None:
+        raise ImportError('the pipeline backend needs psycopg 3: '
+                          'pip install "psycopg[binary]"')
+    with psycopg2_errors():
+        return PipelineConnection(psycopg.connect(dsn, **kwargs))
+
+
+def is_pipelined(cursor):
+
+    """
+    Returns True if 'cursor' is a PipelineCursor, with the batch
+      methods fetchone_each and execute_values_each.
+    """
+
+    return isinstance(cursor, PipelineCursor)
+
+
+def as_psycopg2_error(error):
+
+    """
+    Returns the psycopg2 exception matching a psycopg 3 one: the
+      psycopg2.errors class for its SQLSTATE where it has one.
+    """
+
+    error_class = psycopg2.DatabaseError
+    if isinstance(error, psycopg.OperationalError):
+        error_class = psycopg2.OperationalError
+    if error.sqlstate:
+        try:
+            error_class = psycopg2.errors.lookup(error.sqlstate)
+        except KeyError:
+            pass
+    return error_class(str(error))
+
+
+@contextlib.contextmanager
+def psycopg2_errors():
+
+    """
+    Context manager re-raising psycopg 3 errors as psycopg2 errors,
+      so the 'except psycopg2.Error' handlers in etl.py catch them.
+    """
+
+    try:
+        yield
+    except psycopg.Error as e:
+        raise as_psycopg2_error(e) from e
+
+
+class PipelineConnection:
+
+    """
+    A psycopg 3 connection with psycopg2's interface.
+
+    NOTE: as with psycopg2, 'with connection' wraps a transaction and
+      doesn't close the connection: the block is committed if it
+      succeeds and rolled back if it raises.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._transaction = None
+
+    @property
+    def encoding(self):
+        return self._connection.info.parameter_status('client_encoding')
+
+    @property
+    def autocommit(self):
+        return self._connection.autocommit
+
+    def set_session(self, autocommit=None):
+        if autocommit is not None:
+            with psycopg2_errors():
+                self._connection.autocommit = autocommit
+
+    def cursor(self, cursor_factory=None):
+        return PipelineCursor(self)
+
+    def commit(self):
+        with psycopg2_errors():
+            self._connection.commit()
+
+    def rollback(self):
+        with psycopg2_errors():
+            self._connection.rollback()
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        if self._connection.autocommit:
+            self._transaction = self._connection.transaction()
+            with psycopg2_errors():
+                self._transaction.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        transaction, self._transaction = self._transaction, None
+        with psycopg2_errors():
+            if transaction is not None:
+                return transaction.__exit__(*exc_info)
+            if exc_info[0] is None:
+                self._connection.commit()
+            else:
+                self._connection.rollback()
+        return False
+
+
+class PipelineCursor:
+
+    """
+    A psycopg 3 client-side binding cursor with psycopg2's interface.
+
+    Client-side binding keeps psycopg2's behaviour of one statement
+      string, with the parameters quoted into it, which may hold
+      several statements: etl.py prefixes statements with
+      'SAVEPOINT ...;' in its --commit-every modes. As with psycopg2
+      the results are those of the last statement.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._cursor = psycopg.ClientCursor(connection._connection)
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def _record(self, query, start):
+        if sql_trace.tracing_enabled():
+            sql_trace.record(sql_trace.statement_name(query),
+                             time.perf_counter() - start)
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        with psycopg2_errors():
+            self._cursor.execute(query, vars)
+            while self._cursor.nextset():
+                pass
+        self._record(query, start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        with psycopg2_errors():
+            self._cursor.executemany(query, vars_list)
+        self._record(query, start)
+
+    def mogrify(self, query, vars=None):
+        if isinstance(query, bytes):
+            query = query.decode('utf-8')
+        with psycopg2_errors():
+            return self._cursor.mogrify(query, vars).encode('utf-8')
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        with psycopg2_errors():
+            with self._cursor.copy(sql) as copy:
+                while True:
+                    data = file.read(size)
+                    if not data:
+                        break
+                    copy.write(data)
+        self._record(sql, start)
+
+    def fetchone(self):
+        with psycopg2_errors():
+            return self._cursor.fetchone()
+
+    def fetchall(self):
+        with psycopg2_errors():
+            return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self._cursor.close()
+
+    def fetchone_each(self, query, vars_list):
+
+        """
+        Runs 'query' once for each set of parameters in 'vars_list',
+          all of them in a single pipeline.
+
+        Parameters:
+
+         - query: a query from sql_queries.py, song_select for example
+         - vars_list: list of parameter tuples
+
+        Returns: a list holding the first row returned by each query,
+          or None where it returned no rows
+
+        """
+
+        if not vars_list:
+            return []
+        start = time.perf_counter()
+        rows = []
+        with psycopg2_errors():
+            self._cursor.executemany(query, vars_list, returning=True)
+            while True:
+                rows.append(self._cursor.fetchone())
+                if not self._cursor.nextset():
+                    break
+        self._record(query, start)
+        return rows
+
+    def execute_values_each(self, query, pages):
+
+        """
+        The pipelined counterpart of psycopg2.extras.execute_values:
+          sends one multi-row INSERT for each page of records, all of
+          them in a single pipeline.
+
+        Parameters:
+
+         - query: an INSERT query from sql_queries.py with a single
+             'VALUES %s' placeholder
+         - pages: list of lists of record tuples
+
+        Returns: the number of rows the statements report as inserted
+
+        """
+
+        statements = []
+        for page in pages:
+            if not page:
+                continue
+            template = '(' + ','.join(['%s'] * len(page[0])) + ')'
+            values = b','.join(self.mogrify(template, record)
+                               for record in page)
+            statements.append(query.replace(
+                'VALUES %s', 'VALUES ' + values.decode('utf-8'), 1))
+        if not statements:
+            return 0
+        start = time.perf_counter()
+        connection = self.connection._connection
+        with psycopg2_errors():
+            cursors = [psycopg.ClientCursor(connection)
+                       for _ in statements]
+            with connection.pipeline():
+                for cursor, statement in zip(cursors, statements):
+                    cursor.execute(statement)
+            inserted = sum(cursor.rowcount for cursor in cursors)
+        self._record(query, start)
+        return inserted
@@ -0,0 +1,357 @@
+"""
+Run Statistics
+==============
+
+  The RunStats object collects the numbers for one run of etl.py:
+
+   - counters, for example songs_saved, time_duplicates and
+       handled_errors
+   - the high-water marks, for example peak resident set size
+   - per-stage wall time, rows in and out, rows/sec, bytes read and
+       peak memory
+   - a bounded sample of values worth eyeballing, such as the first
+       few song_select responses
+
+  Each worker process fills a RunStats of its own for each task and
+    returns it to the parent, which merges it in: counters add up,
+    high-water marks keep the largest value.
+
+  NOTE: the seconds of a stage timed in the workers (with --workers,
+    'time', 'users' and 'songplays') are added up across the worker
+    processes, so its rows/sec is the throughput of one worker, not
+    of the run. Each stage records how many processes it was timed
+    in; the 'songs' and 'logs' stages are timed in the parent and are
+    always wall time.
+
+  At the end of a run the stats are written as a JSON file and as a
+    Prometheus text-format file (for the node_exporter textfile
+    collector, for example), so ETL throughput can be graphed over
+    time.
+
+"""
+
+"""
+Imports
+=======
+
+  os - atomic replacement of the output files
+  time - wall clock and timers
+  json - the JSON output file
+  resource - peak memory use where /proc isn't available
+  contextlib - the stage timing context manager
+  collections - Counter for the counters
+
+"""
+
+import os
+import time
+import json
+import resource
+import contextlib
+import collections
+
+
+"""
+  Number of values kept by RunStats.sample for each name.
+"""
+
+SAMPLE_SIZE = 20
+
+"""
+  Prefix of every metric name in the Prometheus output.
+"""
+
+METRIC_PREFIX = 'sparkify_etl'
+
+
+def read_peak_rss():
+
+    """
+    Returns the peak resident set size of this process in kB.
+
+    On Linux this is VmHWM from /proc/self/status, which
+      reset_peak_rss can reset so each log file gets its own peak.
+      Elsewhere it is ru_maxrss, the peak for the life of the process.
+    """
+
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak_rss():
+
+    """
+    Resets the peak resident set size reported by read_peak_rss to
+      the current resident set size, where the OS allows it.
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+class RunStats:
+
+    """
+    Counters, high-water marks, samples and per-stage figures for one
+      run, or one worker task, of etl.py.
+
+    Stage figures are worked out by RunStats.stage from the counters
+      at the start and end of the stage:
+
+     - rows_in: the 'rows_read' counter
+     - rows_out: every counter whose name ends in '_saved'
+     - bytes_read: the 'bytes_read' counter
+     - peak_rss_kb: the largest 'peak_rss_kb' recorded during the
+         stage, by this process or a merged worker
+
+    so anything counted in a worker and merged before the stage ends
+      is included. Merging adds up the seconds of a stage timed in
+      several processes, and the stage's 'processes' figure counts
+      them.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.pid = os.getpid()
+        self.stage_processes = {}
+        self.counters = collections.Counter()
+        self.peaks = {}
+        self.samples = {}
+        self.stages = {}
+        self.settings = {}
+
+    def __getitem__(self, name):
+        return self.counters[name]
+
+    def add(self, name, value=1):
+
+        """
+        Adds 'value' to the counter 'name'.
+        """
+
+        self.counters[name] += value
+
+    def peak(self, name, value):
+
+        """
+        Records 'value' for the high-water mark 'name', keeping the
+          largest value seen.
+        """
+
+        self.peaks[name] = max(self.peaks.get(name, value), value)
+
+    def sample(self, name, value):
+
+        """
+        Keeps 'value' in the sample 'name', until that sample holds
+          SAMPLE_SIZE values.
+        """
+
+        values = self.samples.setdefault(name, [])
+        if len(values) < SAMPLE_SIZE:
+            values.append(value)
+
+    def merge(self, other):
+
+        """
+        Adds the counters, high-water marks, samples and stages of
+          another RunStats, typically one returned by a worker
+          process, to this one.
+
+        Parameters:
+
+         - other: a RunStats
+
+        Returns: none
+
+        """
+
+        self.counters.update(other.counters)
+        for name, value in other.peaks.items():
+            self.peak(name, value)
+        for name, values in other.samples.items():
+            for value in values:
+                self.sample(name, value)
+        for name, pids in other.stage_processes.items():
+            self.stage_processes.setdefault(name, set()).update(pids)
+        for name, figures in other.stages.items():
+            stage = self.stages.setdefault(name, dict.fromkeys(figures, 0))
+            for figure, value in figures.items():
+                if figure == 'peak_rss_kb':
+                    stage[figure] = max(stage[figure], value)
+                else:
+                    stage[figure] += value
+
+    @contextlib.contextmanager
+    def stage(self, name):
+
+        """
+        Times the code run inside the 'with' block as stage 'name'
+          and works out its rows in and out, bytes read and peak
+          memory. Running a stage again adds to its figures, and
+          stages can be nested, the 'time' stage inside 'logs' for
+          example.
+
+        Parameters:
+
+         - name: the stage name, for example 'songs' or 'logs'
+
+        Returns: a context manager giving the stage's figures, so a
+          stage that doesn't read files itself can add to 'rows_in'
+
+        """
+
+        stage = self.stages.setdefault(name, {
+            'seconds': 0,
+            'rows_in': 0,
+            'rows_out': 0,
+            'bytes_read': 0,
+            'peak_rss_kb': 0
+            })
+        self.stage_processes.setdefault(name, set()).add(self.pid)
+        counters_before = self.counters.copy()
+        self.peak('peak_rss_kb', read_peak_rss())
+        peaks_before, self.peaks = self.peaks, {}
+        reset_peak_rss()
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            seconds = time.perf_counter() - start
+            self.peak('peak_rss_kb', read_peak_rss())
+            change = self.counters.copy()
+            change.subtract(counters_before)
+            stage['seconds'] += seconds
+            stage['rows_in'] += change['rows_read']
+            stage['rows_out'] += sum(value
+                                     for counter, value in change.items()
+                                     if counter.endswith('_saved'))
+            stage['bytes_read'] += change['bytes_read']
+            stage['peak_rss_kb'] = max(stage['peak_rss_kb'],
+                                       self.peaks['peak_rss_kb'])
+            stage_peaks, self.peaks = self.peaks, peaks_before
+            for peak_name, value in stage_peaks.items():
+                self.peak(peak_name, value)
+
+    def as_dict(self):
+
+        """
+        Returns the stats as a dictionary of plain values, with the
+          rows/sec and number of processes of each stage and the run's
+          elapsed time added.
+        """
+
+        stages = {}
+        for name, figures in self.stages.items():
+            stages[name] = dict(figures)
+            stages[name]['rows_per_sec'] = \
+                figures['rows_in'] / max(figures['seconds'], 1e-9)
+            stages[name]['processes'] = \
+                len(self.stage_processes.get(name, ())) or 1
+        return {
+            'started': self.started,
+            'seconds': time.time() - self.started,
+            'settings': dict(self.settings),
+            'stages': stages,
+            'counters': dict(sorted(self.counters.items())),
+            'peaks': dict(self.peaks),
+            'samples': {name: [list(value) if isinstance(value, tuple)
+                               else value for value in values]
+                        for name, values in self.samples.items()}
+            }
+
+    def prometheus_text(self):
+
+        """
+        Returns the stats in the Prometheus text exposition format,
+          every metric is a gauge describing this run.
+        """
+
+        stats = self.as_dict()
+        lines = []
+
+        def metric(name, help_text, values):
+            lines.append(f'# HELP {METRIC_PREFIX}_{name} {help_text}')
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} gauge')
+            for labels, value in values:
+                label_text = ','.join(
+                    f'{key}="' + label.replace('\\', '\\\\')
+                    .replace('"', '\\"').replace('\n', '\\n') + '"'
+                    for key, label in labels)
+                if label_text:
+                    label_text = '{' + label_text + '}'
+                lines.append(f'{METRIC_PREFIX}_{name}{label_text} '
+                             f'{float(value)!r}')
+
+        metric('run_start_timestamp_seconds',
+               'Unix time the run started.',
+               [((), stats['started'])])
+        metric('run_seconds',
+               'Wall time of the whole run.',
+               [((), stats['seconds'])])
+        metric('run_info',
+               'Settings the run used, as labels.',
+               [(tuple((key, str(value))
+                       for key, value in sorted(stats['settings'].items())),
+                 1)])
+        stage_metrics = [
+            ('seconds', 'stage_seconds',
+             'Time spent in each stage, added up across processes.', 1),
+            ('rows_in', 'stage_rows_in',
+             'Rows read from the data files by each stage.', 1),
+            ('rows_out', 'stage_rows_out',
+             'Rows saved to the database by each stage.', 1),
+            ('rows_per_sec', 'stage_rows_per_second',
+             'Rows read per second of stage time, per process.', 1),
+            ('processes', 'stage_processes',
+             'Number of processes each stage was timed in.', 1),
+            ('bytes_read', 'stage_bytes_read',
+             'Bytes of data files read by each stage.', 1),
+            ('peak_rss_kb', 'stage_peak_rss_bytes',
+             'Peak resident set size of any one process during each '
+             'stage.', 1024),
+            ]
+        for figure, name, help_text, scale in stage_metrics:
+            metric(name, help_text,
+                   [((('stage', stage),), figures[figure] * scale)
+                    for stage, figures in stats['stages'].items()])
+        metric('count',
+               'Run counters, for example songs_saved or '
+               'handled_errors.',
+               [((('name', name),), value)
+                for name, value in stats['counters'].items()])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_path, prometheus_path):
+
+        """
+        Writes the stats to 'json_path' and 'prometheus_path'. Each
+          file is written beside its final name and then renamed, so
+          a collector never reads a half written file.
+
+        Parameters:
+
+         - json_path: path of the JSON file
+         - prometheus_path: path of the Prometheus text-format file
+
+        Returns: none
+
+        """
+
+        outputs = [
+            (json_path, json.dumps(self.as_dict(), indent=2) + '\n'),
+            (prometheus_path, self.prometheus_text())
+            ]
+        for path, text in outputs:
+            with open(f'{path}.tmp', 'w') as output:
+                output.write(text)
+            os.replace(f'{path}.tmp', path)
@@ -22,15 +22,22 @@ CREATE TABLES
      unique column, generally the existing ID field imported with
      the other data from the song or log files.
 
-01 - Table 'songplays' has fields: songplay_id, start_time,
-     user_id, level, song_id, artist_id, session_id, location,
-     user_agent
+   NOTE: songplays and time share time_key, the event's 'ts' field:
+     a bigint count of milliseconds since 1970-01-01 UTC, from which
+     etl.py derives start_time once per batch. Joining songplays to
+     time on time_key is an integer equality join, and it is the
+     key both tables are partitioned on (see PARTITIONED TABLES).
+
+01 - Table 'songplays' has fields: songplay_id, time_key,
+     start_time, user_id, level, song_id, artist_id, session_id,
+     location, user_agent
 """
 songplay_table_create = ('CREATE TABLE IF NOT EXISTS songplays'
                             '(songplay_id BIGSERIAL PRIMARY KEY, '
+                            'time_key bigint NOT NULL, '
                             'start_time timestamp NOT NULL, '
                             'user_id int NOT NULL, '
-                            'UNIQUE (start_time, user_id), '
+                            'UNIQUE (time_key, user_id), '
                             'level varchar, '
                             'song_id varchar, '
                             'artist_id varchar, '
@@ -76,11 +83,12 @@ artist_table_create = ('CREATE TABLE IF NOT EXISTS artists'
                           'longitude NUMERIC(8,5))'
                           )
 """
-05 - Table 'time' has fields: start_time, hour, day, week, month,
-       year, weekday
+05 - Table 'time' has fields: time_key, start_time, hour, day,
+       week, month, year, weekday
 """
 time_table_create = (f'CREATE TABLE IF NOT EXISTS time'
-                         '(start_time timestamp UNIQUE PRIMARY KEY, '
+                         '(time_key bigint PRIMARY KEY, '
+                         'start_time timestamp NOT NULL, '
                          'hour int, '
                          'day int, '
                          'week int, '
@@ -93,10 +101,11 @@ INSERT RECORDS
 ==============
 """
 songplay_table_insert = ('INSERT INTO songplays'
-                        ' (songplay_id, start_time, user_id, level,'
-                        ' song_id, artist_id, session_id, location,'
-                        ' user_agent)'
-                        ' VALUES (DEFAULT, %s, %s, %s, %s, %s, %s, %s, %s)'
+                        ' (songplay_id, time_key, start_time, user_id,'
+                        ' level, song_id, artist_id, session_id,'
+                        ' location, user_agent)'
+                        ' VALUES (DEFAULT, %s, %s, %s, %s, %s, %s, %s,'
+                        ' %s, %s)'
                         ' ON CONFLICT (songplay_id) DO NOTHING;')
 
 user_table_insert = ('INSERT INTO users'
@@ -117,10 +126,183 @@ artist_table_insert = ('INSERT INTO artists'
                       ' ON CONFLICT (artist_id) DO NOTHING;')
 
 time_table_insert = ('INSERT INTO time'
-                    ' (start_time, hour, day, week, month, year,'
-                    ' weekday)'
-                    ' VALUES (%s, %s, %s, %s, %s, %s, %s)'
-                    ' ON CONFLICT (start_time) DO NOTHING;')
+                    ' (time_key, start_time, hour, day, week, month,'
+                    ' year, weekday)'
+                    ' VALUES (%s, %s, %s, %s, %s, %s, %s, %s)'
+                    ' ON CONFLICT (time_key) DO NOTHING;')
+
+"""
+STAGING TABLES (bulk COPY loader)
+=================================
+
+  UNLOGGED tables with no constraints that receive batches of song
+    and artist records with 'COPY ... FROM STDIN'. Each batch is then
+    merged into the songs and artists tables with one set-based
+    INSERT ... ON CONFLICT. DISTINCT ON removes duplicates within a
+    batch, which ON CONFLICT can't handle on its own.
+
+  NOTE: copy_records in etl.py writes None as '\\N' so the COPY
+    queries declare that as the NULL marker.
+"""
+song_staging_table_create = ('CREATE UNLOGGED TABLE IF NOT EXISTS'
+                                ' songs_staging'
+                                '(song_id varchar, '
+                                'title varchar, '
+                                'artist_id varchar, '
+                                'year int, '
+                                'duration NUMERIC(10,5))'
+                                )
+
+artist_staging_table_create = ('CREATE UNLOGGED TABLE IF NOT EXISTS'
+                                  ' artists_staging'
+                                  '(artist_id varchar, '
+                                  'name varchar, '
+                                  'location varchar, '
+                                  'latitude NUMERIC(8,5), '
+                                  'longitude NUMERIC(8,5))'
+                                  )
+
+song_staging_table_drop = f'DROP TABLE IF EXISTS songs_staging'
+artist_staging_table_drop = f'DROP TABLE IF EXISTS artists_staging'
+
+song_staging_copy = ('COPY songs_staging'
+                    ' (song_id, title, artist_id, year, duration)'
+                    " FROM STDIN WITH (FORMAT csv, NULL '\\N')")
+
+artist_staging_copy = ('COPY artists_staging'
+                      ' (artist_id, name, location, latitude,'
+                      ' longitude)'
+                      " FROM STDIN WITH (FORMAT csv, NULL '\\N')")
+
+song_staging_merge = ('INSERT INTO songs'
+                     ' (song_id, title, artist_id, year, duration)'
+                     ' SELECT DISTINCT ON (song_id)'
+                     ' song_id, title, artist_id, year, duration'
+                     ' FROM songs_staging'
+                     ' ON CONFLICT (song_id) DO NOTHING;')
+
+artist_staging_merge = ('INSERT INTO artists'
+                       ' (artist_id, name, location, latitude,'
+                       ' longitude)'
+                       ' SELECT DISTINCT ON (artist_id)'
+                       ' artist_id, name, location, latitude, longitude'
+                       ' FROM artists_staging'
+                       ' ON CONFLICT (artist_id) DO NOTHING;')
+
+song_staging_truncate = 'TRUNCATE songs_staging'
+artist_staging_truncate = 'TRUNCATE artists_staging'
+
+"""
+SONGPLAYS STAGING (set-based songplay loader)
+=============================================
+
+  A TEMPORARY table, private to the etl connection, receives all the
+    NextSong rows of a log file with 'COPY ... FROM STDIN'. One
+    INSERT ... SELECT then resolves song_id and artist_id with a LEFT
+    JOIN on songs/artists, matching on title, artist name and duration
+    as song_select does, and writes every songplay in one statement.
+
+  NOTE: length is an unconstrained NUMERIC so the duration comparison
+    matches the one song_select makes with the query parameter.
+
+  NOTE: DISTINCT ON and ON CONFLICT on (time_key, user_id) keep one
+    duplicate from aborting the whole statement. The returned row
+    gives the number of songplays saved and how many of them were
+    matched to a song.
+
+  NOTE: start_time is derived from time_key with integer interval
+    arithmetic, so it is exactly the start_time etl.py writes to the
+    time table.
+"""
+songplay_staging_table_create = ('CREATE TEMPORARY TABLE IF NOT EXISTS'
+                                    ' songplays_staging'
+                                    '(time_key bigint, '
+                                    'user_id int, '
+                                    'level varchar, '
+                                    'song varchar, '
+                                    'artist varchar, '
+                                    'length NUMERIC, '
+                                    'session_id int, '
+                                    'location varchar, '
+                                    'user_agent text)'
+                                    )
+
+songplay_staging_copy = ('COPY songplays_staging'
+                        ' (time_key, user_id, level, song, artist, length,'
+                        ' session_id, location, user_agent)'
+                        " FROM STDIN WITH (FORMAT csv, NULL '\\N')")
+
+songplay_staging_truncate = 'TRUNCATE songplays_staging'
+
+songplay_staging_insert = ('WITH saved AS ('
+                          ' INSERT INTO songplays'
+                          ' (time_key, start_time, user_id, level,'
+                          ' song_id, artist_id, session_id, location,'
+                          ' user_agent)'
+                          ' SELECT DISTINCT ON (time_key, user_id)'
+                          ' time_key, start_time, user_id, level,'
+                          ' song_id, artist_id, session_id, location,'
+                          ' user_agent'
+                          ' FROM (SELECT staged.time_key,'
+                          " timestamp 'epoch' + staged.time_key"
+                          " * interval '1 millisecond' AS start_time,"
+                          ' staged.user_id, staged.level,'
+                          ' songs.song_id, artists.artist_id,'
+                          ' staged.session_id, staged.location,'
+                          ' staged.user_agent'
+                          ' FROM songplays_staging AS staged'
+                          ' LEFT JOIN (songs JOIN artists'
+                          ' ON songs.artist_id = artists.artist_id)'
+                          ' ON songs.title = staged.song'
+                          ' AND artists.name = staged.artist'
+                          ' AND songs.duration = staged.length'
+                          ' ) AS resolved'
+                          ' ORDER BY time_key, user_id, song_id'
+                          ' ON CONFLICT (time_key, user_id) DO NOTHING'
+                          ' RETURNING song_id)'
+                          ' SELECT count(*), count(song_id) FROM saved;')
+
+"""
+BATCHED INSERTS
+===============
+
+  Multi-row versions of the inserts above for psycopg2's
+    execute_values, which fills the single VALUES %s placeholder with
+    a page of records at a time.
+
+  NOTE: the songplays version uses ON CONFLICT DO NOTHING without a
+    conflict target so that a repeated (time_key, user_id) pair is
+    skipped rather than failing the whole page.
+"""
+songplay_table_batch_insert = ('INSERT INTO songplays'
+                              ' (time_key, start_time, user_id, level,'
+                              ' song_id, artist_id, session_id, location,'
+                              ' user_agent)'
+                              ' VALUES %s'
+                              ' ON CONFLICT DO NOTHING;')
+
+user_table_batch_insert = ('INSERT INTO users'
+                          ' (user_id, first_name, last_name, gender, level)'
+                          ' VALUES %s'
+                          ' ON CONFLICT (user_id)'
+                          ' DO UPDATE SET level = EXCLUDED.level;')
+
+song_table_batch_insert = ('INSERT INTO songs'
+                          ' (song_id, title, artist_id, year, duration)'
+                          ' VALUES %s'
+                          ' ON CONFLICT (song_id) DO NOTHING;')
+
+artist_table_batch_insert = ('INSERT INTO artists'
+                            ' (artist_id, name, location, latitude,'
+                            ' longitude)'
+                            ' VALUES %s'
+                            ' ON CONFLICT (artist_id) DO NOTHING;')
+
+time_table_batch_insert = ('INSERT INTO time'
+                          ' (time_key, start_time, hour, day, week, month,'
+                          ' year, weekday)'
+                          ' VALUES %s'
+                          ' ON CONFLICT (time_key) DO NOTHING;')
 
 """
 FIND SONGS  (row.song, row.artist, row.length))
@@ -133,13 +315,642 @@ song_select = ('SELECT songs.song_id, artists.artist_id'
               ' AND name = (%s)'
               ' AND duration = (%s);')
 """
+SONG_SELECT INDEXES
+===================
+
+  Without these song_select, and the LEFT JOIN in
+    songplay_staging_insert, scan the whole of the songs table for
+    every NextSong row and the whole of the artists table for each
+    song found. With them each lookup is two index probes:
+
+   - songs (title, duration): the title and duration song_select
+       filters on. The set-based loader compares NUMERIC durations
+       and probes on both columns. song_select's float parameter
+       casts the column, so it probes on title and checks the
+       duration of the few songs with that title.
+   - artists (name): the artist name, checked against the artists
+       of the matching songs
+
+  NOTE: created after the tables in create_table_queries. Dropping
+    the tables drops them too.
+"""
+song_title_duration_index_create = ('CREATE INDEX IF NOT EXISTS'
+                                   ' songs_title_duration_idx'
+                                   ' ON songs (title, duration)')
+
+artist_name_index_create = ('CREATE INDEX IF NOT EXISTS'
+                           ' artists_name_idx'
+                           ' ON artists (name)')
+
+song_title_duration_index_drop = ('DROP INDEX IF EXISTS'
+                                 ' songs_title_duration_idx')
+
+artist_name_index_drop = 'DROP INDEX IF EXISTS artists_name_idx'
+"""
+SONG LOOKUP INDEX
+=================
+
+  Every (title, artist name, duration) that song_select can match,
+    with the IDs it would return, for the in-memory lookup in etl.py
+"""
+song_index_select = ('SELECT songs.title, artists.name, songs.duration,'
+                    ' songs.song_id, artists.artist_id'
+                    ' FROM songs JOIN artists'
+                    ' ON songs.artist_id = artists.artist_id;')
+"""
+LOAD MANIFEST
+=============
+
+  One row per successfully loaded source file so that etl.py can skip
+    files which haven't changed since they were loaded.
+"""
+load_manifest_table_create = ('CREATE TABLE IF NOT EXISTS load_manifest'
+                                 '(path varchar PRIMARY KEY, '
+                                 'size bigint NOT NULL, '
+                                 'mtime double precision NOT NULL, '
+                                 'content_hash varchar NOT NULL, '
+                                 'loaded_at timestamp NOT NULL)'
+                                 )
+
+load_manifest_table_drop = f'DROP TABLE IF EXISTS load_manifest'
+
+load_manifest_select = ('SELECT path, size, mtime, content_hash'
+                       ' FROM load_manifest;')
+
+load_manifest_upsert = ('INSERT INTO load_manifest'
+                       ' (path, size, mtime, content_hash, loaded_at)'
+                       ' VALUES (%s, %s, %s, %s, now())'
+                       ' ON CONFLICT (path) DO UPDATE SET'
+                       ' size = EXCLUDED.size,'
+                       ' mtime = EXCLUDED.mtime,'
+                       ' content_hash = EXCLUDED.content_hash,'
+                       ' loaded_at = EXCLUDED.loaded_at;')
+"""
+PARTITIONED TABLES (create_tables.py --partition)
+=================================================
+
+  songplays and time can be created range-partitioned by month on
+    time_key, so that queries on a time range only scan the months
+    in it and an old month can be detached, or dropped, with:
+
+      ALTER TABLE songplays DETACH PARTITION songplays_y2018m11;
+
+  etl.py creates each month's partition the first time it has rows
+    for it (partition_create, named by etl.partition_name) and writes
+    the rows of each month straight into its partition. A month's
+    bounds are the time_keys of its first millisecond and of the
+    next month's, so both tables split at the same keys and a join
+    on time_key pairs each partition of songplays with one of time.
+
+  NOTE: a primary key or UNIQUE constraint on a partitioned table
+    has to include the partition key, so the songplays primary key
+    becomes (songplay_id, time_key). songplay_id still comes from
+    one sequence and so is still unique.
+"""
+songplay_table_partitioned_create = ('CREATE TABLE IF NOT EXISTS songplays'
+                                        '(songplay_id BIGSERIAL, '
+                                        'time_key bigint NOT NULL, '
+                                        'start_time timestamp NOT NULL, '
+                                        'user_id int NOT NULL, '
+                                        'level varchar, '
+                                        'song_id varchar, '
+                                        'artist_id varchar, '
+                                        'session_id int, '
+                                        'location varchar, '
+                                        'user_agent text, '
+                                        'PRIMARY KEY (songplay_id, '
+                                        'time_key), '
+                                        'UNIQUE (time_key, user_id))'
+                                        ' PARTITION BY RANGE (time_key)'
+                                        )
+
+time_table_partitioned_create = ('CREATE TABLE IF NOT EXISTS time'
+                                    '(time_key bigint PRIMARY KEY, '
+                                    'start_time timestamp NOT NULL, '
+                                    'hour int, '
+                                    'day int, '
+                                    'week int, '
+                                    'month int, '
+                                    'year int, '
+                                    'weekday varchar)'
+                                    ' PARTITION BY RANGE (time_key)'
+                                    )
+
+"""
+  {partition} and {table} are filled in by etl.py, the month bounds
+    are the query parameters.
+"""
+partition_create = ('CREATE TABLE {partition}'
+                   ' PARTITION OF {table}'
+                   ' FOR VALUES FROM (%s) TO (%s);')
+
+partitioned_tables_select = ('SELECT parent.relname FROM pg_partitioned_table'
+                            ' JOIN pg_class AS parent'
+                            ' ON parent.oid = partrelid'
+                            " WHERE parent.relname IN ('songplays', 'time')"
+                            ' AND pg_table_is_visible(parent.oid);')
+
+partitions_select = ('SELECT child.relname FROM pg_inherits'
+                    ' JOIN pg_class AS parent ON parent.oid = inhparent'
+                    ' JOIN pg_class AS child ON child.oid = inhrelid'
+                    " WHERE parent.relname IN ('songplays', 'time')"
+                    ' AND pg_table_is_visible(parent.oid);')
+"""
+COMPACT SCHEMA (create_tables.py --compact)
+===========================================
+
+  A narrower version of the star schema:
+
+   - duration is double precision and latitude and longitude real,
+       instead of NUMERIC
+   - the time table's calendar fields are smallint, and weekday is
+       a smallint code, 0 for Monday to 6 for Sunday, instead of the
+       day's name
+   - songs and artists get integer surrogate keys, song_key and
+       artist_key. songs refers to its artist by artist_key, and
+       songplays holds song_key and artist_key in place of the
+       18-character song_id and artist_id, which stay in songs and
+       artists as UNIQUE natural keys
+   - songplays holds location_key and user_agent_key instead of the
+       location and user agent text, which are stored once each in
+       the locations and user_agents tables (see INTERNED
+       DIMENSIONS)
+   - songplays holds only time_key, start_time being in the time
+       table it joins
+
+  users keeps the usual table.
+
+  etl.py detects the compact tables (compact_schema_select) and
+    swaps the statements in compact_queries for the usual ones. Song
+    rows look up their artist_key as they are inserted, so etl.py
+    inserts each song's artist first.
+
+  NOTE: the day names come from etl.py as before and are coded by
+    time_table_compact_batch_insert.
+
+  NOTE: the staging tables of the COPY song loader get the same
+    types, so that durations keep every digit on the way through, as
+    they do in a double precision column: a log file's song length
+    is the same float as the song file's duration, which NUMERIC(10,5)
+    would round.
+
+  NOTE: the columns of a multi-row VALUES list that holds nothing
+    but NULLs are typed text, hence the casts on nullable columns.
+"""
+songplay_table_compact_create = ('CREATE TABLE IF NOT EXISTS songplays'
+                                    '(songplay_id BIGSERIAL PRIMARY KEY, '
+                                    'time_key bigint NOT NULL, '
+                                    'user_id int NOT NULL, '
+                                    'UNIQUE (time_key, user_id), '
+                                    'level varchar, '
+                                    'song_key int, '
+                                    'artist_key int, '
+                                    'session_id int, '
+                                    'location_key int, '
+                                    'user_agent_key int)'
+                                    )
+
+song_table_compact_create = ('CREATE TABLE IF NOT EXISTS songs'
+                                '(song_key SERIAL PRIMARY KEY, '
+                                'song_id varchar NOT NULL UNIQUE, '
+                                'title varchar, '
+                                'artist_key int, '
+                                'year smallint, '
+                                'duration double precision)'
+                                )
+
+artist_table_compact_create = ('CREATE TABLE IF NOT EXISTS artists'
+                                  '(artist_key SERIAL PRIMARY KEY, '
+                                  'artist_id varchar NOT NULL UNIQUE, '
+                                  'name varchar, '
+                                  'location varchar, '
+                                  'latitude real, '
+                                  'longitude real)'
+                                  )
+
+time_table_compact_create = ('CREATE TABLE IF NOT EXISTS time'
+                                '(time_key bigint PRIMARY KEY, '
+                                'start_time timestamp NOT NULL, '
+                                'hour smallint, '
+                                'day smallint, '
+                                'week smallint, '
+                                'month smallint, '
+                                'year smallint, '
+                                'weekday smallint)'
+                                )
+
+song_staging_table_compact_create = ('CREATE UNLOGGED TABLE IF NOT EXISTS'
+                                        ' songs_staging'
+                                        '(song_id varchar, '
+                                        'title varchar, '
+                                        'artist_id varchar, '
+                                        'year smallint, '
+                                        'duration double precision)'
+                                        )
+
+artist_staging_table_compact_create = ('CREATE UNLOGGED TABLE IF NOT EXISTS'
+                                          ' artists_staging'
+                                          '(artist_id varchar, '
+                                          'name varchar, '
+                                          'location varchar, '
+                                          'latitude real, '
+                                          'longitude real)'
+                                          )
+
+compact_schema_select = ('SELECT EXISTS (SELECT 1 FROM pg_attribute'
+                        " WHERE attrelid = to_regclass('songs')"
+                        " AND attname = 'song_key'"
+                        ' AND NOT attisdropped);')
+
+song_table_compact_batch_insert = ('INSERT INTO songs'
+                                  ' (song_id, title, artist_key, year,'
+                                  ' duration)'
+                                  ' SELECT batch.song_id, batch.title,'
+                                  ' artists.artist_key,'
+                                  ' batch.year::smallint,'
+                                  ' batch.duration::double precision'
+                                  ' FROM (VALUES %s) AS batch'
+                                  ' (song_id, title, artist_id, year,'
+                                  ' duration)'
+                                  ' LEFT JOIN artists'
+                                  ' ON artists.artist_id = batch.artist_id'
+                                  ' ON CONFLICT (song_id) DO NOTHING;')
+
+song_staging_compact_merge = ('INSERT INTO songs'
+                             ' (song_id, title, artist_key, year, duration)'
+                             ' SELECT DISTINCT ON (staged.song_id)'
+                             ' staged.song_id, staged.title,'
+                             ' artists.artist_key, staged.year,'
+                             ' staged.duration'
+                             ' FROM songs_staging AS staged'
+                             ' LEFT JOIN artists'
+                             ' ON artists.artist_id = staged.artist_id'
+                             ' ON CONFLICT (song_id) DO NOTHING;')
+
+time_table_compact_batch_insert = ('INSERT INTO time'
+                                  ' (time_key, start_time, hour, day,'
+                                  ' week, month, year, weekday)'
+                                  ' SELECT time_key, start_time, hour,'
+                                  ' day, week, month, year,'
+                                  " array_position(ARRAY['Monday',"
+                                  " 'Tuesday', 'Wednesday', 'Thursday',"
+                                  " 'Friday', 'Saturday', 'Sunday'],"
+                                  ' weekday) - 1'
+                                  ' FROM (VALUES %s) AS batch'
+                                  ' (time_key, start_time, hour, day,'
+                                  ' week, month, year, weekday)'
+                                  ' ON CONFLICT (time_key) DO NOTHING;')
+
+songplay_table_compact_batch_insert = ('INSERT INTO songplays'
+                                      ' (time_key, user_id, level,'
+                                      ' song_key, artist_key, session_id,'
+                                      ' location_key, user_agent_key)'
+                                      ' SELECT time_key, user_id, level,'
+                                      ' song_key::int, artist_key::int,'
+                                      ' session_id, location_key::int,'
+                                      ' user_agent_key::int'
+                                      ' FROM (VALUES %s) AS batch'
+                                      ' (time_key, start_time, user_id,'
+                                      ' level, song_key, artist_key,'
+                                      ' session_id, location_key,'
+                                      ' user_agent_key)'
+                                      ' ON CONFLICT DO NOTHING;')
+
+songplay_staging_table_compact_create = ('CREATE TEMPORARY TABLE IF NOT'
+                                            ' EXISTS songplays_staging'
+                                            '(time_key bigint, '
+                                            'user_id int, '
+                                            'level varchar, '
+                                            'song varchar, '
+                                            'artist varchar, '
+                                            'length NUMERIC, '
+                                            'session_id int, '
+                                            'location_key int, '
+                                            'user_agent_key int)'
+                                            )
+
+songplay_staging_compact_copy = ('COPY songplays_staging'
+                                ' (time_key, user_id, level, song, artist,'
+                                ' length, session_id, location_key,'
+                                ' user_agent_key)'
+                                " FROM STDIN WITH (FORMAT csv, NULL '\\N')")
+
+songplay_staging_compact_insert = ('WITH saved AS ('
+                                  ' INSERT INTO songplays'
+                                  ' (time_key, user_id, level, song_key,'
+                                  ' artist_key, session_id, location_key,'
+                                  ' user_agent_key)'
+                                  ' SELECT DISTINCT ON (time_key, user_id)'
+                                  ' time_key, user_id, level, song_key,'
+                                  ' artist_key, session_id, location_key,'
+                                  ' user_agent_key'
+                                  ' FROM (SELECT staged.time_key,'
+                                  ' staged.user_id, staged.level,'
+                                  ' songs.song_key, artists.artist_key,'
+                                  ' staged.session_id, staged.location_key,'
+                                  ' staged.user_agent_key'
+                                  ' FROM songplays_staging AS staged'
+                                  ' LEFT JOIN (songs JOIN artists'
+                                  ' ON songs.artist_key = artists.artist_key)'
+                                  ' ON songs.title = staged.song'
+                                  ' AND artists.name = staged.artist'
+                                  ' AND songs.duration ='
+                                  ' staged.length::double precision'
+                                  ' ) AS resolved'
+                                  ' ORDER BY time_key, user_id, song_key'
+                                  ' ON CONFLICT (time_key, user_id)'
+                                  ' DO NOTHING'
+                                  ' RETURNING song_key)'
+                                  ' SELECT count(*), count(song_key)'
+                                  ' FROM saved;')
+
+song_select_compact = ('SELECT songs.song_key, artists.artist_key'
+                      ' FROM songs JOIN artists'
+                      ' ON songs.artist_key = artists.artist_key'
+                      ' WHERE title = (%s)'
+                      ' AND name = (%s)'
+                      ' AND duration = (%s);')
+
+song_index_compact_select = ('SELECT songs.title, artists.name,'
+                            ' songs.duration, songs.song_key,'
+                            ' artists.artist_key'
+                            ' FROM songs JOIN artists'
+                            ' ON songs.artist_key = artists.artist_key;')
+"""
+INTERNED DIMENSIONS
+===================
+
+  Each distinct location and user agent string is stored once, in
+    the locations and user_agents tables, under an integer key that
+    songplays refers to. etl.py keeps every value -> key pair in
+    memory, read at the start of the run with the *_keys_select
+    queries, and writes only values it hasn't seen: *_insert adds
+    them and *_new_keys_select reads back their keys.
+
+  The locations table and the keys in songplays are only in the
+    compact schema. The user_agents table is in both: each user
+    agent is stored with the browser, os and device that etl.py
+    parsed from it (see user_agent.py), so they can be grouped by
+    without a regular expression over every songplay. Join it on
+    user_agent in the standard schema, on user_agent_key in the
+    compact one. etl.py fills it when it finds the browser column
+    (user_agent_dimension_select).
+"""
+location_table_create = ('CREATE TABLE IF NOT EXISTS locations'
+                            '(location_key SERIAL PRIMARY KEY, '
+                            'location varchar NOT NULL UNIQUE)'
+                            )
+
+user_agent_table_create = ('CREATE TABLE IF NOT EXISTS user_agents'
+                              '(user_agent_key SERIAL PRIMARY KEY, '
+                              'user_agent text NOT NULL UNIQUE, '
+                              'browser varchar, '
+                              'os varchar, '
+                              'device varchar)'
+                              )
+
+location_table_drop = f'DROP TABLE IF EXISTS locations'
+user_agent_table_drop = f'DROP TABLE IF EXISTS user_agents'
+
+location_insert = ('INSERT INTO locations (location)'
+                  ' VALUES %s'
+                  ' ON CONFLICT (location) DO NOTHING;')
+
+user_agent_insert = ('INSERT INTO user_agents'
+                    ' (user_agent, browser, os, device)'
+                    ' VALUES %s'
+                    ' ON CONFLICT (user_agent) DO NOTHING;')
+
+location_keys_select = 'SELECT location, location_key FROM locations;'
+
+user_agent_keys_select = ('SELECT user_agent, user_agent_key'
+                         ' FROM user_agents;')
+
+location_new_keys_select = ('SELECT location, location_key FROM locations'
+                           ' WHERE location = ANY(%s);')
+
+user_agent_new_keys_select = ('SELECT user_agent, user_agent_key'
+                             ' FROM user_agents'
+                             ' WHERE user_agent = ANY(%s);')
+
+user_agent_dimension_select = ('SELECT EXISTS (SELECT 1 FROM pg_attribute'
+                              " WHERE attrelid = to_regclass('user_agents')"
+                              " AND attname = 'browser'"
+                              ' AND NOT attisdropped);')
+"""
+BULK LOAD (create_tables.py --bulk-load and --finalize)
+=======================================================
+
+  For a full rebuild the five tables can be created UNLOGGED and
+    without their primary keys, UNIQUE constraints or indexes, so the
+    inserts made by etl.py write no WAL and maintain no indexes.
+    etl.py sees the UNLOGGED songplays table (bulk_load_select) and
+    drops the conflict targets from its inserts, which have no
+    constraint to check against.
+
+  The finalize step then, for each table:
+
+   - removes duplicate keys, keeping the row the ON CONFLICT clauses
+       would have kept: the first one loaded, or for users the last
+       one, whose level DO UPDATE would have written
+   - switches the table to LOGGED and adds its constraints in a
+       single ALTER TABLE, so the table is rewritten only once
+
+  and afterwards runs ANALYZE. The song_select indexes are created
+    with the tables, as the lookups etl.py makes during the load need
+    them.
+
+  NOTE: until the tables are finalized every copy of an artist is in
+    the artists table, so with the per-row song_select lookups a
+    NextSong row can match any of the names an artist has in the
+    song files, not only the first one loaded.
+
+  NOTE: ctid gives the load order, the tables being insert-only
+    until they are finalized. songplays uses songplay_id.
+
+  NOTE: load_manifest is always created normally: its upsert needs
+    the primary key and it is only one row per file.
+"""
+songplay_table_bulk_create = ('CREATE UNLOGGED TABLE IF NOT EXISTS'
+                                 ' songplays'
+                                 '(songplay_id BIGSERIAL, '
+                                 'time_key bigint NOT NULL, '
+                                 'start_time timestamp NOT NULL, '
+                                 'user_id int NOT NULL, '
+                                 'level varchar, '
+                                 'song_id varchar, '
+                                 'artist_id varchar, '
+                                 'session_id int, '
+                                 'location varchar, '
+                                 'user_agent text)'
+                                 )
+
+user_table_bulk_create = ('CREATE UNLOGGED TABLE IF NOT EXISTS users'
+                             '(user_id int NOT NULL, '
+                             'first_name varchar, '
+                             'last_name varchar, '
+                             'gender varchar, '
+                             'level varchar)'
+                             )
+
+song_table_bulk_create = ('CREATE UNLOGGED TABLE IF NOT EXISTS songs'
+                             '(song_id varchar NOT NULL, '
+                             'title varchar, '
+                             'artist_id varchar, '
+                             'year int, '
+                             'duration NUMERIC(10,5))'
+                             )
+
+artist_table_bulk_create = ('CREATE UNLOGGED TABLE IF NOT EXISTS artists'
+                               '(artist_id varchar NOT NULL, '
+                               'name varchar, '
+                               'location varchar, '
+                               'latitude NUMERIC(8,5), '
+                               'longitude NUMERIC(8,5))'
+                               )
+
+time_table_bulk_create = ('CREATE UNLOGGED TABLE IF NOT EXISTS time'
+                             '(time_key bigint NOT NULL, '
+                             'start_time timestamp NOT NULL, '
+                             'hour int, '
+                             'day int, '
+                             'week int, '
+                             'month int, '
+                             'year int, '
+                             'weekday varchar)'
+                             )
+
+bulk_load_select = ("SELECT relpersistence = 'u' FROM pg_class"
+                   " WHERE oid = to_regclass('songplays');")
+
+songplay_table_dedupe = ('DELETE FROM songplays WHERE songplay_id IN'
+                        ' (SELECT songplay_id FROM (SELECT songplay_id,'
+                        ' row_number() OVER (PARTITION BY time_key,'
+                        ' user_id ORDER BY songplay_id) AS copy'
+                        ' FROM songplays) AS copies WHERE copy > 1);')
+
+user_table_dedupe = ('DELETE FROM users WHERE ctid IN'
+                    ' (SELECT ctid FROM (SELECT ctid,'
+                    ' row_number() OVER (PARTITION BY user_id'
+                    ' ORDER BY ctid DESC) AS copy'
+                    ' FROM users) AS copies WHERE copy > 1);')
+
+song_table_dedupe = ('DELETE FROM songs WHERE ctid IN'
+                    ' (SELECT ctid FROM (SELECT ctid,'
+                    ' row_number() OVER (PARTITION BY song_id'
+                    ' ORDER BY ctid) AS copy'
+                    ' FROM songs) AS copies WHERE copy > 1);')
+
+artist_table_dedupe = ('DELETE FROM artists WHERE ctid IN'
+                      ' (SELECT ctid FROM (SELECT ctid,'
+                      ' row_number() OVER (PARTITION BY artist_id'
+                      ' ORDER BY ctid) AS copy'
+                      ' FROM artists) AS copies WHERE copy > 1);')
+
+time_table_dedupe = ('DELETE FROM time WHERE ctid IN'
+                    ' (SELECT ctid FROM (SELECT ctid,'
+                    ' row_number() OVER (PARTITION BY time_key'
+                    ' ORDER BY ctid) AS copy'
+                    ' FROM time) AS copies WHERE copy > 1);')
+
+songplay_table_finalize = ('ALTER TABLE songplays SET LOGGED,'
+                          ' ADD PRIMARY KEY (songplay_id),'
+                          ' ADD UNIQUE (time_key, user_id);')
+
+user_table_finalize = ('ALTER TABLE users SET LOGGED,'
+                      ' ADD PRIMARY KEY (user_id);')
+
+song_table_finalize = ('ALTER TABLE songs SET LOGGED,'
+                      ' ADD PRIMARY KEY (song_id);')
+
+artist_table_finalize = ('ALTER TABLE artists SET LOGGED,'
+                        ' ADD PRIMARY KEY (artist_id);')
+
+time_table_finalize = ('ALTER TABLE time SET LOGGED,'
+                      ' ADD PRIMARY KEY (time_key);')
+
+tables_analyze = 'ANALYZE songplays, users, songs, artists, time;'
+"""
 QUERY LISTS
 ===========
 """
 create_table_queries = [songplay_table_create, user_table_create,
                          song_table_create, artist_table_create,
-                         time_table_create]
+                         time_table_create, song_staging_table_create,
+                         artist_staging_table_create,
+                         load_manifest_table_create,
+                         user_agent_table_create,
+                         song_title_duration_index_create,
+                         artist_name_index_create]
 
 drop_table_queries = [songplay_table_drop, user_table_drop,
                         song_table_drop, artist_table_drop,
-                        time_table_drop]
+                        time_table_drop, song_staging_table_drop,
+                        artist_staging_table_drop,
+                        load_manifest_table_drop,
+                        location_table_drop, user_agent_table_drop]
+
+song_staging_queries = [song_staging_table_create,
+                          artist_staging_table_create]
+
+song_select_index_queries = [song_title_duration_index_create,
+                               artist_name_index_create]
+
+song_select_index_drop_queries = [song_title_duration_index_drop,
+                                    artist_name_index_drop]
+
+"""
+  For each table create_tables.py can partition, its usual CREATE
+    statement and the partitioned one that replaces it.
+"""
+partitioned_table_creates = {
+    'songplays': (songplay_table_create, songplay_table_partitioned_create),
+    'time': (time_table_create, time_table_partitioned_create)
+    }
+
+compact_create_table_queries = [songplay_table_compact_create,
+                                 user_table_create,
+                                 song_table_compact_create,
+                                 artist_table_compact_create,
+                                 time_table_compact_create,
+                                 location_table_create,
+                                 user_agent_table_create,
+                                 song_staging_table_compact_create,
+                                 artist_staging_table_compact_create,
+                                 load_manifest_table_create,
+                                 song_title_duration_index_create,
+                                 artist_name_index_create]
+
+"""
+  The etl.py statements, by name, that the compact schema replaces.
+"""
+compact_queries = {
+    'song_table_batch_insert': song_table_compact_batch_insert,
+    'song_staging_merge': song_staging_compact_merge,
+    'time_table_batch_insert': time_table_compact_batch_insert,
+    'songplay_table_batch_insert': songplay_table_compact_batch_insert,
+    'songplay_staging_table_create': songplay_staging_table_compact_create,
+    'songplay_staging_copy': songplay_staging_compact_copy,
+    'songplay_staging_insert': songplay_staging_compact_insert,
+    'song_select': song_select_compact,
+    'song_index_select': song_index_compact_select
+    }
+
+bulk_create_table_queries = [songplay_table_bulk_create,
+                              user_table_bulk_create,
+                              song_table_bulk_create,
+                              artist_table_bulk_create,
+                              time_table_bulk_create,
+                              song_staging_table_create,
+                              artist_staging_table_create,
+                              load_manifest_table_create,
+                              user_agent_table_create,
+                              song_title_duration_index_create,
+                              artist_name_index_create]
+
+bulk_finalize_queries = [songplay_table_dedupe, songplay_table_finalize,
+                          user_table_dedupe, user_table_finalize,
+                          song_table_dedupe, song_table_finalize,
+                          artist_table_dedupe, artist_table_finalize,
+                          time_table_dedupe, time_table_finalize,
+                          tables_analyze]
@@ -0,0 +1,308 @@
+"""
+SQL Statement Tracing
+=====================
+
+  An opt-in cursor for etl.py, create_tables.py and test.py that
+    times every statement it runs, so we can see where a run spends
+    its time in the database: song_select, songplay_table_insert,
+    time_table_batch_insert and so on.
+
+  Set SPARKIFY_TRACE_SQL=1 in the environment to turn it on, and
+    SPARKIFY_TRACE_TOP to the number of statements in the report at
+    the end of the run (default 10), for example:
+
+      SPARKIFY_TRACE_SQL=1 python etl.py
+
+  For each statement the call count, total time and a latency
+    histogram are kept, from which p50, p95 and p99 are reported.
+    Statements are named after their variable in sql_queries.py, also
+    when etl.py has rewritten them for a partition or for --bulk-load
+    tables; anything else is named by its first few words.
+
+  When tracing is off cursor_factory returns None, so the scripts get
+    psycopg2's own cursor and pay nothing for it.
+
+"""
+
+"""
+Imports
+=======
+
+  os - the environment variables that turn tracing on
+  re - recognising savepoint prefixes
+  math - histogram bucket arithmetic
+  time - statement timing
+  collections - Counter for the histogram buckets
+  psycopg2 - the cursor class being instrumented
+  sql_queries - the statements to be named
+
+"""
+
+import os
+import re
+import math
+import time
+import collections
+
+import psycopg2.extensions
+
+import sql_queries
+
+
+TRACE_ENV = 'SPARKIFY_TRACE_SQL'
+TRACE_TOP_ENV = 'SPARKIFY_TRACE_TOP'
+TRACE_TOP = 10
+
+"""
+  Latency histogram buckets grow by HISTOGRAM_RATIO from
+    HISTOGRAM_FLOOR seconds, so percentiles are reported to within
+    10% while each statement needs only a few dozen counters however
+    often it runs.
+"""
+
+HISTOGRAM_FLOOR = 1e-6
+HISTOGRAM_RATIO = 1.1
+
+"""
+  Length at which statements not in sql_queries.py are cut to make
+    their name.
+"""
+
+UNNAMED_LENGTH = 48
+
+SAVEPOINT_PREFIX = re.compile(r'^(?:(?:RELEASE )?SAVEPOINT \w+; )+')
+
+"""
+  etl.py inserts into a monthly partition, songplays_y2018m11 for
+    example, by rewriting the table name of the insert, and drops the
+    conflict target of the BULK_LOAD_QUERIES for --bulk-load tables.
+    Both are taken out of a statement before it is named.
+"""
+
+PARTITION_INSERT = re.compile(r'^INSERT INTO (\w+)_y\d{4}m\d{2} ')
+
+CONFLICT_CLAUSE = re.compile(
+    r' ON CONFLICT(?: \([^)]*\))? DO (?:NOTHING|UPDATE SET [^;]*)')
+
+"""
+  statement_stats holds, for each statement name, a dictionary of:
+
+   - calls: number of times it was run
+   - seconds: total time
+   - buckets: Counter of histogram bucket -> calls
+"""
+
+statement_stats = {}
+
+def normalise(query):
+
+    """
+    Returns 'query' with any partition table name put back to its
+      parent table and any ON CONFLICT clause taken out.
+    """
+
+    query = PARTITION_INSERT.sub(r'INSERT INTO \1 ', query, 1)
+    return CONFLICT_CLAUSE.sub('', query)
+
+
+statement_names = {normalise(value): name
+                   for name, value in reversed(vars(sql_queries).items())
+                   if isinstance(value, str) and not name.startswith('_')}
+
+"""
+  Statements executed through psycopg2.extras.execute_values arrive
+    with their VALUES already filled in, so they are recognised by the
+    text either side of the 'VALUES %s' placeholder instead.
+"""
+
+batch_statements = [(query.split('VALUES %s')[0],
+                     query.split('VALUES %s')[1],
+                     name)
+                    for query, name in statement_names.items()
+                    if 'VALUES %s' in query]
+
+
+def tracing_enabled():
+
+    """
+    Returns True when SPARKIFY_TRACE_SQL is set to anything other
+      than '', '0' or 'false'.
+    """
+
+    return os.environ.get(TRACE_ENV, '').lower() not in ('', '0', 'false')
+
+
+def cursor_factory():
+
+    """
+    Returns the cursor class to pass to connection.cursor(), which is
+      None (psycopg2's default) unless tracing is enabled.
+    """
+
+    if tracing_enabled():
+        return TracingCursor
+    return None
+
+
+def statement_name(query):
+
+    """
+    Names the statement 'query' after its variable in sql_queries.py.
+
+    Parameters:
+
+     - query: the SQL as passed to execute, str or bytes
+
+    Returns: the statement name
+
+    """
+
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    query = normalise(SAVEPOINT_PREFIX.sub('', query))
+    name = statement_names.get(query)
+    if name is not None:
+        return name
+    for before, after, name in batch_statements:
+        if query.startswith(before) and query.endswith(after):
+            return name
+    return ' '.join(query.split())[:UNNAMED_LENGTH]
+
+
+def record(name, seconds):
+
+    """
+    Adds one call of 'seconds' to the statistics for statement 'name'.
+    """
+
+    stats = statement_stats.get(name)
+    if stats is None:
+        stats = {'calls': 0, 'seconds': 0.0,
+                 'buckets': collections.Counter()}
+        statement_stats[name] = stats
+    stats['calls'] += 1
+    stats['seconds'] += seconds
+    bucket = 0
+    if seconds > HISTOGRAM_FLOOR:
+        bucket = math.ceil(math.log(seconds / HISTOGRAM_FLOOR,
+                                    HISTOGRAM_RATIO))
+    stats['buckets'][bucket] += 1
+
+
+def take_statement_stats():
+
+    """
+    Returns statement_stats and starts it afresh, used by the etl.py
+      workers to hand their statistics back to the parent.
+    """
+
+    global statement_stats
+
+    taken, statement_stats = statement_stats, {}
+    return taken
+
+
+def merge_statement_stats(other):
+
+    """
+    Adds statistics returned by take_statement_stats (in a worker
+      process) to statement_stats.
+    """
+
+    for name, other_stats in other.items():
+        stats = statement_stats.setdefault(
+            name,
+            {'calls': 0, 'seconds': 0.0, 'buckets': collections.Counter()}
+            )
+        stats['calls'] += other_stats['calls']
+        stats['seconds'] += other_stats['seconds']
+        stats['buckets'].update(other_stats['buckets'])
+
+
+def percentile(buckets, fraction):
+
+    """
+    Returns the latency, in seconds, below which 'fraction' of the
+      calls in 'buckets' fell, to within HISTOGRAM_RATIO.
+    """
+
+    target = fraction * sum(buckets.values())
+    seen = 0
+    for bucket in sorted(buckets):
+        seen += buckets[bucket]
+        if seen >= target:
+            return HISTOGRAM_FLOOR * HISTOGRAM_RATIO ** bucket
+    return 0.0
+
+
+def statement_report(top=None):
+
+    """
+    Builds the slowest-statements report for the end of a run.
+
+    Parameters:
+
+     - top: number of statements to include, by total time, None uses
+         SPARKIFY_TRACE_TOP
+
+    Returns: the report as a string
+
+    """
+
+    if top is None:
+        top = int(os.environ.get(TRACE_TOP_ENV, TRACE_TOP))
+    ranked = sorted(statement_stats.items(),
+                    key=lambda item: item[1]['seconds'],
+                    reverse=True)
+    total = sum(stats['seconds'] for stats in statement_stats.values())
+    report = (
+        f'\n'
+        f'  Slowest SQL statements, top {min(top, len(ranked))} of '
+        f'{len(ranked)} by total '
+        f'time ({total:.3f}s in all):\n\n'
+        f'  {"statement":<48} {"calls":>8} {"total s":>9} '
+        f'{"mean ms":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}\n'
+        )
+    for name, stats in ranked[:top]:
+        buckets = stats['buckets']
+        report += (
+            f'  {name:<48} {stats["calls"]:>8} '
+            f'{stats["seconds"]:>9.3f} '
+            f'{stats["seconds"] / stats["calls"] * 1000:>8.3f} '
+            f'{percentile(buckets, 0.50) * 1000:>8.3f} '
+            f'{percentile(buckets, 0.95) * 1000:>8.3f} '
+            f'{percentile(buckets, 0.99) * 1000:>8.3f}\n'
+            )
+    return report
+
+
+class TracingCursor(psycopg2.extensions.cursor):
+
+    """
+    A psycopg2 cursor that records the time taken by each execute,
+      executemany and copy_expert call against the statement's name.
+
+    NOTE: psycopg2.extras.execute_values calls execute once per page,
+      so each page counts as one call of the batch statement.
+    """
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record(statement_name(query), time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record(statement_name(query), time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            record(statement_name(sql), time.perf_counter() - start)
@@ -15,10 +15,16 @@ Imports
 =======
 
   psycopg2 to handle interaction with PostgreSQL
+  sql_trace to time each query when SPARKIFY_TRACE_SQL is set
+  connection_pool for the connection settings and pooled connections
+  sql_queries for the check on the compact schema
 
 """
 
 import psycopg2
+import sql_trace
+import connection_pool
+from sql_queries import compact_schema_select
 
 
 """
@@ -101,9 +107,7 @@ def main():
 
     """
     try:
-        sparkify_connection = psycopg2.connect(
-            'host=127.0.0.1 dbname=sparkify user=student password=student'
-            )
+        sparkify_connection = connection_pool.getconn()
         sparkify_connection.set_session(autocommit=True)
         logging.info(
             f'\n'
@@ -128,7 +132,8 @@ def main():
     """
 
     try:
-        sparkify_cursor = sparkify_connection.cursor()
+        sparkify_cursor = sparkify_connection.cursor(
+            cursor_factory=sql_trace.cursor_factory())
         logging.info(
             f'\n'
             f'  Sparkify cursor active\n'
@@ -145,6 +150,26 @@ def main():
             f'{UNDERLINE_1}'
             )
 
+    """
+    With create_tables.py --compact songplays refers to songs and
+      artists by song_key and artist_key instead.
+
+    """
+
+    song_column, artist_column = 'song_id', 'artist_id'
+    try:
+        sparkify_cursor.execute(compact_schema_select)
+        if sparkify_cursor.fetchone()[0]:
+            song_column, artist_column = 'song_key', 'artist_key'
+    except psycopg2.Error as e:
+        logging.error(
+            f'\n'
+            f'  Something went wrong checking for the compact schema\n'
+            f'  Error raised is: \n'
+            f'    {e}\n'
+            f'{UNDERLINE_2}'
+            )
+
     """
     TEST 1
     ======
@@ -152,7 +177,8 @@ def main():
 
     """
 
-    sql = f'SELECT songplay_id, song_id, artist_id FROM songplays{LIMIT_STRING}'
+    sql = (f'SELECT songplay_id, {song_column}, {artist_column}'
+           f' FROM songplays{LIMIT_STRING}')
     try:
         sparkify_cursor.execute(sql)
         songplays_rows_found = sparkify_cursor.rowcount
@@ -323,8 +349,8 @@ def main():
     """
 
     sql = (f'SELECT * FROM songplays'
-          f' WHERE song_id is NOT NULL'
-          f' AND artist_id is NOT NULL'
+          f' WHERE {song_column} is NOT NULL'
+          f' AND {artist_column} is NOT NULL'
           f' {LIMIT_STRING}'
           )
     try:
@@ -383,10 +409,10 @@ def main():
             )
 
     try:
-        sparkify_connection.close()
+        connection_pool.putconn(sparkify_connection)
         logging.info(
             f'\n'
-            f'  Sparkify connection closed\n'
+            f'  Sparkify connection released\n'
             f'{UNDERLINE_3}\n'
             )
     except psycopg2.Error as e:
@@ -429,6 +455,9 @@ def main():
 
     """
 
+    if sql_trace.tracing_enabled():
+        logging.info(sql_trace.statement_report())
+
     logging.info(
         f'\n'
         f'  We\'ve got to the end!!\n\n'
@@ -0,0 +1,115 @@
+"""
+User Agent Parsing
+==================
+
+  Splits the userAgent string of a log event into the browser, the
+    operating system and the class of device it came from, for the
+    user_agents dimension table filled by etl.py (see INTERNED
+    DIMENSIONS in sql_queries.py).
+
+  Only the family of each is kept ('Chrome', 'Windows', 'mobile' and
+    so on), which is what the analysts group by; the version numbers
+    are still in the raw string. The rules below are tried in order
+    and the first that matches wins, so the more specific ones come
+    first: Chromium and Edge also claim to be Chrome and Safari, and
+    an iPhone also says it's 'like Mac OS X'.
+
+  A log file repeats a handful of user agents thousands of times, so
+    etl.py parses each distinct string once and keeps the result; the
+    rules here are only run for strings it hasn't seen.
+
+"""
+
+"""
+Imports
+=======
+
+  re - the parsing rules
+
+"""
+
+import re
+
+
+UNKNOWN = 'Other'
+
+DESKTOP = 'desktop'
+
+"""
+  (name, pattern) rules for each attribute, tried in order.
+"""
+
+BROWSER_RULES = [
+    ('Edge', r'\bEdg(e|A|iOS)?/'),
+    ('Opera', r'\bOPR/|\bOpera\b'),
+    ('Internet Explorer', r'\bMSIE |\bTrident/'),
+    ('Firefox', r'\bFirefox/|\bFxiOS/'),
+    ('Chromium', r'\bChromium/'),
+    ('Chrome', r'\bChrome/|\bCriOS/'),
+    ('Safari', r'\bSafari/'),
+    ]
+
+OS_RULES = [
+    ('Windows Phone', r'\bWindows Phone\b'),
+    ('Windows', r'\bWindows\b'),
+    ('iOS', r'\b(iPhone|iPad|iPod)\b'),
+    ('Mac OS X', r'\bMac OS X\b|\bMacintosh\b'),
+    ('Android', r'\bAndroid\b'),
+    ('Chrome OS', r'\bCrOS\b'),
+    ('Linux', r'\bLinux\b|\bX11\b'),
+    ]
+
+DEVICE_RULES = [
+    ('bot', r'(?i)bot\b|crawl|spider|slurp'),
+    ('tablet', r'\biPad\b|\bTablet\b|\bAndroid\b(?!.*\bMobile\b)'),
+    ('mobile', r'\bMobile\b|\biPhone\b|\biPod\b|\bWindows Phone\b'),
+    ]
+
+
+def compile_rules(rules):
+
+    """
+    Returns the rules with their patterns compiled.
+    """
+
+    return [(name, re.compile(pattern)) for name, pattern in rules]
+
+
+browser_rules = compile_rules(BROWSER_RULES)
+os_rules = compile_rules(OS_RULES)
+device_rules = compile_rules(DEVICE_RULES)
+
+
+def first_match(rules, text, default):
+
+    """
+    Returns the name of the first of 'rules' whose pattern is found
+      in 'text', or 'default' if none is.
+    """
+
+    for name, pattern in rules:
+        if pattern.search(text):
+            return name
+    return default
+
+
+def parse_user_agent(raw):
+
+    """
+    Parses a userAgent string from the log files.
+
+    Parameters:
+
+     - raw: the userAgent string, as it is in the log, some of which
+         are wrapped in double quotes
+
+    Returns: a (browser, os, device) tuple of strings, 'Other' for a
+      browser or operating system that isn't recognised and
+      'desktop' for a device that isn't a phone, tablet or bot
+
+    """
+
+    text = raw.strip().strip('"')
+    return (first_match(browser_rules, text, UNKNOWN),
+            first_match(os_rules, text, UNKNOWN),
+            first_match(device_rules, text, DESKTOP))